@@ -43,6 +43,7 @@ def output_hdul(set_inandout_filenames, config):
     esa_files_path = config.get("esa_intermediary_products", "esa_files_path")
     wcs_threshold_diff = config.get("additional_arguments", "wcs_threshold_diff")
     save_wcs_plots = config.getboolean("additional_arguments", "save_wcs_plots")
+    n_workers = config.getint("additional_arguments", "n_workers", fallback=1)
     # if run_calwebb_spec2 is True calwebb_spec2 will be called, else individual steps will be ran
     step_completed = False
     end_time = '0.0'
@@ -86,7 +87,7 @@ def output_hdul(set_inandout_filenames, config):
         step_output_file = core_utils.read_completion_to_full_run_map(full_run_map, step)
         hdul = core_utils.read_hdrfits(step_output_file, info=True, show_hdr=True)
         scihdul = core_utils.read_hdrfits(step_output_file, info=False, show_hdr=False, ext=1)
-        return hdul, scihdul, step_output_file, esa_files_path, wcs_threshold_diff, save_wcs_plots
+        return hdul, scihdul, step_output_file, esa_files_path, wcs_threshold_diff, save_wcs_plots, n_workers
     else:
         # create the Map of file names
         assign_wcs_utils.create_completed_steps_txtfile(txt_name, step_input_file)
@@ -116,7 +117,7 @@ def output_hdul(set_inandout_filenames, config):
                 core_utils.add_completed_steps(txt_name, step, outstep_file_suffix, step_completed, end_time)
                 hdul = core_utils.read_hdrfits(step_output_file, info=False, show_hdr=False, ext=0)
                 scihdul = core_utils.read_hdrfits(step_output_file, info=False, show_hdr=False, ext=1)
-                return hdul, scihdul, step_output_file, esa_files_path, wcs_threshold_diff, save_wcs_plots
+                return hdul, scihdul, step_output_file, esa_files_path, wcs_threshold_diff, save_wcs_plots, n_workers
             else:
                 print("Skipping step. Intput file "+step_input_file+" does not exit.")
                 core_utils.add_completed_steps(txt_name, step, outstep_file_suffix, step_completed, end_time)
@@ -143,13 +144,16 @@ def validate_wcs_IFU(output_hdul):
     # save the output plots
     save_wcs_plots = output_hdul[5]
 
+    # number of processes to read the IFU slices in parallel
+    n_workers = output_hdul[6]
+
     # show the figures
     show_figs = False
 
     if core_utils.check_IFU_true(hdu):
         median_diff = compare_wcs_ifu.compare_wcs(infile_name, esa_files_path=esa_files_path, auxiliary_code_path=None,
                                                   plot_names=None, show_figs=show_figs, save_figs=save_wcs_plots,
-                                                  threshold_diff=threshold_diff)
+                                                  threshold_diff=threshold_diff, n_workers=n_workers)
     else:
         pytest.skip("Skipping pytest: Validation of WCS step for non IFU data will be done after the extract_2d step.")
 
@@ -38,6 +38,7 @@ def output_hdul(set_inandout_filenames, config):
     msa_conf_name = config.get("esa_intermediary_products", "msa_conf_name")
     wcs_threshold_diff = config.get("additional_arguments", "wcs_threshold_diff")
     save_wcs_plots = config.getboolean("additional_arguments", "save_wcs_plots")
+    n_workers = config.getint("additional_arguments", "n_workers", fallback=1)
     # if run_calwebb_spec2 is True calwebb_spec2 will be called, else individual steps will be ran
     step_completed = False
     end_time = '0.0'
@@ -53,7 +54,8 @@ def output_hdul(set_inandout_filenames, config):
             step_output_file = os.path.join(working_directory, local_step_output_file)
             print ("Step product was saved as: ", step_output_file)
             subprocess.run(["mv", local_step_output_file, step_output_file])
-            return hdul, step_output_file, msa_conf_name, esa_files_path, wcs_threshold_diff, save_wcs_plots
+            return hdul, step_output_file, msa_conf_name, esa_files_path, wcs_threshold_diff, save_wcs_plots, \
+                   n_workers
         else:
             if config.getboolean("steps", step):
                 print ("*** Step "+step+" set to True")
@@ -74,7 +76,8 @@ def output_hdul(set_inandout_filenames, config):
                     step_completed = True
                     core_utils.add_completed_steps(txt_name, step, outstep_file_suffix, step_completed, end_time)
                     hdul = core_utils.read_hdrfits(step_output_file, info=False, show_hdr=False)
-                    return hdul, step_output_file, msa_conf_name, esa_files_path, wcs_threshold_diff, save_wcs_plots
+                    return hdul, step_output_file, msa_conf_name, esa_files_path, wcs_threshold_diff, save_wcs_plots, \
+                           n_workers
                 else:
                     core_utils.add_completed_steps(txt_name, step, outstep_file_suffix, step_completed, end_time)
                     pytest.skip("Skiping "+step+" because the input file does not exist.")
@@ -103,6 +106,9 @@ def validate_wcs_extract2d(output_hdul):
     # save the output plots
     save_wcs_plots = output_hdul[5]
 
+    # number of processes to compare the MOS slitlets in parallel
+    n_workers = output_hdul[6]
+
     # show the figures
     show_figs = False
 
@@ -120,7 +126,7 @@ def validate_wcs_extract2d(output_hdul):
         median_diff = compare_wcs_mos.compare_wcs(infile_name, msa_conf_name=msa_conf_name,
                                                   esa_files_path=esa_files_path, auxiliary_code_path=None,
                                                   plot_names=None, show_figs=show_figs, save_figs=save_wcs_plots,
-                                                  threshold_diff=threshold_diff)
+                                                  threshold_diff=threshold_diff, n_workers=n_workers)
 
     else:
         pytest.skip("Skipping pytest: The fits file is not FS, MOS, or IFU. Tool does not yet include the routine to verify this kind of file.")
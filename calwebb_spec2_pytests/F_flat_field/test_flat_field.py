@@ -42,8 +42,10 @@ def output_hdul(set_inandout_filenames, config):
     flattest_threshold_diff = config.get("additional_arguments", "flattest_threshold_diff")
     save_flattest_plot = config.getboolean("additional_arguments", "save_flattest_plot")
     write_flattest_files = config.getboolean("additional_arguments", "write_flattest_files")
-    flattest_paths = [step_output_file, msa_shutter_conf, dflat_path, sflat_path, fflat_path]
-    flattest_switches = [flattest_threshold_diff, save_flattest_plot, write_flattest_files]
+    reference_flat_cache = config.get("additional_arguments", "reference_flat_cache", fallback=None)
+    flattest_paths = [step_output_file, msa_shutter_conf, dflat_path, sflat_path, fflat_path, reference_flat_cache]
+    n_workers = config.getint("additional_arguments", "n_workers", fallback=1)
+    flattest_switches = [flattest_threshold_diff, save_flattest_plot, write_flattest_files, n_workers]
     skip_runing_pipe_step = config.getboolean("tests_only", "_".join((step, "tests")))
     # if run_calwebb_spec2 is True calwebb_spec2 will be called, else individual steps will be ran
     step_completed = False
@@ -112,8 +114,8 @@ def output_hdul(set_inandout_filenames, config):
 def validate_flat_field(output_hdul):
     # get the input information for the wcs routine
     hdu = output_hdul[0]
-    step_output_file, msa_shutter_conf, dflatref_path, sfile_path, fflat_path = output_hdul[1]
-    flattest_threshold_diff, save_flattest_plot, write_flattest_files = output_hdul[2]
+    step_output_file, msa_shutter_conf, dflatref_path, sfile_path, fflat_path, reference_flat_cache = output_hdul[1]
+    flattest_threshold_diff, save_flattest_plot, write_flattest_files, n_workers = output_hdul[2]
 
     # show the figures
     show_figs = False
@@ -122,21 +124,24 @@ def validate_flat_field(output_hdul):
         median_diff, msg = flattest_fs.flattest(step_output_file, dflatref_path=dflatref_path, sfile_path=sfile_path,
                                                 fflat_path=fflat_path, writefile=write_flattest_files,
                                                 show_figs=show_figs, save_figs=save_flattest_plot, plot_name=None,
-                                                threshold_diff=flattest_threshold_diff, debug=False)
+                                                threshold_diff=flattest_threshold_diff, debug=False,
+                                                cache_dir=reference_flat_cache)
 
     elif core_utils.check_MOS_true(hdu):
         median_diff, msg = flattest_mos.flattest(step_output_file, dflatref_path=dflatref_path, sfile_path=sfile_path,
                                                fflat_path=fflat_path, msa_shutter_conf=msa_shutter_conf,
                                                writefile=write_flattest_files,
                                                show_figs=show_figs, save_figs=save_flattest_plot, plot_name=None,
-                                               threshold_diff=flattest_threshold_diff, debug=False)
+                                               threshold_diff=flattest_threshold_diff, debug=False,
+                                               cache_dir=reference_flat_cache, n_workers=n_workers)
 
     elif core_utils.check_IFU_true(hdu):
         median_diff, msg = flattest_ifu.flattest(step_output_file, dflatref_path=dflatref_path, sfile_path=sfile_path,
                                                 fflat_path=fflat_path, writefile=write_flattest_files,
                                                 mk_all_slices_plt=False, show_figs=show_figs,
                                                 save_figs=save_flattest_plot, plot_name=None,
-                                                threshold_diff=flattest_threshold_diff, debug=False)
+                                                threshold_diff=flattest_threshold_diff, debug=False,
+                                                cache_dir=reference_flat_cache, n_workers=n_workers)
 
     else:
         pytest.skip("Skipping pytest: The input fits file is not FS, MOS, or IFU. This tool does not yet include the "
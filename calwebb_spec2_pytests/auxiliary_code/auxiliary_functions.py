@@ -1,16 +1,33 @@
 import numpy as np
 import os
+import functools
+import hashlib
+import json
+import multiprocessing
+import shutil
+from collections import namedtuple
 from scipy import integrate
 from scipy import interpolate
 from astropy.io import fits
 from glob import glob
 
+from .. import core_utils
+
 
 """
 This script contains the auxiliary functions that the wcs FS, MOS, and IFU WCS scripts use.
 """
 
 
+# pipeline minus ESA deltas of the good pixels of a subwindow, and their pixel and ESA MSA positions
+SubwindowDeltas = namedtuple("SubwindowDeltas", ["delwave", "deldy", "pxrg", "pyrg", "msax", "msay"])
+
+# MSA shutter configuration: columns of the SHUTTER_INFO table, and per slitlet id the table rows of its shutters
+# and the row of the shutter with the source (None if all the shutters of the slitlet are background)
+MSAShutterConf = namedtuple("MSAShutterConf", ["file_name", "slitlet_id", "quadrant", "row", "column", "background",
+                                               "slitlet_shutters", "slitlet_source"])
+
+
 def find_nearest(arr, value):
     '''
     This function gives the content and the index in the array of the number that is closest to
@@ -54,15 +71,111 @@ def do_idl_match(arrA, arrB):
         subA: numpy array of index of arrA from elements also present in arrB
         subB: numpy array of index of arrB from elements also present in arrA
     """
-    # Find the index corresponding to the intersection elements and return them as arrays
-    subA, subB = [], []
-    for i, ai in enumerate(arrA):
-        if ai in arrB:
-            subA.append(i)
-    for i, bi in enumerate(arrB):
-        if bi in arrA:
-            subB.append(i)
-    return np.array(subA), np.array(subB)
+    # Find the index corresponding to the intersection elements and return them as arrays (np.isin sorts both
+    # arrays, so this scales as O((N+M) log(N+M)) instead of O(N*M))
+    arrA, arrB = np.asarray(arrA), np.asarray(arrB)
+    subA = np.nonzero(np.isin(arrA, arrB))[0]
+    subB = np.nonzero(np.isin(arrB, arrA))[0]
+    return subA, subB
+
+
+def get_overlap_slices(p0, npix, e0, nepix):
+    """
+    This function finds the pixels that the pipeline and the ESA subwindows have in common along one axis, i.e. it
+    does the same as do_idl_match(np.arange(npix)+p0, np.arange(nepix)+e0), but it returns slices.
+    Args:
+        p0: integer, pipeline subwindow origin
+        npix: integer, number of pixels of the pipeline subwindow
+        e0: float, ESA subwindow origin
+        nepix: integer, number of pixels of the ESA subwindow
+
+    Returns:
+        psl: slice, common pixels in the pipeline subwindow
+        esl: slice, common pixels in the ESA subwindow
+    """
+    shift = e0 - p0
+    if shift != int(shift):
+        return slice(0, 0), slice(0, 0)
+    shift = int(shift)
+    lo = max(0, shift)
+    hi = max(lo, min(npix, shift + nepix))
+    return slice(lo, hi), slice(lo - shift, hi - shift)
+
+
+def compare_subwindows_batch(pipe_list, esa_list, esa_zeros=False, dy_mask=False):
+    """
+    This function compares the pipeline and ESA WCS of the pixels that each pair of subwindows have in common,
+    for all the pairs (e.g. all the slices of an IFU exposure) in a single pass. Pixels where the pipeline
+    wavelength is 0 or where either wavelength is NaN are skipped.
+    Args:
+        pipe_list: list, (px0, py0, pwave, pdy) of each pipeline subwindow, where px0 and py0 are the origin and
+                   pwave and pdy the 2D arrays of wavelength (in m) and relative slit position
+        esa_list: list, (ex0, ey0, ewave, edy, emsax, emsay) of each ESA subwindow, where emsax and emsay can be None
+        esa_zeros: boolean, if True also skip pixels where the ESA wavelength is 0
+        dy_mask: boolean, if True the relative slit position deltas use their own good pixels (where neither
+                 relative slit position is 0 or NaN) instead of those of the wavelength
+
+    Returns:
+        deltas_list: list, SubwindowDeltas of each pair of subwindows
+    """
+    # gather the overlapping pixels of all the pairs
+    pw, ew, pd, ed, mx, my, pxr, pyr, counts = [], [], [], [], [], [], [], [], []
+    for (px0, py0, pwave, pdy), (ex0, ey0, ewave, edy, emsax, emsay) in zip(pipe_list, esa_list):
+        npy, npx = np.shape(pwave)
+        ney, nex = np.shape(ewave)
+        psx, esx = get_overlap_slices(px0, npx, ex0, nex)
+        psy, esy = get_overlap_slices(py0, npy, ey0, ney)
+        pw.append(pwave[psy, psx].ravel())
+        ew.append(ewave[esy, esx].ravel())
+        pd.append(pdy[psy, psx].ravel())
+        ed.append(edy[esy, esx].ravel())
+        if emsax is None:
+            emsax, emsay = np.zeros(np.shape(ewave)) + np.nan, np.zeros(np.shape(ewave)) + np.nan
+        mx.append(emsax[esy, esx].ravel())
+        my.append(emsay[esy, esx].ravel())
+        x, y = np.meshgrid((np.arange(npx)+px0).astype(int)[psx], (np.arange(npy)+py0).astype(int)[psy])
+        pxr.append(x.ravel())
+        pyr.append(y.ravel())
+        counts.append(np.size(pw[-1]))
+    if len(counts) == 0:
+        return []
+    pw, ew, pd, ed = np.concatenate(pw), np.concatenate(ew), np.concatenate(pd), np.concatenate(ed)
+    mx, my, pxr, pyr = np.concatenate(mx), np.concatenate(my), np.concatenate(pxr), np.concatenate(pyr)
+
+    # good pixels and deltas of all the pairs at once
+    ig = (pw != 0) & np.isfinite(pw) & np.isfinite(ew)
+    if esa_zeros:
+        ig &= (ew != 0)
+    igy = ig
+    if dy_mask:
+        igy = (pd != 0) & (ed != 0) & np.isfinite(pd) & np.isfinite(ed)
+    delwave, deldy = pw - ew, pd - ed
+
+    # split the results into the pairs of subwindows
+    deltas_list = []
+    bounds = np.cumsum([0] + counts)
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        g, gy = ig[lo:hi], igy[lo:hi]
+        deltas = SubwindowDeltas(delwave=delwave[lo:hi][g], deldy=deldy[lo:hi][gy], pxrg=pxr[lo:hi][g],
+                                 pyrg=pyr[lo:hi][g], msax=mx[lo:hi][g], msay=my[lo:hi][g])
+        deltas_list.append(deltas)
+    return deltas_list
+
+
+def compare_subwindows(pipe_subwindow, esa_subwindow, esa_zeros=False, dy_mask=False):
+    """
+    This function compares the pipeline and ESA WCS of the pixels that a pair of subwindows have in common. See
+    compare_subwindows_batch for the description of the arguments.
+    Args:
+        pipe_subwindow: list, (px0, py0, pwave, pdy) of the pipeline subwindow
+        esa_subwindow: list, (ex0, ey0, ewave, edy, emsax, emsay) of the ESA subwindow
+        esa_zeros: boolean, if True also skip pixels where the ESA wavelength is 0
+        dy_mask: boolean, if True the relative slit position deltas use their own good pixels
+
+    Returns:
+        deltas: SubwindowDeltas, namedtuple with the arrays delwave, deldy, pxrg, pyrg, msax, and msay
+    """
+    return compare_subwindows_batch([pipe_subwindow], [esa_subwindow], esa_zeros=esa_zeros, dy_mask=dy_mask)[0]
 
 
 def do_idl_rebin(a, *args):
@@ -108,6 +221,313 @@ def get_modeused_and_rawdatrt_PTT_cfg_file():
     return mode_used, raw_data_root_file
 
 
+# world coordinates of the subwindows of an extract_2d product: name of the world coordinates file, snapshot of its
+# headers, and the (read-only) data array of each extension, None for the primary
+WorldCoordinates = namedtuple("WorldCoordinates", ["file_name", "headers", "data"])
+
+# reference files used by assign_wcs for NIRSpec, as recorded in the primary header of the products
+world_coordinates_ref_keywds = ["R_CAMERA", "R_COLLIM", "R_DISPER", "R_DISTOR", "R_FILOFF", "R_FORE", "R_FPA",
+                                "R_IFUFOR", "R_IFUPOS", "R_IFUSLI", "R_MSA", "R_OTE", "R_REGION", "R_SPCWCS",
+                                "R_WAVRAN"]
+
+# keywords that change every time a product is written, and do not change its world coordinates
+world_coordinates_volatile_keywds = ["DATE", "FILENAME", "IRAF-TLM", "CHECKSUM", "DATASUM", "HISTORY", "COMMENT", ""]
+
+# directory, next to the products, where the world coordinates are saved by key (see get_world_coordinates_key)
+world_coordinates_cache_dir_name = "world_coordinates_cache"
+
+
+def get_world_coordinates_key(infile_name, ifu=False):
+    """
+    This function calculates the key of the world coordinates of a product, the SHA1 of everything they depend on:
+    the WCS reference files (R_* keywords of world_coordinates_ref_keywds) and the headers of the product, without
+    the volatile keywords, the status of the steps (S_*), and the other reference files, which are different in
+    each product of the same exposure. For MOS data the contents of the MSA metafile (MSAMETFL, looked for next to
+    the product and then in the working directory) enter the key too, since a metafile can be regenerated under the
+    same name. The pixel values do not enter the key, so a product written again by a pipeline run that only
+    changed a non-WCS step has the same key; the products of different steps (e.g. assign_wcs and extract_2d) have
+    different headers, and so different keys.
+    Args:
+        infile_name: str, name of the product (with full path)
+        ifu: boolean, True if the world coordinates are those of the IFU slices
+
+    Returns:
+        key: string, hexadecimal SHA1
+    """
+    hdrs = core_utils.read_header_snapshot(infile_name)
+    primary_hdr = hdrs.headers[0]
+    key_items = ["IFU=" + repr(bool(ifu))]
+    for keywd in world_coordinates_ref_keywds:
+        key_items.append(keywd + "=" + repr(primary_hdr.get(keywd, "N/A")))
+    for ext, hdr in sorted(hdrs.headers.items()):
+        if ext != 0 and hdr.get("EXTNAME") != "SCI":
+            continue
+        for keywd in sorted(hdr):
+            if keywd in world_coordinates_volatile_keywds or keywd.startswith("S_") or keywd.startswith("R_"):
+                continue
+            key_items.append(str(ext) + ":" + keywd + "=" + repr(hdr[keywd]))
+    msametfl = primary_hdr.get("MSAMETFL")
+    if msametfl not in (None, "", "N/A"):
+        for msa_dir in (os.path.dirname(os.path.abspath(infile_name)), os.getcwd()):
+            msa_file = os.path.join(msa_dir, os.path.basename(str(msametfl)))
+            if os.path.isfile(msa_file):
+                with open(msa_file, "rb") as mf:
+                    key_items.append("MSAMETFL_SHA1=" + hashlib.sha1(mf.read()).hexdigest())
+                break
+    key = hashlib.sha1("\n".join(key_items).encode()).hexdigest()
+    return key
+
+
+def load_world_coordinates(wc_file_name, hdulist):
+    """
+    This function copies the headers and data of a world coordinates HDUList into memory.
+    Args:
+        wc_file_name: string, world coordinates file name with full path (it must exist)
+        hdulist: astropy HDUList, contents of the file
+
+    Returns:
+        wc: WorldCoordinates namedtuple
+    """
+    data = []
+    for hdu in hdulist:
+        arr = None
+        if hdu.data is not None:
+            arr = np.array(hdu.data)
+            arr.flags.writeable = False
+        data.append(arr)
+    wc = WorldCoordinates(wc_file_name, core_utils.snapshot_hdulist(wc_file_name, hdulist), tuple(data))
+    return wc
+
+
+@functools.lru_cache(maxsize=4)
+def cached_world_coordinates(wc_file_name, mtime):
+    """
+    This function does the work of read_world_coordinates, the modification time is only part of the cache key.
+    Only the world coordinates of the last few files are kept in memory.
+    Args:
+        wc_file_name: string, world coordinates file name with full path
+        mtime: float, modification time of the world coordinates file
+
+    Returns:
+        wc: WorldCoordinates namedtuple
+    """
+    with fits.open(wc_file_name) as hdulist:
+        wc = load_world_coordinates(wc_file_name, hdulist)
+    return wc
+
+
+def read_world_coordinates(wc_file_name):
+    """
+    This function reads a world coordinates file (output of the pipeline compute_world_coordinates tool) into
+    memory, only the first time it is needed in this process and again if the file changes.
+    Args:
+        wc_file_name: string, world coordinates file name with full path
+
+    Returns:
+        wc: WorldCoordinates namedtuple
+    """
+    wc_file_name = os.path.abspath(wc_file_name)
+    wc = cached_world_coordinates(wc_file_name, os.path.getmtime(wc_file_name))
+    return wc
+
+
+def get_world_coordinates(infile_name, ifu=False):
+    """
+    This function gets the world coordinates of all the subwindows (or IFU slices) of a product. They are saved in
+    the world coordinates cache directory next to the product, under the key of the product (see
+    get_world_coordinates_key), so they are computed only once for each product, also across test runs, and again
+    when the product changes in a way that can change them, e.g. with a new WCS reference file.
+    Otherwise the pipeline compute_world_coordinates tool is run, and its output (written in the working
+    directory) is moved into the cache.
+    Args:
+        infile_name: str, name of the product (with full path)
+        ifu: boolean, if True the world coordinates of the IFU slices are computed (with ifu_coords)
+
+    Returns:
+        wc: WorldCoordinates namedtuple
+    """
+    key = get_world_coordinates_key(infile_name, ifu=ifu)
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(infile_name)), world_coordinates_cache_dir_name)
+    wc_file_name = os.path.join(cache_dir, "world_coordinates_"+key+".fits")
+    if os.path.isfile(wc_file_name):
+        print ("Using the world coordinates in cache: ", wc_file_name)
+        return read_world_coordinates(wc_file_name)
+
+    print ("running compute_world_coordinates.py script...")
+    from jwst.assign_wcs.tools.nirspec import compute_world_coordinates
+    if ifu:
+        compute_world_coordinates.ifu_coords(infile_name)
+    else:
+        compute_world_coordinates.compute_world_coordinates(infile_name)
+
+    # the world coordinate file was created in the working directory and named after the id of the input file
+    fileID = os.path.basename(infile_name).split("_")[0]
+    wcoordfile = os.path.join(os.getcwd(), fileID+"_world_coordinates.fits")
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # move to a temporary file first (it is a copy if the working directory is in another file system), so that
+    # other processes never see an incomplete cache file
+    tmp_file = wc_file_name.replace(".fits", "_"+str(os.getpid())+".tmp")
+    shutil.move(wcoordfile, tmp_file)
+    os.replace(tmp_file, wc_file_name)
+    print ("Saved world coordinates in cache: ", wc_file_name)
+    return read_world_coordinates(wc_file_name)
+
+
+# name of the index of the ESA trace files saved at the top of the ESA files path, and its layout version
+esa_index_name = "esa_files_index.json"
+esa_index_version = 1
+
+# ESA indexes already read in this process, by ESA files path
+esa_indexes = {}
+
+
+def get_file_fingerprint(file_name):
+    """
+    This function gets the size and modification time of a file, which change when the file is replaced.
+    Args:
+        file_name: string, file name with full path
+
+    Returns:
+        fingerprint: list, size in bytes and modification time
+    """
+    file_stat = os.stat(file_name)
+    fingerprint = [file_stat.st_size, file_stat.st_mtime]
+    return fingerprint
+
+
+def scan_esa_trace_dir(mode_dir, old_files=None):
+    """
+    This function reads the FILENAME keyword (raw file the ESA products were made from) of all the trace files in
+    an ESA trace directory. Files with the same fingerprint as in old_files are not opened again.
+    Args:
+        mode_dir: string, path of the trace directory (e.g. .../V96214001001P0000000002105_trace_MOS)
+        old_files: dictionary, previous index of the directory
+
+    Returns:
+        files: dictionary, per trace file name its fingerprint and FILENAME keyword (None if it has none)
+    """
+    if old_files is None:
+        old_files = {}
+    files = {}
+    for esafile in sorted(glob(os.path.join(mode_dir, "Trace_*.fits"))):
+        esabase = os.path.basename(esafile)
+        fingerprint = get_file_fingerprint(esafile)
+        if esabase in old_files and old_files[esabase]["fingerprint"] == fingerprint:
+            files[esabase] = old_files[esabase]
+        else:
+            files[esabase] = {"fingerprint": fingerprint, "filename": fits.getheader(esafile, 0).get("FILENAME")}
+    return files
+
+
+def refresh_esa_dir(dir_index, jlab88_dir):
+    """
+    This function updates the index of one ESA products directory, scanning again only the trace directories
+    whose modification time changed.
+    Args:
+        dir_index: dictionary, index of the directory
+        jlab88_dir: string, path of the directory (e.g. .../V96214001001P0000000002105)
+
+    Returns:
+        changed: boolean, True if the index was updated
+    """
+    changed = False
+    dir_mtime = os.path.getmtime(jlab88_dir)
+    if dir_index["mtime"] != dir_mtime:
+        # trace directories may have been added or removed
+        mode_dirs = [os.path.basename(d) for d in glob(os.path.join(jlab88_dir, "*_trace_*")) if os.path.isdir(d)]
+        dir_index["modes"] = {mode_dir: dir_index["modes"].get(mode_dir, {"mtime": None, "files": {}})
+                              for mode_dir in mode_dirs}
+        dir_index["mtime"] = dir_mtime
+        changed = True
+    for mode_dir, mode_index in dir_index["modes"].items():
+        mode_mtime = os.path.getmtime(os.path.join(jlab88_dir, mode_dir))
+        if mode_index["mtime"] != mode_mtime:
+            mode_index["files"] = scan_esa_trace_dir(os.path.join(jlab88_dir, mode_dir), mode_index["files"])
+            mode_index["mtime"] = mode_mtime
+            changed = True
+    return changed
+
+
+def read_esa_index(esa_files_path, esaroot):
+    """
+    This function gets the index of the ESA trace files: per ESA products directory (named after the raw data
+    root), trace directory (one per mode), and trace file (named after the MOS shutter, FS slit, or IFU slice),
+    the fingerprint and FILENAME keyword of the file. The index is built the first time, saved in esa_files_path
+    (if it can be written), and only the directories that changed since then, among the ones that match esaroot,
+    are scanned again.
+    Args:
+        esa_files_path: str, top level of where the regression test data lives
+        esaroot: str, root name of the raw data file
+
+    Returns:
+        esa_index: dictionary
+    """
+    esa_files_path = os.path.abspath(esa_files_path)
+    index_file = os.path.join(esa_files_path, esa_index_name)
+    esa_index = esa_indexes.get(esa_files_path)
+    if esa_index is None and os.path.isfile(index_file):
+        with open(index_file, "r") as f:
+            esa_index = json.load(f)
+        if esa_index.get("version") != esa_index_version:
+            esa_index = None
+    changed = False
+    if esa_index is None:
+        print ("Building the index of the ESA files in ", esa_files_path)
+        esa_index = {"version": esa_index_version, "mtime": None, "dirs": {}}
+        changed = True
+
+    # ESA products directories may have been added or removed
+    top_mtime = os.path.getmtime(esa_files_path)
+    if esa_index["mtime"] != top_mtime:
+        jlab88_dirs = [d for d in os.listdir(esa_files_path) if os.path.isdir(os.path.join(esa_files_path, d))]
+        esa_index["dirs"] = {jlab88_dir: esa_index["dirs"].get(jlab88_dir, {"mtime": None, "modes": {}})
+                             for jlab88_dir in jlab88_dirs}
+        esa_index["mtime"] = top_mtime
+        changed = True
+    for jlab88_dir, dir_index in esa_index["dirs"].items():
+        if esaroot in os.path.join(esa_files_path, jlab88_dir):
+            if refresh_esa_dir(dir_index, os.path.join(esa_files_path, jlab88_dir)):
+                changed = True
+    esa_indexes[esa_files_path] = esa_index
+
+    if changed:
+        # write to a temporary file first, so that other processes never see an incomplete index
+        tmp_file = index_file.replace(".json", "_"+str(os.getpid())+".tmp")
+        try:
+            with open(tmp_file, "w") as f:
+                json.dump(esa_index, f)
+            os.replace(tmp_file, index_file)
+        except OSError:
+            print ("Unable to save the index of the ESA files in ", esa_files_path, ", using it only in memory.")
+    return esa_index
+
+
+def get_esa_root_filename(esa_index, esafile):
+    """
+    This function gets the FILENAME keyword of an ESA trace file from the index, reading it from the file only if
+    the file is not in the index or changed since it was indexed.
+    Args:
+        esa_index: dictionary, from read_esa_index
+        esafile: str, full path of the ESA trace file
+
+    Returns:
+        root_filename: str, value of the FILENAME keyword
+    """
+    mode_dir, esabase = os.path.split(esafile)
+    jlab88_dir, mode_dir = os.path.split(mode_dir)
+    dir_index = esa_index["dirs"].get(os.path.basename(jlab88_dir), {"modes": {}})
+    files = dir_index["modes"].get(mode_dir, {"files": {}})["files"]
+    if (esabase in files) and (files[esabase]["filename"] is not None) and os.path.isfile(esafile):
+        fingerprint = get_file_fingerprint(esafile)
+        if files[esabase]["fingerprint"] != fingerprint:
+            # the file was replaced without changing its directory, update its entry
+            files[esabase] = {"fingerprint": fingerprint, "filename": fits.getheader(esafile, 0).get("FILENAME")}
+        if files[esabase]["filename"] is not None:
+            return files[esabase]["filename"]
+    return fits.getval(esafile, "FILENAME", 0)
+
+
 def get_esafile(esa_files_path, rawdatroot, mode, specifics):
     """
     This function gets the ESA file corresponding to the input given.
@@ -177,12 +597,13 @@ def get_esafile(esa_files_path, rawdatroot, mode, specifics):
     esaroot = rawdatroot.split("_")[0].replace("NRS", "")
 
     # go into the esa_files_path directory and enter the the mode to get the right esafile
-    # get all subdirectories within esa_files_path
-    subdir_list = glob(esa_files_path+"/*")
+    # get the subdirectories within esa_files_path, and the FILENAME keyword of their trace files, from the index
+    # of the ESA files (so the directories are not listed and the files not opened for every slitlet or slice)
+    esa_index = read_esa_index(esa_files_path, esaroot)
     jlab88_list = []
     esafile = "ESA file not found"
-    for subdir in subdir_list:
-        #subdir = subdir.split("/")[-1]
+    for subdir in sorted(esa_index["dirs"]):
+        subdir = os.path.join(esa_files_path, subdir)
         if esaroot in subdir:
             jlab88_list.append(subdir)
     #print("jlab88_list=", jlab88_list)
@@ -195,7 +616,7 @@ def get_esafile(esa_files_path, rawdatroot, mode, specifics):
         if not isinstance(esafile_basename, list):
             esafile = os.path.join(mode_dir, esafile_basename)
             # check if we got the right esafile
-            root_filename = fits.getval(esafile, "FILENAME", 0)
+            root_filename = get_esa_root_filename(esa_index, esafile)
             print("root_filename = ", root_filename)
             print("rawdatroot = ", rawdatroot)
             if rawdatroot.replace(".fits", "") in root_filename:
@@ -209,7 +630,7 @@ def get_esafile(esa_files_path, rawdatroot, mode, specifics):
                 esaf = os.path.join(mode_dir, esabase)
                 esafile.append(esaf)
                 # check if we got the right esafile
-                root_filename = fits.getval(esaf, "FILENAME", 0)
+                root_filename = get_esa_root_filename(esa_index, esaf)
                 print("root_filename = ", root_filename)
                 print("rawdatroot = ", rawdatroot)
                 if rawdatroot.replace(".fits", "") in root_filename:
@@ -221,6 +642,422 @@ def get_esafile(esa_files_path, rawdatroot, mode, specifics):
 
 
 
+def reverse_cols(arr):
+    """
+    This function permutates the last column of the array with the first, e.g. a = [4,5,6]
+    b = reverse_cols(a) = [6,5,4].
+    Args:
+        arr: numpy array
+
+    Returns:
+        rev_arr: numpy array with first and last columns reversed
+    """
+    last_idx = np.shape(arr)[-1]-1
+    permutation = [last_idx]
+    for i, a in enumerate(arr):
+        if (i != 0) and (i != last_idx):
+            permutation.append(i)
+        if i == last_idx:
+            permutation.append(0)
+    p = np.argsort(permutation)
+    rev_arr = arr[:, p]
+    return rev_arr
+
+
+def orient_reference_image(arr, det, axes=None, nrs2_op="reverse_cols"):
+    """
+    This function flips/rotates a reference file image or cube into science orientation.
+    Args:
+        arr: numpy array, image or cube as read from the reference file
+        det: string, detector (NRS1 or NRS2)
+        axes: tuple, axes permutation for np.transpose (None reverses all the axes)
+        nrs2_op: string, operation done before flipping the rows for NRS2, either reverse_cols or transpose
+
+    Returns:
+        arr: numpy array in science orientation
+    """
+    arr = np.transpose(arr, axes)   # keep in mind that 0,1,2 = z,y,x in Python, whereas =x,y,z in IDL
+    if det == "NRS2":
+        if nrs2_op == "transpose":
+            arr = np.transpose(arr)
+        else:
+            arr = reverse_cols(arr)
+        arr = arr[::-1]
+    return arr
+
+
+def read_reference_flat(ref_file, ext, det, axes=None, nrs2_op="reverse_cols", cache_dir=None):
+    """
+    This function reads an image or cube of a flat reference file in science orientation (see
+    orient_reference_image). If a cache directory is given, the oriented array is saved there as a .npy file
+    keyed by the reference file path and modification time, the extension, the detector, and the orientation, so
+    the next time it is only memory-mapped instead of read, rotated, and copied again.
+    Args:
+        ref_file: string, reference file name (with full path)
+        ext: integer, extension to read
+        det: string, detector (NRS1 or NRS2)
+        axes: tuple, axes permutation for np.transpose (None reverses all the axes)
+        nrs2_op: string, operation done before flipping the rows for NRS2, either reverse_cols or transpose
+        cache_dir: string, path of the cache directory (None or empty string to not use the cache)
+
+    Returns:
+        arr: numpy array in science orientation (a read-only memory map if it comes from the cache)
+    """
+    if not cache_dir:
+        return orient_reference_image(fits.getdata(ref_file, ext), det, axes=axes, nrs2_op=nrs2_op)
+    key = "|".join((os.path.abspath(ref_file), repr(os.path.getmtime(ref_file)), str(ext), det, repr(axes),
+                    nrs2_op))
+    cache_file = os.path.join(cache_dir, "reference_flat_"+hashlib.sha1(key.encode()).hexdigest()+".npy")
+    if not os.path.isfile(cache_file):
+        arr = orient_reference_image(fits.getdata(ref_file, ext), det, axes=axes, nrs2_op=nrs2_op)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # write to a temporary file first, so that other processes never see an incomplete cache file
+        tmp_file = cache_file.replace(".npy", "_"+str(os.getpid())+".tmp")
+        with open(tmp_file, "wb") as f:
+            np.save(f, np.ascontiguousarray(arr))
+        os.replace(tmp_file, cache_file)
+        print ("Saved oriented reference flat in cache: ", cache_file)
+    return np.load(cache_file, mmap_mode="r")
+
+
+@functools.lru_cache(maxsize=32)
+def cached_flat_wavelengths(ref_file, mtime, keyword_format, first, ext, skip_missing):
+    """
+    This function does the work of get_flat_wavelengths, the modification time is only part of the cache key.
+    Args:
+        ref_file: string, absolute path of the reference file
+        mtime: float, modification time of the reference file
+        keyword_format: string, see get_flat_wavelengths
+        first: integer, see get_flat_wavelengths
+        ext: integer, see get_flat_wavelengths
+        skip_missing: boolean, see get_flat_wavelengths
+
+    Returns:
+        wave: read-only numpy array of the wavelengths
+    """
+    hdr = core_utils.read_header_snapshot(ref_file, extensions=[ext]).headers[ext]
+    naxis3 = hdr["NAXIS3"]
+    wave = np.empty(naxis3)
+    nw = 0
+    for i in range(first, first+naxis3):
+        keyword = keyword_format % i
+        if keyword in hdr:
+            wave[nw] = hdr[keyword]
+            nw += 1
+        elif not skip_missing:
+            raise KeyError("Keyword {} not found in extension {} of {}".format(keyword, ext, ref_file))
+    wave = wave[:nw]
+    wave.setflags(write=False)
+    return wave
+
+
+def get_flat_wavelengths(ref_file, keyword_format, first=1, ext=1, skip_missing=False):
+    """
+    This function reads the wavelength of each plane of a flat reference cube from the header keywords of the
+    cube extension (e.g. PFLAT_1, PFLAT_2, ... or FLAT_01, FLAT_02, ...). The header is read once, and the
+    result is cached per file, so asking again for the same file costs nothing.
+    Args:
+        ref_file: string, reference file name (with full path)
+        keyword_format: string, format of the keyword name with the plane number, e.g. "PFLAT_%d" or "FLAT_%02d"
+        first: integer, number of the keyword for the first plane of the cube
+        ext: integer, extension of the cube
+        skip_missing: boolean, if True planes without keyword are skipped, otherwise a KeyError is raised
+
+    Returns:
+        wave: read-only numpy array of the wavelengths
+    """
+    ref_file = os.path.abspath(ref_file)
+    wave = cached_flat_wavelengths(ref_file, os.path.getmtime(ref_file), keyword_format, first, ext, skip_missing)
+    return wave
+
+
+@functools.lru_cache(maxsize=8)
+def cached_msa_shutter_conf(msa_conf_name, mtime):
+    """
+    This function does the work of read_msa_shutter_conf, the modification time is only part of the cache key.
+    Args:
+        msa_conf_name: string, absolute path of the MSA configuration file
+        mtime: float, modification time of the MSA configuration file
+
+    Returns:
+        msa_conf: MSAShutterConf
+    """
+    shutter_info = fits.getdata(msa_conf_name, "SHUTTER_INFO")
+    slitlet_id = np.array(shutter_info.field("SLITLET_ID"), dtype=int)
+    quadrant = np.array(shutter_info.field("SHUTTER_QUADRANT"))
+    row = np.array(shutter_info.field("SHUTTER_ROW"))
+    column = np.array(shutter_info.field("SHUTTER_COLUMN"))
+    background = np.char.strip(np.array(shutter_info.field("BACKGROUND"), dtype=str))
+    # group the table rows by slitlet, keeping the order of the table within each slitlet
+    order = np.argsort(slitlet_id, kind="stable")
+    ids, starts = np.unique(slitlet_id[order], return_index=True)
+    slitlet_shutters, slitlet_source = {}, {}
+    for sid, shutters in zip(ids, np.split(order, starts[1:])):
+        shutters = tuple(int(j) for j in shutters)
+        slitlet_shutters[int(sid)] = shutters
+        source = [j for j in shutters if background[j] == "N"]
+        slitlet_source[int(sid)] = source[-1] if source else None
+    for arr in (slitlet_id, quadrant, row, column, background):
+        arr.setflags(write=False)
+    msa_conf = MSAShutterConf(msa_conf_name, slitlet_id, quadrant, row, column, background, slitlet_shutters,
+                              slitlet_source)
+    return msa_conf
+
+
+def read_msa_shutter_conf(msa_conf_name):
+    """
+    This function reads the SHUTTER_INFO table of the MSA configuration file and indexes it by slitlet id, so
+    that the shutters of a slitlet are found with a dictionary lookup instead of scanning the whole table. The
+    result is cached per file, so the table is read only once even if several scripts use it.
+    Args:
+        msa_conf_name: string, MSA configuration file name (with full path)
+
+    Returns:
+        msa_conf: MSAShutterConf, namedtuple with the (read-only) table columns, and the dictionaries
+                  slitlet_shutters (slitlet id to tuple of table rows) and slitlet_source (slitlet id to the
+                  table row of the source shutter)
+    """
+    msa_conf_name = os.path.abspath(msa_conf_name)
+    msa_conf = cached_msa_shutter_conf(msa_conf_name, os.path.getmtime(msa_conf_name))
+    return msa_conf
+
+
+# data shared with the worker processes of run_in_pool, set by init_pool_worker
+pool_shared_data = {}
+
+
+def init_pool_worker(shared_data):
+    """
+    This function stores the data shared by all the tasks of run_in_pool in each worker process. With the fork
+    start method (the default in Linux) the arrays are inherited from the parent process without being copied.
+    Args:
+        shared_data: dictionary, keyword arguments of the function run in the pool
+
+    Returns:
+        nothing
+    """
+    pool_shared_data.clear()
+    pool_shared_data.update(shared_data)
+
+
+def call_pool_worker(task):
+    """
+    This function runs one task of run_in_pool in a worker process.
+    Args:
+        task: tuple, function and item to run it with
+
+    Returns:
+        the output of the function
+    """
+    func, item = task
+    return func(item, **pool_shared_data)
+
+
+def run_in_pool(func, items, shared_data, n_workers=1):
+    """
+    This generator runs func(item, **shared_data) for each item, either serially or distributing the items over a
+    pool of worker processes. The shared data is sent once to each worker instead of with every item. In both
+    cases the results are yielded in the order of the items, so what is done with them does not depend on the
+    number of workers.
+    Args:
+        func: function defined at module level (so that it can be sent to the workers)
+        items: list, first argument of func for each task
+        shared_data: dictionary, keyword arguments of func that are the same for all the tasks
+        n_workers: integer, number of worker processes, if 1 (or None) the tasks run in this process
+
+    Returns:
+        the output of func for each item, in the same order as items
+    """
+    if n_workers is None or int(n_workers) <= 1:
+        for item in items:
+            yield func(item, **shared_data)
+    else:
+        n_workers = min(int(n_workers), max(len(items), 1))
+        print ("Running ", len(items), " tasks in ", n_workers, " worker processes")
+        with multiprocessing.Pool(n_workers, initializer=init_pool_worker, initargs=(shared_data,)) as pool:
+            for result in pool.imap(call_pool_worker, [(func, item) for item in items]):
+                yield result
+
+
+def split_in_groups(items, n_groups):
+    """
+    This function splits a list into n_groups contiguous groups of (almost) the same size, so that the groups
+    can be processed in parallel and the results put back together in the original order.
+    Args:
+        items: list
+        n_groups: integer, number of groups (there are no empty groups if there are fewer items)
+
+    Returns:
+        groups: list of lists
+    """
+    n_groups = max(min(int(n_groups), len(items)), 1)
+    bounds = np.linspace(0, len(items), n_groups+1).astype(int)
+    groups = [items[bounds[g]:bounds[g+1]] for g in range(n_groups)]
+    return groups
+
+
+def plot_sigma_bands(ax, xarr, yarr, deltas, limits, markersize=6, max_vector_points=5000):
+    """
+    This function plots the points (xarr, yarr) colour coded by the band of limits in which their delta falls, with
+    one scatter call per band instead of one plot call per point. Points exactly on a limit are not plotted, and if
+    the arrays have different lengths only the first points of the longer ones are used. Sets with more than
+    max_vector_points points are rasterized, so that saving them as pdf does not store one path per point.
+    Args:
+        ax: matplotlib axes where to plot
+        xarr: array, x positions of the points
+        yarr: array, y positions of the points
+        deltas: array, values to colour code
+        limits: list of 4 floats in increasing order, limits of the bands
+        markersize: float, size of the diamond markers in points
+        max_vector_points: integer, maximum number of points drawn as vectors
+
+    Returns:
+        nothing
+    """
+    xarr, yarr, deltas = np.ravel(xarr), np.ravel(yarr), np.ravel(deltas)
+    npts = min(len(xarr), len(yarr), len(deltas))
+    xarr, yarr, deltas = xarr[:npts], yarr[:npts], deltas[:npts]
+    lim_a, lim_b, lim_c, lim_d = limits
+    band_masks = [(deltas > lim_d, 'red'),
+                  (deltas < lim_a, 'fuchsia'),
+                  ((deltas > lim_a) & (deltas < lim_b), 'blue'),
+                  ((deltas > lim_b) & (deltas < lim_c), 'lime'),
+                  ((deltas > lim_c) & (deltas < lim_d), 'black')]
+    rasterized = npts > max_vector_points
+    for band_mask, color in band_masks:
+        if band_mask.any():
+            ax.scatter(xarr[band_mask], yarr[band_mask], s=markersize**2, marker='D', color=color,
+                       rasterized=rasterized)
+
+
+# pool of worker processes rendering the figures in the background, and the pending results of the figures sent
+PlotQueue = namedtuple("PlotQueue", ["pool", "jobs"])
+
+
+def init_plot_worker():
+    """
+    This function sets the non-interactive Agg backend in each worker process of the plot queue, so that the
+    figures are only drawn into the files they are saved to.
+    Returns:
+        nothing
+    """
+    import matplotlib.pyplot as plt
+    plt.switch_backend("Agg")
+
+
+def start_plot_queue(show_figs, save_figs, n_workers=1):
+    """
+    This function starts the pool of worker processes that render and save the figures while the validation
+    continues. The figures can only be rendered in the background when they are saved and not shown, otherwise
+    they are made inline by make_plot.
+    Args:
+        show_figs: boolean, show figures on screen or not
+        save_figs: boolean, save figures or not
+        n_workers: integer, number of worker processes rendering the figures
+
+    Returns:
+        plot_queue: PlotQueue namedtuple, or None if the figures are made inline
+    """
+    if show_figs or not save_figs:
+        return None
+    n_workers = max(int(n_workers or 1), 1)
+    pool = multiprocessing.Pool(n_workers, initializer=init_plot_worker)
+    plot_queue = PlotQueue(pool, [])
+    return plot_queue
+
+
+def make_plot(plot_queue, plot_func, **plot_kwargs):
+    """
+    This function makes a figure with plot_func(**plot_kwargs), either right away or, if there is a plot queue,
+    sending the statistics and arrays of the figure to be rendered by one of its worker processes.
+    Args:
+        plot_queue: PlotQueue namedtuple from start_plot_queue, or None
+        plot_func: function defined at module level (so that it can be sent to the workers)
+        plot_kwargs: keyword arguments of plot_func
+
+    Returns:
+        nothing
+    """
+    if plot_queue is None:
+        plot_func(**plot_kwargs)
+    else:
+        plot_queue.jobs.append(plot_queue.pool.apply_async(plot_func, kwds=plot_kwargs))
+
+
+def finish_plot_queue(plot_queue):
+    """
+    This function waits until all the figures sent to the plot queue are saved, and stops its worker processes.
+    Errors raised while rendering a figure are raised here.
+    Args:
+        plot_queue: PlotQueue namedtuple from start_plot_queue, or None
+
+    Returns:
+        nothing
+    """
+    if plot_queue is None:
+        return
+    plot_queue.pool.close()
+    try:
+        for job in plot_queue.jobs:
+            job.get()
+    finally:
+        plot_queue.pool.terminate()
+        plot_queue.pool.join()
+
+
+@functools.lru_cache(maxsize=None)
+def uniform_newton_cotes_weights(n):
+    """
+    This function gives the Newton-Cotes weights for n+1 equally spaced points. The result is cached.
+    Args:
+        n: integer, number of intervals
+
+    Returns:
+        weights: numpy array (read only), weights of the n+1 points
+    """
+    weights = integrate.newton_cotes(n, 1)[0]
+    weights.flags.writeable = False
+    return weights
+
+
+@functools.lru_cache(maxsize=4096)
+def quantized_newton_cotes_weights(key, quantum):
+    """
+    This function gives the Newton-Cotes weights for the normalized abscissae key*quantum. The results are kept
+    in a bounded LRU cache, so the weights of the same abscissa pattern are only calculated once.
+    Args:
+        key: tuple of integers, normalized abscissae in units of quantum
+        quantum: float, quantization step of the normalized abscissae
+
+    Returns:
+        weights: numpy array (read only), weights of each point
+    """
+    weights = integrate.newton_cotes(np.array(key) * quantum)[0]
+    weights.flags.writeable = False
+    return weights
+
+
+def newton_cotes_weights(rn, quantum=1.0e-12):
+    """
+    This function is a memoizing proxy to integrate.newton_cotes(rn)[0]. Uniformly spaced abscissae (the usual
+    case) use the tabulated weights, and other patterns are quantized to be looked up in a cache.
+    Args:
+        rn: array, normalized abscissae, i.e. going from 0 to len(rn)-1
+        quantum: float, quantization step of the normalized abscissae
+
+    Returns:
+        weights: numpy array (read only), weights of each point
+    """
+    n = len(rn) - 1
+    if not np.all(np.isfinite(rn)):
+        return integrate.newton_cotes(rn)[0]
+    if np.all(np.abs(rn - np.arange(n+1)) < quantum):
+        return uniform_newton_cotes_weights(n)
+    key = tuple(np.rint(np.asarray(rn) / quantum).astype(np.int64))
+    return quantized_newton_cotes_weights(key, quantum)
+
+
 def idl_tabulate(x, f, p=5):
     """
     This is a Python proxy to the IDL int_tabulate function taken from:
@@ -238,7 +1075,7 @@ def idl_tabulate(x, f, p=5):
         if x.shape[0] < 2 :
             return 0
         rn = (x.shape[0] - 1) * (x - x[0]) / (x[-1] - x[0])
-        weights = integrate.newton_cotes(rn)[0]
+        weights = newton_cotes_weights(rn)
         """
         # I added this part for the last remaining non 5 points, it will only use the available points
         lw, lf = len(weights), len(f)
@@ -257,36 +1094,203 @@ def idl_tabulate(x, f, p=5):
     return ret
 
 
-def idl_valuelocate(arr, vals):
+def newton_cotes_chunks(xs, fs):
     """
-    This function is equivalent to value_locate() in IDL.
+    This function integrates a stack of chunks with the Newton-Cotes formula, i.e. it does what the newton_cotes
+    function inside idl_tabulate does, but for all the rows of xs and fs at once.
+    Args:
+        xs: 2D array, each row is the abscissa of one chunk (all chunks have the same number of points)
+        fs: 2D array, function values corresponding to xs
+
+    Returns:
+        ret: 1D array, integrated value of each chunk
+    """
+    nchunks, npts = np.shape(xs)
+    if npts < 2:
+        return np.zeros(nchunks)
+    n = npts - 1
+    span = xs[:, -1] - xs[:, 0]
+    rn = n * (xs - xs[:, :1]) / span[:, None]
+    # uniformly spaced chunks use the tabulated weights
+    weights = np.empty(np.shape(xs))
+    uniform = np.all(np.abs(rn - np.arange(npts)) < 1.0e-12, axis=1)
+    weights[uniform] = uniform_newton_cotes_weights(n)
+    # same weights as integrate.newton_cotes(rn) for the rest, obtained by solving the Vandermonde system of each chunk
+    if not np.all(uniform):
+        ti = 2.0 * rn[~uniform] / n - 1.0
+        nvec = np.arange(npts)
+        vander = ti[:, None, :] ** nvec[None, :, None]
+        moments = np.where(nvec % 2 == 0, 2.0 / (nvec + 1), 0.0)
+        moments = np.broadcast_to(moments, (len(ti), npts))[..., None]
+        weights[~uniform] = np.linalg.solve(vander, moments)[..., 0] * (n / 2.0)
+    return span / n * np.sum(weights * fs, axis=1)
+
+
+def idl_tabulate_windows(x, f, lo, hi, p=5):
+    """
+    This is the batched version of idl_tabulate. It integrates f over many windows of the same reference vector
+    at once, where window k covers the elements x[lo[k]:hi[k]]. On a uniform grid the result of each window is the
+    same as that of idl_tabulate(x[lo[k]:hi[k]], f[lo[k]:hi[k]], p), to within rounding errors (~1e-15 relative).
+    On a non-uniform grid the weights of the chunks are obtained by solving their Vandermonde systems, instead of
+    with the quantized weights of idl_tabulate, and the results can differ by up to ~1e-8 relative when the
+    spacing is very irregular.
+
+    The integrals of all the chunks of p points of the reference vector are calculated only once, and accumulated
+    separately for each of the p-1 possible positions of the first chunk of a window. This way the integral of the
+    complete chunks of a window is the difference of two cumulative sums, and only the (at most p-1) points left at
+    the end of the window need to be integrated separately.
 
     Args:
-        arr: array where values will be located. ** This array MUST be in increasing order **
-        vals: array, values that will be located in arr
+        x: array, reference abscissa
+        f: array, reference function values
+        lo: array of integers, index of the first element of each window
+        hi: array of integers, index after the last element of each window
+        p: integer, integrator order
 
     Returns:
-        idx: list, indeces of where the values would be located if placed in arr
+        ret: array, integrated values of each window
+    """
+    x, f = np.asarray(x, dtype=float), np.asarray(f, dtype=float)
+    lo, hi = np.asarray(lo, dtype=int), np.asarray(hi, dtype=int)
+    step = p - 1
+    npts = np.maximum(hi - lo, 0)
+
+    # integrate all the complete chunks of the reference vector and accumulate them for each phase
+    nchunks = max(len(x) - step, 0)
+    chunk_int = np.zeros(len(x) + step)
+    if nchunks > 0:
+        idx = np.arange(nchunks)[:, None] + np.arange(p)
+        chunk_int[:nchunks] = newton_cotes_chunks(x[idx], f[idx])
+    bad_chunk = ~np.isfinite(chunk_int)
+    chunk_int[bad_chunk] = 0.0
+    cum_int, cum_bad = np.zeros(len(chunk_int) + step), np.zeros(len(chunk_int) + step, dtype=int)
+    for phase in range(step):
+        cum_int[phase+step::step] = np.cumsum(chunk_int[phase::step])
+        cum_bad[phase+step::step] = np.cumsum(bad_chunk[phase::step])
+
+    # complete chunks of each window
+    nfull = np.maximum(npts - 1, 0) // step
+    start = lo + nfull * step
+    ret = cum_int[start] - cum_int[lo]
+
+    # points left at the end of each window
+    nrest = npts - nfull * step
+    for n in range(2, p):
+        sel = np.where(nrest == n)[0]
+        if sel.size != 0:
+            idx = start[sel, None] + np.arange(n)
+            ret[sel] += newton_cotes_chunks(x[idx], f[idx])
+
+    # windows with NaN or infinite values are integrated chunk by chunk
+    for k in np.where(cum_bad[start] - cum_bad[lo] > 0)[0]:
+        ret[k] = idl_tabulate(x[lo[k]:hi[k]], f[lo[k]:hi[k]], p)
+    return ret
+
+
+def band_average(vec_wav, vec_dat, wav_min, wav_max):
+    """
+    This function averages a reference vector (e.g. the fast vector of a flat reference file) over many bands at
+    once, integrating with the same method as idl_tabulate. Each band is located with a binary search, so the cost
+    is O(N log M) for N bands and a vector of M points.
+    Args:
+        vec_wav: numpy array, wavelengths of the vector ** This array MUST be in increasing order **
+        vec_dat: numpy array, vector values
+        wav_min: numpy array, lower edge of each band
+        wav_max: numpy array, upper edge of each band
 
+    Returns:
+        avg: numpy array, band-averaged value for each band (NaN if the band has less than 2 points)
+        npts: numpy array, number of vector points within each band
     """
+    lo = np.searchsorted(vec_wav, wav_min, side="left")
+    hi = np.searchsorted(vec_wav, wav_max, side="right")
+    npts = np.maximum(hi - lo, 0)
+    int_tab = idl_tabulate_windows(vec_wav, vec_dat, lo, np.maximum(hi, lo))
+    first = vec_wav[np.clip(lo, 0, len(vec_wav)-1)]
+    last = vec_wav[np.clip(hi-1, 0, len(vec_wav)-1)]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        avg = np.where(npts > 1, int_tab / (last - first), np.nan)
+    return avg, npts
 
-    if isinstance(vals, float):
-        vals = [vals]
 
-    idx_list = []
-    for v in vals:
-        # Find the index and value of the closest element to vals
-        if (v > arr[0]) and (v < arr[-1]):
-            arr_val, i = find_nearest(arr, v)
-            """
-            if arr[i] > v:
-                i =-1
-            """
-            idx_list.append(i)
-        else:
-            idx_list.append(-1)
-    #print ("v, i, arr[i] : ", v, i, arr[i])
-    return idx_list
+def calc_pixel_bandwidth(flat_wave, nx, edge_factor=1.0):
+    """
+    This function calculates the bandwidth of every pixel of the flattened wavelength array of a subwindow, using
+    the neighbouring pixels in the same row (i.e. along the dispersion direction).
+    **this needs to be modified for prism, since the dispersion is not linear!**
+    Args:
+        flat_wave: 1D numpy array, flattened wavelength array of the subwindow
+        nx: integer, number of pixels in each row of the subwindow
+        edge_factor: float, factor of the difference with the only neighbour for the pixels at the edges of the
+                     rows or next to a NaN wavelength (1.0 for MOS, 0.5 for IFU, as in the IDL scripts)
+
+    Returns:
+        delw: 1D numpy array, bandwidth of each pixel
+    """
+    col = np.arange(np.size(flat_wave)) % nx
+    prev_wave, next_wave = np.roll(flat_wave, 1), np.roll(flat_wave, -1)
+    first_in_row = (col == 0) | ~np.isfinite(prev_wave)
+    last_in_row = (col == nx-1) | ~np.isfinite(next_wave)
+    delw = 0.5 * (next_wave - prev_wave)
+    delw = np.where(first_in_row, edge_factor * (next_wave - flat_wave), delw)
+    delw = np.where(last_in_row, edge_factor * (flat_wave - prev_wave), delw)
+    return delw
+
+
+def interp_cube(vals, xp, cube, yind, xind, dq=None):
+    """
+    This function does the same as np.interp(vals[k], xp, cube[:, yind[k], xind[k]]) for all the pixels k at once,
+    i.e. it interpolates the reference cube at the wavelength of each pixel between the two closest planes (the
+    value of the first or last plane is used outside of xp). It also tells which pixels fall between two planes
+    with good values, since the MOS and FS tests set the rest to 1.
+    Args:
+        vals: numpy array, wavelength of each pixel
+        xp: numpy array, wavelengths of the cube planes ** This array MUST be in increasing order **
+        cube: 3D numpy array, reference cube
+        yind: numpy array, y-index of each pixel in the cube
+        xind: numpy array, x-index of each pixel in the cube
+        dq: 3D numpy array or None, DQ cube; if given, the pixels flagged in either plane are not in range
+
+    Returns:
+        val: numpy array, interpolated values
+        in_range: numpy array of booleans, True where the wavelength is within xp and the values of the two
+                  planes are finite (and not flagged)
+    """
+    iloc = idl_valuelocate(xp, vals)
+    j = np.clip(iloc, 0, len(xp)-2)
+    x0, x1 = xp[j], xp[j+1]
+    z0, z1 = cube[j, yind, xind], cube[j+1, yind, xind]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = (z1 - z0) / (x1 - x0)
+        val = slope * (vals - x0) + z0
+        # same treatment of NaN values as np.interp
+        val = np.where(np.isnan(val), slope * (vals - x1) + z1, val)
+        val = np.where(np.isnan(val) & (z0 == z1), z0, val)
+    val = np.where(vals < xp[0], cube[0, yind, xind], val)
+    val = np.where(vals >= xp[-1], cube[-1, yind, xind], val)
+    in_range = (iloc >= 0) & (iloc < len(xp)-1) & np.isfinite(z0) & np.isfinite(z1)
+    if dq is not None:
+        in_range &= (dq[j, yind, xind] == 0) & (dq[j+1, yind, xind] == 0)
+    return val, in_range
+
+
+def idl_valuelocate(arr, vals):
+    """
+    This function is equivalent to value_locate() in IDL. For each value it gives the index i of the interval of
+    arr that contains it, i.e. arr[i] <= value < arr[i+1]. Values smaller than arr[0] give -1, and values larger
+    than or equal to arr[-1] give len(arr)-1. The values are located with a binary search, so they can be whole
+    arrays (e.g. the wavelength map of a slit).
+
+    Args:
+        arr: array where values will be located. ** This array MUST be in increasing order **
+        vals: float or array, values that will be located in arr
+
+    Returns:
+        idx: numpy array, indeces of the intervals of arr where the values are located (same shape as vals, or
+             one element if vals is a number)
+
+    """
+    return np.searchsorted(arr, np.atleast_1d(vals), side="right") - 1
 
 
 def interp_spline(x,y, atx):
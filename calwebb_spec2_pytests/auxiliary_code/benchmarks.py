@@ -0,0 +1,293 @@
+import numpy as np
+import time
+from scipy import integrate
+from astropy.io import fits
+
+from . import auxiliary_functions as auxfunc
+from . import flattest_ifu
+
+
+"""
+This script times the array implementations of the auxiliary code against the pixel-by-pixel versions they
+replaced, using synthetic data, e.g.
+    python -m calwebb_spec2_pytests.auxiliary_code.benchmarks
+"""
+
+
+def mk_fast_vector(wav_name, dat_name, wav, dat):
+    """
+    This function creates a fast vector table like the ones in the flat reference files.
+    Args:
+        wav_name: string, name of the wavelength column
+        dat_name: string, name of the data column
+        wav: numpy array, wavelengths
+        dat: numpy array, values
+
+    Returns:
+        table: FITS_rec table
+    """
+    cols = [fits.Column(name=wav_name, format="D", array=wav), fits.Column(name=dat_name, format="D", array=dat)]
+    return fits.BinTableHDU.from_columns(cols).data
+
+
+def mk_ifu_data(nslices=30, ny=30, nx=2048, seed=42):
+    """
+    This function creates a synthetic IFU exposure (slice wavelengths and reference flats) covering a full
+    2048x2048 detector.
+    Args:
+        nslices: integer, number of slices
+        ny: integer, number of rows of each slice
+        nx: integer, number of columns of each slice
+        seed: integer, random seed
+
+    Returns:
+        slices: list, wavelength array and subwindow origin (wave, px0, py0) of each slice
+        pipeflat: 2D numpy array, pipeline on-the-fly flat
+        dflat: list, D-flat wavelengths, cube, DQ image, and fast vector table
+        sflat: list, S-flat image, DQ image, and fast vector table
+        ffv: F-flat fast vector table
+    """
+    rng = np.random.RandomState(seed)
+    npix = 2048
+    slices = []
+    for k in range(nslices):
+        wave = np.linspace(0.95, 1.9, nx)[None, :] + 0.002 * np.arange(ny)[:, None] + 0.001 * k
+        wave[rng.rand(ny, nx) < 0.02] = np.nan
+        slices.append((wave, 1, 1 + k * ny))
+    pipeflat = rng.uniform(0.9, 1.1, (npix, npix)).astype(np.float32)
+    pipeflat[rng.rand(npix, npix) < 0.05] = 1.0
+    dfwave = np.linspace(0.9, 2.0, 8)
+    dfim = rng.uniform(0.95, 1.05, (len(dfwave), npix, npix)).astype(np.float32)
+    dfimdq = (rng.rand(npix, npix) < 0.01).astype(int)
+    rqe_wav = np.linspace(0.6, 5.3, 2000)
+    dfrqe = mk_fast_vector("WAVELENGTH", "RQE", rqe_wav, 1.0 + 0.05 * np.sin(rqe_wav))
+    sfim = rng.uniform(0.95, 1.05, (npix, npix)).astype(np.float32)
+    sfimdq = (rng.rand(npix, npix) < 0.01).astype(int)
+    sf_wav = np.linspace(0.6, 5.3, 3000)
+    sfv = mk_fast_vector("WAVELENGTH", "DATA", sf_wav, 1.0 + 0.02 * np.cos(sf_wav))
+    ff_wav = np.linspace(1.0, 5.3, 1500)
+    ffv = mk_fast_vector("WAVELENGTH", "DATA", ff_wav, 1.0 + 0.01 * np.sin(3 * ff_wav))
+    return slices, pipeflat, [dfwave, dfim, dfimdq, dfrqe], [sfim, sfimdq, sfv], ffv
+
+
+def legacy_ifu_slice_flat(wave, px0, py0, pipeflat, dflat, sflat, ffv):
+    """
+    This is the pixel-by-pixel calculation of the IFU flat of a slice that flattest_ifu used to do, kept as
+    reference for the benchmark.
+    Args:
+        wave: 2D numpy array, wavelengths of the slice
+        px0: integer, x-index of the slice origin
+        py0: integer, y-index of the slice origin
+        pipeflat: 2D numpy array, pipeline on-the-fly flat
+        dflat: list, D-flat wavelengths, cube, DQ image, and fast vector table
+        sflat: list, S-flat image, DQ image, and fast vector table
+        ffv: F-flat fast vector table
+
+    Returns:
+        flatcor: 1D numpy array, calculated flat of each pixel
+        delf: 1D numpy array, pipeline minus calculated flat of each pixel
+    """
+    dfwave, dfim, dfimdq, dfrqe = dflat
+    sfim, sfimdq, sfv = sflat
+    nx = np.shape(wave)[1]
+    nw = np.size(wave)
+    delf = np.zeros([nw]) + 999.0
+    flatcor = np.zeros([nw]) + 999.0
+    flat_wave = wave.flatten()
+
+    def band_value(vec_wav, vec_dat, jwav, delw, empty_value=None):
+        iw = np.where((vec_wav >= jwav-delw/2.0) & (vec_wav <= jwav+delw/2.0))[0]
+        if np.size(iw) > 1:
+            return auxfunc.idl_tabulate(vec_wav[iw], vec_dat[iw]) / (vec_wav[iw][-1] - vec_wav[iw][0])
+        if empty_value is None:
+            return np.nan
+        if np.size(iw) == 1:
+            return float(vec_dat[iw[0]])
+        return empty_value
+
+    for j in range(1, nw):
+        if np.isfinite(flat_wave[j]):
+            jwav = flat_wave[j]
+            t = np.where(wave == jwav)
+            pind = [t[0][0]+py0-1, t[1][0]+px0-1]
+            delw = 0.0
+            if (int((j-1)/nx)==int(j/nx)) and (int((j+1)/nx)==int(j/nx)) and np.isfinite(flat_wave[j+1]) and np.isfinite(flat_wave[j-1]):
+                delw = 0.5 * (flat_wave[j+1] - flat_wave[j-1])
+            if not np.isfinite(flat_wave[j-1]) or (int((j-1)/nx) != int(j/nx)):
+                delw = 0.5 * (flat_wave[j+1] - flat_wave[j])
+            if (j==nw-1) or not np.isfinite(flat_wave[j+1]) or (int((j+1)/nx) != int(j/nx)):
+                delw = 0.5 * (flat_wave[j] - flat_wave[j-1])
+            dff = band_value(dfrqe.field("WAVELENGTH"), dfrqe.field("RQE"), jwav, delw)
+            dfs = 1.0
+            if dfimdq[pind[0], pind[1]] == 0:
+                dfs = np.interp(jwav, dfwave, dfim[:, pind[0], pind[1]])
+            sff = 999.0
+            if (jwav < 5.3) and (jwav > 0.6):
+                sff = band_value(sfv.field("WAVELENGTH"), sfv.field("DATA"), jwav, delw, sfv.field("DATA")[-1])
+            sfs = 1.0
+            if sfimdq[pind[0], pind[1]] == 0:
+                sfs = sfim[pind[0], pind[1]]
+            fff = 1.0
+            if jwav-delw/2.0 >= 1.0:
+                fff = band_value(ffv.field("WAVELENGTH"), ffv.field("DATA"), jwav, delw, ffv.field("DATA")[-1])
+            flatcor[j] = dff * dfs * sff * sfs * fff
+            delf[j] = pipeflat[pind[0], pind[1]] - flatcor[j]
+            if pipeflat[pind[0], pind[1]] == 1:
+                delf[j] = 999.0
+            else:
+                flatcor[j] = 1.0
+    return flatcor, delf
+
+
+def legacy_idl_tabulate(x, f, p=5):
+    """
+    This is idl_tabulate as it was before the Newton-Cotes weights were cached, kept as reference for the benchmark.
+    Args:
+        x: array
+        f: array
+        p: integer, integrator order
+
+    Returns:
+        ret: array, integrated values
+    """
+    def newton_cotes(x, f):
+        if x.shape[0] < 2:
+            return 0
+        rn = (x.shape[0] - 1) * (x - x[0]) / (x[-1] - x[0])
+        weights = integrate.newton_cotes(rn)[0]
+        return (x[-1] - x[0]) / (x.shape[0] - 1) * np.dot(weights, f)
+
+    ret = 0
+    for idx in range(0, x.shape[0], p - 1):
+        ret += newton_cotes(x[idx:idx + p], f[idx:idx + p])
+    return ret
+
+
+def bench_idl_tabulate(nwindows=20000, seed=42):
+    """
+    This function times idl_tabulate with and without the cache of Newton-Cotes weights, integrating a realistic
+    D-flat RQE vector (uniform grid from 0.6 to 5.3 microns) over pixel bands of 5 to 30 points.
+    Args:
+        nwindows: integer, number of bands to integrate
+        seed: integer, random seed
+
+    Returns:
+        legacy_time: float, wall-clock time without the cache
+        cached_time: float, wall-clock time with the cache
+    """
+    rng = np.random.RandomState(seed)
+    rqe_wav = np.linspace(0.6, 5.3, 4701)
+    rqe = 0.9 - 0.1 * (rqe_wav - 3.0)**2 / 9.0
+    lo = rng.randint(0, len(rqe_wav)-30, nwindows)
+    hi = lo + rng.randint(5, 31, nwindows)
+
+    start = time.time()
+    legacy = [legacy_idl_tabulate(rqe_wav[l:h], rqe[l:h]) for l, h in zip(lo, hi)]
+    legacy_time = time.time() - start
+
+    start = time.time()
+    cached = [auxfunc.idl_tabulate(rqe_wav[l:h], rqe[l:h]) for l, h in zip(lo, hi)]
+    cached_time = time.time() - start
+
+    max_diff = np.max(np.abs(np.array(legacy) - np.array(cached)) / np.abs(legacy))
+    print ("idl_tabulate over ", nwindows, " bands of an RQE vector:")
+    print ("   without weight cache = ", round(legacy_time, 2), " s")
+    print ("   with weight cache    = ", round(cached_time, 2), " s")
+    print ("   maximum relative difference = ", max_diff)
+    return legacy_time, cached_time
+
+
+def legacy_do_idl_match(arrA, arrB):
+    """
+    This is do_idl_match as it was before it used np.isin, kept as reference for the benchmark.
+    Args:
+        arrA: numpy array
+        arrB: numpy array
+
+    Returns:
+        subA: numpy array of index of arrA from elements also present in arrB
+        subB: numpy array of index of arrB from elements also present in arrA
+    """
+    subA, subB = [], []
+    for i, ai in enumerate(arrA):
+        if ai in arrB:
+            subA.append(i)
+    for i, bi in enumerate(arrB):
+        if bi in arrA:
+            subB.append(i)
+    return np.array(subA), np.array(subB)
+
+
+def bench_do_idl_match(sizes=(50, 400, 2048)):
+    """
+    This function times do_idl_match against the element-by-element version, matching the pixel indeces of a
+    pipeline subwindow with those of the corresponding ESA subwindow (shifted by a few pixels, and with a repeated
+    index to check that duplicates are treated the same way).
+    Args:
+        sizes: list, number of pixels along the subwindow axis
+
+    Returns:
+        times: list, (size, legacy time, new time) for each size
+    """
+    times = []
+    print ("do_idl_match of pipeline and ESA pixel indeces:")
+    for n in sizes:
+        px = np.arange(n) + 101
+        ex = np.concatenate((np.arange(n) + 104, [110]))
+
+        start = time.time()
+        legacy = legacy_do_idl_match(px, ex)
+        legacy_time = time.time() - start
+
+        start = time.time()
+        new = auxfunc.do_idl_match(px, ex)
+        new_time = time.time() - start
+
+        same = np.array_equal(legacy[0], new[0]) and np.array_equal(legacy[1], new[1])
+        print ("   ", n, " pixels: element by element = ", round(legacy_time, 4), " s,  np.isin = ",
+               round(new_time, 4), " s,  identical indeces: ", same)
+        times.append((n, legacy_time, new_time))
+    return times
+
+
+def bench_ifu_flat(nslices=30, ny=30, nx=2048, legacy_slices=1):
+    """
+    This function times the calculation of the IFU flat for a full synthetic exposure. The pixel-by-pixel version
+    is only run on a few slices and its time is scaled to the whole exposure.
+    Args:
+        nslices: integer, number of slices
+        ny: integer, number of rows of each slice
+        nx: integer, number of columns of each slice
+        legacy_slices: integer, number of slices to run with the pixel-by-pixel version
+
+    Returns:
+        legacy_time: float, estimated wall-clock time per exposure of the pixel-by-pixel version
+        array_time: float, wall-clock time per exposure of the array version
+    """
+    slices, pipeflat, dflat, sflat, ffv = mk_ifu_data(nslices, ny, nx)
+
+    start = time.time()
+    flatcor_list, delf_list = flattest_ifu.calc_ifu_flat(slices, pipeflat, dflat, sflat, ffv)
+    array_time = time.time() - start
+
+    start = time.time()
+    max_diff = 0.0
+    for k in range(legacy_slices):
+        wave, px0, py0 = slices[k]
+        flatcor, delf = legacy_ifu_slice_flat(wave, px0, py0, pipeflat, dflat, sflat, ffv)
+        good = np.isfinite(flatcor) & np.isfinite(flatcor_list[k])
+        max_diff = max(max_diff, np.max(np.abs(flatcor[good] - flatcor_list[k][good])))
+    legacy_time = (time.time() - start) * nslices / legacy_slices
+
+    print ("IFU flat for ", nslices, " slices of ", ny, "x", nx, " pixels:")
+    print ("   pixel-by-pixel loop (estimated) = ", round(legacy_time, 2), " s per exposure")
+    print ("   array implementation            = ", round(array_time, 2), " s per exposure")
+    print ("   maximum difference in calculated flat = ", max_diff)
+    return legacy_time, array_time
+
+
+if __name__ == '__main__':
+
+    bench_idl_tabulate()
+    bench_do_idl_match()
+    bench_ifu_flat()
@@ -1,13 +1,12 @@
 import numpy as np
-import os
 import sys
 import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib.ticker import MaxNLocator
 from astropy.io import fits
 
-from jwst.assign_wcs.tools.nirspec import compute_world_coordinates
 from . import auxiliary_functions as auxfunc
+from .. import core_utils
 
 
 """
@@ -64,7 +63,6 @@ def mk_plots(title, show_figs=True, save_figs=False, info_fig1=None, info_fig2=N
     if deltas_plt:
         ax = plt.subplot(211)
         title1, xlabel1, ylabel1, xarr1, yarr1, xdelta, x_median, x_stddev = info_fig1
-        xarr1, yarr1 = xarr1[0], yarr1[0]
         plt.title(title1)
         plt.xlabel(xlabel1)
         plt.ylabel(ylabel1)
@@ -72,29 +70,9 @@ def mk_plots(title, show_figs=True, save_figs=False, info_fig1=None, info_fig2=N
         mean_minus_half_std = x_median - 0.5*x_stddev
         mean_plus_half_std = x_median + 0.5*x_stddev
         mean_plus_1half_std = x_median + 1.5*x_stddev
-        '''
-        for xd, xi, yi in zip(xdelta, xarr1, yarr1):
-            if xd > mean_plus_1half_std:
-                plt.plot(xi, yi, linewidth=7, marker='D', color='red')#, label="")
-            if xd < mean_minus_1half_std:
-                plt.plot(xi, yi, linewidth=7, marker='D', color='fuchsia')#, label="")
-            if (xd > mean_minus_1half_std) and (xd < mean_minus_half_std):
-                plt.plot(xi, yi, linewidth=7, marker='D', color='blue')#, label="")
-            if (xd > mean_minus_half_std) and (xd < mean_plus_half_std):
-                plt.plot(xi, yi, linewidth=7, marker='D', color='lime')#, label="")
-            if (xd > mean_plus_half_std) and (xd < mean_plus_1half_std):
-                plt.plot(xi, yi, linewidth=7, marker='D', color='black')#, label="")
-        '''
-        idx_red = np.where(xdelta > mean_plus_1half_std)
-        idx_fuchsia = np.where(xdelta < mean_minus_1half_std)
-        idx_blue = np.where((xdelta > mean_minus_1half_std) & (xdelta < mean_minus_half_std))
-        idx_lime = np.where((xdelta > mean_minus_half_std) & (xdelta < mean_plus_half_std))
-        idx_black = np.where((xdelta > mean_plus_half_std) & (xdelta < mean_plus_1half_std))
-        plt.plot(xarr1[idx_red], yarr1[idx_red], linewidth=7, marker='D', color='red')#, label="")
-        plt.plot(xarr1[idx_fuchsia], yarr1[idx_fuchsia], linewidth=7, marker='D', color='fuchsia')#, label="")
-        plt.plot(xarr1[idx_blue], yarr1[idx_blue], linewidth=7, marker='D', color='blue')#, label="")
-        plt.plot(xarr1[idx_lime], yarr1[idx_lime], linewidth=7, marker='D', color='lime')#, label="")
-        plt.plot(xarr1[idx_black], yarr1[idx_black], linewidth=7, marker='D', color='black')#, label="")
+        band_limits = [mean_minus_1half_std, mean_minus_half_std,
+                       mean_plus_half_std, mean_plus_1half_std]
+        auxfunc.plot_sigma_bands(ax, xarr1, yarr1, xdelta, band_limits)
         # add legend
         #box = ax.get_position()
         #ax.set_position([box.x0, box.y0, box.width * 1.0, box.height])
@@ -128,7 +106,6 @@ def mk_plots(title, show_figs=True, save_figs=False, info_fig1=None, info_fig2=N
     if deltas_plt:
         ax = plt.subplot(212)
         title2, xlabel2, ylabel2, xarr2, yarr2, ydelta, y_median, y_stddev = info_fig2
-        xarr2, yarr2 = xarr2[0], yarr2[0]
         plt.title(title2)
         plt.xlabel(xlabel2)
         plt.ylabel(ylabel2)
@@ -136,29 +113,9 @@ def mk_plots(title, show_figs=True, save_figs=False, info_fig1=None, info_fig2=N
         mean_minus_half_std = y_median - 0.5*y_stddev
         mean_plus_half_std = y_median + 0.5*y_stddev
         mean_plus_1half_std = y_median + 1.5*y_stddev
-        '''
-        for yd, xi, yi in zip(ydelta, xarr2, yarr2):
-            if yd > mean_plus_1half_std:
-                plt.plot(xi, yi, linewidth=7, marker='D', color='red')#, label="")
-            if yd < mean_minus_1half_std:
-                plt.plot(xi, yi, linewidth=7, marker='D', color='fuchsia')#, label="")
-            if (yd > mean_minus_1half_std) and (yd < mean_minus_half_std):
-                plt.plot(xi, yi, linewidth=7, marker='D', color='blue')#, label="")
-            if (yd > mean_minus_half_std) and (yd < mean_plus_half_std):
-                plt.plot(xi, yi, linewidth=7, marker='D', color='lime')#, label="")
-            if (yd > mean_plus_half_std) and (yd < mean_plus_1half_std):
-                plt.plot(xi, yi, linewidth=7, marker='D', color='black')#, label=r"$\mu+0.5*\sigma$ > $\mu+1.5*\sigma$")
-        '''
-        idx_red = np.where(ydelta > mean_plus_1half_std)
-        idx_fuchsia = np.where(ydelta < mean_minus_1half_std)
-        idx_blue = np.where((ydelta > mean_minus_1half_std) & (ydelta < mean_minus_half_std))
-        idx_lime = np.where((ydelta > mean_minus_half_std) & (ydelta < mean_plus_half_std))
-        idx_black = np.where((ydelta > mean_plus_half_std) & (ydelta < mean_plus_1half_std))
-        plt.plot(xarr2[idx_red], yarr2[idx_red], linewidth=7, marker='D', color='red')#, label="")
-        plt.plot(xarr2[idx_fuchsia], yarr2[idx_fuchsia], linewidth=7, marker='D', color='fuchsia')#, label="")
-        plt.plot(xarr2[idx_blue], yarr2[idx_blue], linewidth=7, marker='D', color='blue')#, label="")
-        plt.plot(xarr2[idx_lime], yarr2[idx_lime], linewidth=7, marker='D', color='lime')#, label="")
-        plt.plot(xarr2[idx_black], yarr2[idx_black], linewidth=7, marker='D', color='black')#, label="")
+        band_limits = [mean_minus_1half_std, mean_minus_half_std,
+                       mean_plus_half_std, mean_plus_1half_std]
+        auxfunc.plot_sigma_bands(ax, xarr2, yarr2, ydelta, band_limits)
         # add legend
         #box = ax.get_position()
         #ax.set_position([box.x0, box.y0, box.width * 1.0, box.height])
@@ -233,53 +190,42 @@ def compare_wcs(infile_name, esa_files_path=None, auxiliary_code_path=None,
     """
 
     # get grating and filter info from the rate file header
-    det = fits.getval(infile_name, "DETECTOR", 0)
+    infile_hdrs = core_utils.read_header_snapshot(infile_name)
+    det = core_utils.get_snapshot_val(infile_hdrs, "DETECTOR")
     print('infile_name=', infile_name)
-    lamp = fits.getval(infile_name, "LAMP", 0)
-    grat = fits.getval(infile_name, "GRATING", 0)
-    filt = fits.getval(infile_name, "FILTER", 0)
+    lamp = core_utils.get_snapshot_val(infile_hdrs, "LAMP")
+    grat = core_utils.get_snapshot_val(infile_hdrs, "GRATING")
+    filt = core_utils.get_snapshot_val(infile_hdrs, "FILTER")
     print ("extract_2d  -->     Detector:", det, "   Grating:", grat, "   Filter:", filt, "   Lamp:", lamp)
 
 
-    # Run compute_world_coordinates.py in order to produce the necessary file
+    # get the world coordinates of the extract_2d file (compute_world_coordinates.py is only run if they were not
+    # computed before for a product with the same WCS, see auxfunc.get_world_coordinates)
     # !!! note that the code expects to be in the build environment !!!
     if auxiliary_code_path is None:
         auxiliary_code_path = "./"
-
-    compute_world_coordinates.compute_world_coordinates(infile_name)
-
-    # The world coordinate file was created but it needs to be renamed
-    basenameinfile_name = os.path.basename(infile_name)
-    fileID = basenameinfile_name.split("_")[0]   # obtain the id of the file
-    working_dir_path = os.getcwd()
-    wcoordfile = working_dir_path+"/"+fileID+"_world_coordinates.fits"
-    #print (wcoordfile)
-    # to move file to location of infile
-    #cwc_fname = infile_name.replace(".fits", "_world_coordinates.fits")
-    # to rename file within the working directory
-    cwc_fname = basenameinfile_name.replace(".fits", "_world_coordinates.fits")
+    wc = auxfunc.get_world_coordinates(infile_name)
+    cwc_fname = wc.file_name
     print (cwc_fname)
-    cwc_fname = infile_name.replace(basenameinfile_name, cwc_fname)
-    os.system("mv "+wcoordfile+" "+cwc_fname)
 
     # loop over the slits
     sltname_list = []
-    wchdu = fits.open(cwc_fname)
-    #n_ext = len(wchdu)
     sci_ext_list = auxfunc.get_sci_extensions(infile_name)
     print ('sci_ext_list=', sci_ext_list, '\n')
 
+    # the figures that are only saved are rendered in the background while the next slits are compared
+    plot_queue = auxfunc.start_plot_queue(show_figs, save_figs)
     for i, s_ext in enumerate(sci_ext_list):
         print("-> opening extension =", i+1, "  in ", cwc_fname)
         print("   which corresponds to science ext:", s_ext, " of file:", infile_name)
-        hdr = wchdu[i+1].header
+        hdr = wc.headers.headers[i+1]
 
         # what is the slit of this exposure
         pslit = hdr["SLIT"]
         print("SLIT = ", pslit)
 
         # for matched spectrum, get the wavelength and Delta_Y values
-        fdata = fits.getdata(cwc_fname, ext=i+1)
+        fdata = wc.data[i+1]
         pwave = fdata[0,:,:]
         pdy = fdata[3,:,:]
         pskyx = fdata[1,:,:]
@@ -289,9 +235,11 @@ def compare_wcs(infile_name, esa_files_path=None, auxiliary_code_path=None,
         #print('np.shape(fdata) = ', np.shape(fdata))
 
         # get the origin of the subwindow
-        px0 = fits.getval(infile_name, "SLTSTRT1", ext=s_ext)+fits.getval(infile_name, "SUBSTRT1", ext=0)-1
-        py0 = fits.getval(infile_name, "SLTSTRT2", ext=s_ext)+fits.getval(infile_name, "SUBSTRT2", ext=0)-1
-        sltname = fits.getval(infile_name, "SLTNAME", ext=s_ext)
+        px0 = (core_utils.get_snapshot_val(infile_hdrs, "SLTSTRT1", ext=s_ext) +
+               core_utils.get_snapshot_val(infile_hdrs, "SUBSTRT1") - 1)
+        py0 = (core_utils.get_snapshot_val(infile_hdrs, "SLTSTRT2", ext=s_ext) +
+               core_utils.get_snapshot_val(infile_hdrs, "SUBSTRT2") - 1)
+        sltname = core_utils.get_snapshot_val(infile_hdrs, "SLTNAME", ext=s_ext)
         sltname_list.append(sltname)
         n_p = np.shape(fdata)
         npx = n_p[2]
@@ -343,6 +291,7 @@ def compare_wcs(infile_name, esa_files_path=None, auxiliary_code_path=None,
                 print(" * compare_wcs_fs.py is exiting because there are no extensions that match detector NRS2 in the ESA file.")
                 print("   -> The WCS test is now set to skip and no plots will be generated. ")
                 median_diff = "skip"
+                auxfunc.finish_plot_queue(plot_queue)
                 return median_diff
 
         esahdulist.close()
@@ -369,72 +318,12 @@ def compare_wcs(infile_name, esa_files_path=None, auxiliary_code_path=None,
             print("   ex=", len(ex), "   ey=", len(ey))
             print("   px=", len(px), "   py=", len(py))
 
-        # match up the correct elements in each data set
-        subpx, subex = auxfunc.do_idl_match(px, ex)
-        subpy, subey = auxfunc.do_idl_match(py, ey)
-        print("matched elements in the 2D spectra: ", len(subpx), len(subey))
-        for sx in subpx:
-            if px[sx] not in ex:
-                print("aha! found it!  ", ex[sx])
-        imp, ime = [], []
-        for spy in subpy:
-            im0 = subpx + npx * spy
-            imp.append(im0)
-        for sey in subey:
-            im0 = subex + nex * sey
-            ime.append(im0)
-        imp, ime = np.array(imp), np.array(ime)
-        imp, ime  = imp.flatten(), ime.flatten()
-
-        #print('ime = ', np.shape(ime), '   imp =', np.shape(imp))
-        #print('ime[0:9] = ', ime[0:10])
-
-        # get the difference between the two in units of resels
+        # match up the correct elements in each data set and get the difference between the two in units of m
         # do not include pixels where one or the other solution is 0 or NaN
-        flat_pwave, flat_ewave = pwave.flatten(), ewave.flatten()
-        # get the elements with index imp and ime
-        #print('flat_pwave=', len(flat_pwave), '  flat_ewave=', len(flat_ewave))
-
-        try:
-            ig = np.where((flat_pwave[imp]!=0.0) & (flat_ewave[ime]!=0.0) & (np.isfinite(flat_pwave[imp])) & (np.isfinite(flat_ewave[imp])))
-        except:
-            IndexError
-        #print('ig = ', np.shape(ig))
-
-        pxr, pyr = np.array([]), np.array([])
-        for _ in range(npy):
-            pxr = np.concatenate((pxr, px))
-        pxr = pxr.astype(int)
-        reshaped_py = py.reshape(npy, 1)
-        for rpy_i in reshaped_py:
-            for _ in range(npx):
-                pyr = np.concatenate((pyr, rpy_i))
-        pyr = pyr.astype(int)
-
-        pxrg, pyrg, deldy = [], [], []
-        flat_pdy, flat_edy = pdy.flatten(), edy.flatten()
-        try:
-            for ig_i in ig:
-                pxrg_i = pxr[imp[ig_i]]
-                pxrg.append(pxrg_i)
-                pyrg_i = pyr[imp[ig_i]]
-                pyrg.append(pyrg_i)
-                deldy_i = flat_pdy[imp[ig_i]] - flat_edy[ime[ig_i]]
-                deldy.append(deldy_i)
-            pxrg, pyrg, deldy = np.array(pxrg), np.array(pyrg), np.array(deldy)
-
-            igy = np.where((flat_pdy[imp]!=0.0) & (flat_edy[ime]!=0.0) & (np.isfinite(flat_pdy[imp])) & (np.isfinite(flat_edy[imp])))
-            #print('igy = ', np.shape(igy))
-
-            delwave = (flat_pwave[imp[ig]]*1.0e-6 -flat_ewave[ime[ig]])
-            deldy = flat_pdy[imp[igy]] - flat_edy[ime[igy]]
-            #delflx = flat_pdy[imp[ig]] - flat_edy[ime[ig]]
-            #print (flat_pdy[imp[ig]], flat_edy[ime[ig]])
-
-            #print('np.shape(delwave) = ', np.shape(delwave))
-            #print('np.shape(deldy) = ', np.shape(deldy))
-        except:
-            IndexError
+        deltas = auxfunc.compare_subwindows([px0, py0, pwave*1.0e-6, pdy], [ex0, ey0, ewave, edy, None, None],
+                                            esa_zeros=True, dy_mask=True)
+        delwave, deldy, pxrg, pyrg = deltas.delwave, deltas.deldy, deltas.pxrg, deltas.pyrg
+        print("matched elements in the 2D spectra: ", len(delwave), len(deldy))
 
         # get the median and standard deviations
         median_diff = False
@@ -477,8 +366,8 @@ def compare_wcs(infile_name, esa_files_path=None, auxiliary_code_path=None,
                     xmax2 = max(deldy) + (max(deldy)-min(deldy))*0.1
                     xlabel2, ylabel2 = r"$\Delta y_{pipe}$ - $\Delta y_{ESA}$ (relative slit position)", "N"
                     info_fig2 = [xlabel2, ylabel2, deldy, yarr, xmin2, xmax2, bins, deldy_median, deldy_stddev]
-                    mk_plots(title, info_fig1=info_fig1, info_fig2=info_fig2, show_figs=show_figs, save_figs=save_figs,
-                             histogram=True, fig_name=hist_name)
+                    auxfunc.make_plot(plot_queue, mk_plots, title=title, info_fig1=info_fig1, info_fig2=info_fig2,
+                                      show_figs=show_figs, save_figs=save_figs, histogram=True, fig_name=hist_name)
 
                     # DELTAS PLOT
                     title = ""
@@ -488,8 +377,8 @@ def compare_wcs(infile_name, esa_files_path=None, auxiliary_code_path=None,
                     info_fig2 = [title2, xlabel2, ylabel2, pxrg, pyrg, deldy, deldy_median, deldy_stddev]
                     #title3, xlabel3, ylabel3 = r"$\Delta$ Flux", "x (pixels)", "y (pixels)"
                     #info_fig3 = [title3, xlabel3, ylabel3, pxrg, pyrg, delflx, deldy_median, deldy_stddev]
-                    mk_plots(title, info_fig1=info_fig1, info_fig2=info_fig2,
-                             show_figs=show_figs, save_figs=save_figs, deltas_plt=True, fig_name=deltas_name)
+                    auxfunc.make_plot(plot_queue, mk_plots, title=title, info_fig1=info_fig1, info_fig2=info_fig2,
+                                      show_figs=show_figs, save_figs=save_figs, deltas_plt=True, fig_name=deltas_name)
 
                     print("Done.")
 
@@ -498,6 +387,7 @@ def compare_wcs(infile_name, esa_files_path=None, auxiliary_code_path=None,
             else:
                 print("Not making plots because median is NaN.")
 
+    auxfunc.finish_plot_queue(plot_queue)
 
     return median_diff
 
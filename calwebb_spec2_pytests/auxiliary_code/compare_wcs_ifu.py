@@ -1,12 +1,11 @@
 import numpy as np
-import os
 import sys
 import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib.ticker import MaxNLocator
 from astropy.io import fits
-from jwst.assign_wcs.tools.nirspec import compute_world_coordinates as cwc
 from . import auxiliary_functions as auxfunc
+from .. import core_utils
 
 
 """
@@ -67,29 +66,9 @@ def mk_plots(title, show_figs=True, save_figs=False, info_fig1=None, info_fig2=N
             mean_plus_half_std = x_median + 0.5*x_stddev
             mean_plus_1half_std = x_median + 1.5*x_stddev
 
-            for xd, xi, yi in zip(xdelta, xarr1, yarr1):
-                if xd > mean_plus_1half_std:
-                    plt.plot(xi, yi, linewidth=7, marker='D', color='red')#, label="")
-                if xd < mean_minus_1half_std:
-                    plt.plot(xi, yi, linewidth=7, marker='D', color='fuchsia')#, label="")
-                if (xd > mean_minus_1half_std) and (xd < mean_minus_half_std):
-                    plt.plot(xi, yi, linewidth=7, marker='D', color='blue')#, label="")
-                if (xd > mean_minus_half_std) and (xd < mean_plus_half_std):
-                    plt.plot(xi, yi, linewidth=7, marker='D', color='lime')#, label="")
-                if (xd > mean_plus_half_std) and (xd < mean_plus_1half_std):
-                    plt.plot(xi, yi, linewidth=7, marker='D', color='black')#, label="")
-            '''
-            idx_red = np.where(xdelta > mean_plus_1half_std)
-            idx_fuchsia = np.where(xdelta < mean_minus_1half_std)
-            idx_blue = np.where((xdelta > mean_minus_1half_std) & (xdelta < mean_minus_half_std))
-            idx_lime = np.where((xdelta > mean_minus_half_std) & (xdelta < mean_plus_half_std))
-            idx_black = np.where((xdelta > mean_plus_half_std) & (xdelta < mean_plus_1half_std))
-            plt.plot(xarr1[idx_red], yarr1[idx_red], linewidth=7, marker='D', color='red')#, label="")
-            plt.plot(xarr1[idx_fuchsia], yarr1[idx_fuchsia], linewidth=7, marker='D', color='fuchsia')#, label="")
-            plt.plot(xarr1[idx_blue], yarr1[idx_blue], linewidth=7, marker='D', color='blue')#, label="")
-            plt.plot(xarr1[idx_lime], yarr1[idx_lime], linewidth=7, marker='D', color='lime')#, label="")
-            plt.plot(xarr1[idx_black], yarr1[idx_black], linewidth=7, marker='D', color='black')#, label="")
-            '''
+            band_limits = [mean_minus_1half_std, mean_minus_half_std,
+                           mean_plus_half_std, mean_plus_1half_std]
+            auxfunc.plot_sigma_bands(ax, xarr1, yarr1, xdelta, band_limits)
             # add legend
             #box = ax.get_position()
             #ax.set_position([box.x0, box.y0, box.width * 1.0, box.height])
@@ -129,17 +108,9 @@ def mk_plots(title, show_figs=True, save_figs=False, info_fig1=None, info_fig2=N
             mean_minus_half_std = y_median - 0.5*y_stddev
             mean_plus_half_std = y_median + 0.5*y_stddev
             mean_plus_1half_std = y_median + 1.5*y_stddev
-            for yd, xi, yi in zip(ydelta, xarr2, yarr2):
-                if yd > mean_plus_1half_std:
-                    plt.plot(xi, yi, linewidth=7, marker='D', color='red')#, label="")
-                if yd < mean_minus_1half_std:
-                    plt.plot(xi, yi, linewidth=7, marker='D', color='fuchsia')#, label="")
-                if (yd > mean_minus_1half_std) and (yd < mean_minus_half_std):
-                    plt.plot(xi, yi, linewidth=7, marker='D', color='blue')#, label="")
-                if (yd > mean_minus_half_std) and (yd < mean_plus_half_std):
-                    plt.plot(xi, yi, linewidth=7, marker='D', color='lime')#, label="")
-                if (yd > mean_plus_half_std) and (yd < mean_plus_1half_std):
-                    plt.plot(xi, yi, linewidth=7, marker='D', color='black')#, label=r"$\mu+0.5*\sigma$ > $\mu+1.5*\sigma$")
+            band_limits = [mean_minus_1half_std, mean_minus_half_std,
+                           mean_plus_half_std, mean_plus_1half_std]
+            auxfunc.plot_sigma_bands(ax, xarr2, yarr2, ydelta, band_limits)
             # add legend
             #box = ax.get_position()
             #ax.set_position([box.x0, box.y0, box.width * 1.0, box.height])
@@ -161,17 +132,7 @@ def mk_plots(title, show_figs=True, save_figs=False, info_fig1=None, info_fig2=N
         plt.ylim(-0.0010, 0.0010)
         #plt.xticks(np.arange(min(xarr), max(xarr), xarr[0]*5))
         #plt.yticks(np.arange(min(yarr), max(yarr), 0.000005))
-        for xd, xi, yi in zip(xdelta, xarr, yarr):
-            if xd > lim_d:
-                plt.plot(xi, yi, linewidth=7, marker='D', color='red')#, label="")
-            if xd < lim_a:
-                plt.plot(xi, yi, linewidth=7, marker='D', color='fuchsia')#, label="")
-            if (xd > lim_a) and (xd < lim_b):
-                plt.plot(xi, yi, linewidth=7, marker='D', color='blue')#, label="")
-            if (xd > lim_b) and (xd < lim_c):
-                plt.plot(xi, yi, linewidth=7, marker='D', color='lime')#, label="")
-            if (xd > lim_c) and (xd < lim_d):
-                plt.plot(xi, yi, linewidth=7, marker='D', color='black')#, label="")
+        auxfunc.plot_sigma_bands(ax, xarr, yarr, xdelta, [lim_a, lim_b, lim_c, lim_d])
         # Shrink current axis
         box = ax.get_position()
         #percent = 0.85
@@ -199,8 +160,70 @@ def mk_plots(title, show_figs=True, save_figs=False, info_fig1=None, info_fig2=N
     plt.close()
 
 
+def read_slice_subwindows(wc_ext, wc=None, esa_files_path=None, raw_data_root_file=None, debug=False):
+    """
+    This function reads the pipeline subwindow of the slice in the given extension of the world coordinates file,
+    and the corresponding ESA subwindow. It only depends on its arguments, so the slices can be read in parallel
+    (see auxfunc.run_in_pool).
+    Args:
+        wc_ext: integer, extension of the world coordinates file
+        wc: WorldCoordinates, headers and data of the world coordinates file
+        esa_files_path: str, full path of where to find all ESA intermediary products
+        raw_data_root_file: string, raw data file used to find the corresponding ESA files
+        debug: boolean, if true a series of print statements will show on-screen
+
+    Returns:
+        IFUslice: string, number of the slice
+        pipe_subwindow: list, px0, py0, wavelength (m), and relative slit position of the pipeline
+        esa_subwindow: list, ex0, ey0, wavelength, relative slit position, MSA x and MSA y of the ESA file
+    """
+    print("-> opening extension =", wc_ext, "  in ", wc.file_name)
+    hdr = wc.headers.headers[wc_ext]
+
+    # what is the slice of this exposure
+    pslit = hdr["SLIT"].replace("SLIT_", "")
+    if float(pslit) < 10.0:
+        IFUslice = "0"+pslit
+    else:
+        IFUslice = pslit
+
+    print("working with slice: ", IFUslice)
+
+    # for matched spectrum, get the wavelength and Delta_Y values
+    fdata = wc.data[wc_ext]
+    pwave = fdata[0,:,:] * 1.0e-6
+    pdy = fdata[3,:,:]
+
+    # get the subwindow origin (technically no subwindows for IFU, but need it for comparing with IDT extractions)
+    px0 = hdr["CRVAL1"]
+    py0 = hdr["CRVAL2"]
+    if debug:
+        print ("px0=",px0, "   py0=", py0)
+        print("n_p =", np.shape(pwave))
+
+    # read in the ESA file using raw data root file name
+    specifics = [IFUslice]
+    esafile = auxfunc.get_esafile(esa_files_path, raw_data_root_file, "IFU", specifics)
+
+    esahdulist = fits.open(esafile)
+    print ("* ESA file contents ")
+    esahdulist.info()
+    esahdr1 = esahdulist[1].header
+    ewave = esahdulist[4].data
+    edy = esahdulist[5].data
+    emsax = esahdulist[6].data
+    emsay = esahdulist[7].data
+    esahdulist.close()
+    # get the origin of the subwindow
+    ex0 = esahdr1["CRVAL1"] - esahdr1["CRPIX1"] + 1
+    ey0 = esahdr1["CRVAL2"] - esahdr1["CRPIX2"] + 1
+    print("ESA subwindow corner pixel ID: ", ex0, ey0)
+
+    return IFUslice, [px0, py0, pwave, pdy], [ex0, ey0, ewave, edy, emsax, emsay]
+
+
 def compare_wcs(infile_name, esa_files_path=None, auxiliary_code_path=None,
-                show_figs=True, save_figs=False, plot_names=None, threshold_diff=1.0e-14, debug=False):
+                show_figs=True, save_figs=False, plot_names=None, threshold_diff=1.0e-14, debug=False, n_workers=1):
     """
     This function does the WCS comparison from the world coordinates calculated using the
     compute_world_coordinates.py script with the ESA files. The function calls that script.
@@ -216,6 +239,7 @@ def compare_wcs(infile_name, esa_files_path=None, auxiliary_code_path=None,
                     default)
         threshold_diff: float, threshold difference between pipeline output and ESA file
         debug: boolean, if true a series of print statements will show on-screen
+        n_workers: integer, number of processes to read the slices in parallel (1 reads them serially)
 
     Returns:
         - 2 plots, if told to save and/or show them.
@@ -224,186 +248,53 @@ def compare_wcs(infile_name, esa_files_path=None, auxiliary_code_path=None,
     """
 
     # get grating and filter info from the rate file header
-    det = fits.getval(infile_name, "DETECTOR", 0)
+    infile_hdrs = core_utils.read_header_snapshot(infile_name, extensions=[0])
+    det = core_utils.get_snapshot_val(infile_hdrs, "DETECTOR")
     print('infile_name=', infile_name)
-    lamp = fits.getval(infile_name, "LAMP", 0)
-    grat = fits.getval(infile_name, "GRATING", 0)
-    filt = fits.getval(infile_name, "FILTER", 0)
+    lamp = core_utils.get_snapshot_val(infile_hdrs, "LAMP")
+    grat = core_utils.get_snapshot_val(infile_hdrs, "GRATING")
+    filt = core_utils.get_snapshot_val(infile_hdrs, "FILTER")
     print ("Info from WCS file  -->     Detector:", det, "   Grating:", grat, "   Filter:", filt, "   Lamp:", lamp)
 
 
-    # Run compute_world_coordinates.py in order to produce the necessary file
+    # get the world coordinates of the extract_2d file (compute_world_coordinates.py is only run if they were not
+    # computed before for a product with the same WCS, see auxfunc.get_world_coordinates)
     # !!! note that the code expects to be in the build environment !!!
     if auxiliary_code_path is None:
         auxiliary_code_path = "./"
+    wc = auxfunc.get_world_coordinates(infile_name, ifu=True)
 
-    # compute world coordinates with Nadia's script
-    print ("running compute_world_coordinates.py script...")
-    cwc.ifu_coords(infile_name)
-    print (" ... done.")
-
-    # The world coordinate file was created but it needs to be renamed
-    basenameinfile_name = os.path.basename(infile_name)
-    fileID = basenameinfile_name.split("_")[0]   # obtain the id of the file
-    working_dir_path = os.getcwd()
-    wcoordfile = working_dir_path+"/"+fileID+"_world_coordinates.fits"
-    #print (wcoordfile)
-    # to move file to location of infile
-    #cwc_fname = infile_name.replace(".fits", "_world_coordinates.fits")
-    # to rename file within the working directory
-    cwc_fname = basenameinfile_name.replace(".fits", "_world_coordinates.fits")
-    #print (cwc_fname)
-    cwc_fname = infile_name.replace(basenameinfile_name, cwc_fname)
-    os.system("mv "+wcoordfile+" "+cwc_fname)
-
-    # loop over the slits
-    wchdu = fits.open(cwc_fname)
-    slices = len(wchdu)
+    # read in the pipeline and ESA subwindows of each slice, in parallel if n_workers > 1 (the slices come back in
+    # the order of the extensions)
     sci_ext_list = auxfunc.get_sci_extensions(infile_name)
     print ('sci_ext_list=', sci_ext_list, '\n')
-
-    for wc_ext in range(1, slices):
-        try:
-            print("-> opening extension =", wc_ext, "  in ", cwc_fname)
-            hdr = wchdu[wc_ext].header
-        except:
-            IndexError
-            break
-
-        # what is the slice of this exposure
-        pslit = hdr["SLIT"].replace("SLIT_", "")
-        if float(pslit) < 10.0:
-            IFUslice = "0"+pslit
-        else:
-            IFUslice = pslit
-
-        print("working with slice: ", IFUslice)
-
-        # for matched spectrum, get the wavelength and Delta_Y values
-        fdata = fits.getdata(cwc_fname, ext=wc_ext)
-        pwave = fdata[0,:,:] * 1.0e-6
-        pdy = fdata[3,:,:]
-        pskyx = fdata[1,:,:]
-        pskyy = fdata[2,:,:]
-
-        # get the subwindow origin (technically no subwindows for IFU, but need it for comparing with IDT extractions)
-        px0 = fits.getval(cwc_fname, "CRVAL1", wc_ext)
-        py0 = fits.getval(cwc_fname, "CRVAL2", wc_ext)
+    _, raw_data_root_file = auxfunc.get_modeused_and_rawdatrt_PTT_cfg_file()
+    print("Using this raw data file to find the corresponding ESA files: ", raw_data_root_file)
+
+    slice_data = dict(wc=wc, esa_files_path=esa_files_path, raw_data_root_file=raw_data_root_file, debug=debug)
+    wc_exts = list(range(1, len(wc.headers.headers)))
+    IFUslice_list, pipe_list, esa_list = [], [], []
+    for IFUslice, pipe_subwindow, esa_subwindow in auxfunc.run_in_pool(read_slice_subwindows, wc_exts, slice_data,
+                                                                       n_workers=n_workers):
+        IFUslice_list.append(IFUslice)
+        pipe_list.append(pipe_subwindow)
+        esa_list.append(esa_subwindow)
+
+    # match up the correct elements in each data set and get the difference between the two in units of m, for
+    # all the slices at once (do not include pixels where one or the other solution is 0 or NaN)
+    deltas_list = auxfunc.compare_subwindows_batch(pipe_list, esa_list)
+
+    # the figures that are only saved are rendered in the background while the next slices are checked
+    plot_queue = auxfunc.start_plot_queue(show_figs, save_figs, n_workers=n_workers)
+    median_diff = False
+    for IFUslice, deltas in zip(IFUslice_list, deltas_list):
+        print("\n Results for slice: ", IFUslice)
+        delwave, deldy, pxrg, pyrg = deltas.delwave, deltas.deldy, deltas.pxrg, deltas.pyrg
         if debug:
-            print ("px0=",px0, "   py0=", py0)
+            print("shapes of delwave, deldy: ", np.shape(delwave), np.shape(deldy))
 
-        # get the count rates for this spectrum
-        counts = fits.getdata(infile_name, 1)
-        n_p = np.shape(pwave)
-        if debug:
-            print("n_p =", n_p)
-        npx = n_p[1]
-        npy = n_p[0]
-        px = np.arange(npx)+px0
-        py = np.arange(npy)+py0
-        if debug:
-            print  ("px =", px)
-            print  ("px0+npx-1 =", px0+npx-1)
-            print  ("py =", py)
-            print  ("py0+npy-1 =", py0+npy-1)
-
-        # read in the ESA file using raw data root file name
-        #rawdatroot = fits.getval(infile_name, "rawdatrt", 0)
-        _, raw_data_root_file = auxfunc.get_modeused_and_rawdatrt_PTT_cfg_file()
-        specifics = [IFUslice]
-        esafile = auxfunc.get_esafile(esa_files_path, raw_data_root_file, "IFU", specifics)
-
-        esahdulist = fits.open(esafile)
-        print ("* ESA file contents ")
-        esahdulist.info()
-        esahdr1 = esahdulist[1].header
-        enext = []
-        for ext in esahdulist:
-            enext.append(ext)
-        eflux = fits.getdata(esafile, 1)
-        ewave = fits.getdata(esafile, 4)
-        edy = fits.getdata(esafile, 5)
-        emsax = fits.getdata(esafile, 6)
-        emsay = fits.getdata(esafile, 7)
-        esahdulist.close()
-        n_p = np.shape(eflux)
-        nex = n_p[1]
-        ney = n_p[0]
-        # get the origin of the subwindow
-        ex0 = esahdr1["CRVAL1"] - esahdr1["CRPIX1"] + 1
-        ey0 = esahdr1["CRVAL2"] - esahdr1["CRPIX2"] + 1
-        ex = np.arange(nex) + ex0
-        ey = np.arange(ney) + ey0
-        print("ESA subwindow corner pixel ID: ", ex0, ey0)
-        if debug:
-            print("From ESA file: ")
-            print("   ex0 =", ex0)
-            print("   ey0 =", ey0)
-            print("   ex=", ex, "   ey=", ey)
-
-        # match up the correct elements in each data set
-        subpx, subex = auxfunc.do_idl_match(px, ex)
-        subpy, subey = auxfunc.do_idl_match(py, ey)
-        imp, ime = [], []
-        for spy in subpy:
-            im0 = subpx + npx * spy
-            imp.append(im0)
-        for sey in subey:
-            im0 = subex + nex * sey
-            ime.append(im0)
-        imp, ime = np.array(imp), np.array(ime)
-        imp, ime  = imp.flatten(), ime.flatten()
-
-        if debug:
-            print ("SAHPES subpx, subex: ", np.shape(subpx), np.shape(subex))
-            print ("SHAPES subpy, subey: ", np.shape(subpy), np.shape(subey))
-
-
-        # get the difference between the two in units of m
-        # do not include pixels where one or the other solution is 0 or NaN
-        flat_pwave, flat_ewave = pwave.flatten(), ewave.flatten()
-        ig = []
-        for ip, ie, ig_i in zip(imp, ime, range(len(imp))):
-            if all( [flat_pwave[ip] != 0 and flat_ewave[ie].size != 0 and np.isfinite(flat_pwave[ip]) and np.isfinite(flat_ewave[ip])] ):
-                ig.append(ig_i)
-
-        delwave = []
-        for ig_i in ig:
-            delw = flat_pwave[imp[ig_i]] - flat_ewave[ime[ig_i]]
-            delwave.append(delw)
-        delwave = np.array(delwave)
-
-        pxr, pyr = np.array([]), np.array([])
-        for _ in range(npy):
-            pxr = np.concatenate((pxr, px))
-        pxr = pxr.astype(int)
-        reshaped_py = py.reshape(npy, 1)
-        for rpy_i in reshaped_py:
-            for _ in range(npx):
-                pyr = np.concatenate((pyr, rpy_i))
-        pyr = pyr.astype(int)
-
-        if debug:
-            print("shapes of px, py: ", np.shape(px), np.shape(py))
-            print("shapes of pxr, pyr: ", np.shape(pxr), np.shape(pyr))
-            print("shapes of pdy, edy: ", np.shape(pdy), np.shape(edy))
-            print("shapes of ig, delwave: ", np.shape(ig), np.shape(delwave))
-            print("shapes of pwave, ewave, imp, ime: ", np.shape(pwave), np.shape(ewave), np.shape(imp), np.shape(ime))
-
-        for dw in delwave:
-            if not np.isfinite(dw):
-                print("Got a NaN!, median and standard deviation will fail.")
-
-        pxrg, pyrg, deldy = [], [], []
-        flat_pdy, flat_edy = pdy.flatten(), edy.flatten()
-        for ig_i in ig:
-            pxrg_i = pxr[imp[ig_i]]
-            pxrg.append(pxrg_i)
-            pyrg_i = pyr[imp[ig_i]]
-            pyrg.append(pyrg_i)
-            deldy_i = flat_pdy[imp[ig_i]] - flat_edy[ime[ig_i]]
-            deldy.append(deldy_i)
-        pxrg, pyrg, deldy = np.array(pxrg), np.array(pyrg), np.array(deldy)
+        if not np.all(np.isfinite(delwave)):
+            print("Got a NaN!, median and standard deviation will fail.")
 
         # get the median and standard deviations
         median_diff = False
@@ -448,8 +339,8 @@ def compare_wcs(infile_name, esa_files_path=None, auxiliary_code_path=None,
             xmax2 = max(deldy) + (max(deldy)-min(deldy))*0.1
             xlabel2, ylabel2 = r"$\Delta y_{pipe}$ - $\Delta y_{ESA}$ (relative slit position)", "N"
             info_fig2 = [xlabel2, ylabel2, deldy, yarr, xmin2, xmax2, bins, deldy_median, deldy_stddev]
-            mk_plots(title, info_fig1=info_fig1, info_fig2=info_fig2, show_figs=show_figs, save_figs=save_figs,
-                     histogram=True, fig_name=hist_name)
+            auxfunc.make_plot(plot_queue, mk_plots, title=title, info_fig1=info_fig1, info_fig2=info_fig2,
+                              show_figs=show_figs, save_figs=save_figs, histogram=True, fig_name=hist_name)
 
             # DELTAS PLOT
             print("\n Making deltas plot...")
@@ -458,21 +349,16 @@ def compare_wcs(infile_name, esa_files_path=None, auxiliary_code_path=None,
             info_fig1 = [title1, xlabel1, ylabel1, pxrg, pyrg, delwave, delwave_median, delwave_stddev]
             title2, xlabel2, ylabel2 = "Relative slit position", "x (pixels)", "y (pixels)"
             info_fig2 = [title2, xlabel2, ylabel2, pxrg, pyrg, deldy, deldy_median, deldy_stddev]
-            mk_plots(title, info_fig1=info_fig1, info_fig2=info_fig2, show_figs=show_figs, save_figs=save_figs,
-                     deltas_plt=True, fig_name=deltas_name)
+            auxfunc.make_plot(plot_queue, mk_plots, title=title, info_fig1=info_fig1, info_fig2=info_fig2,
+                              show_figs=show_figs, save_figs=save_figs, deltas_plt=True, fig_name=deltas_name)
 
             # MSA COLOR MAP
             print("\n Making color map...")
             title = "MSA Color Map"
             xlabel, ylabel = "MSA_x (m)", "MSA_y (m)"
-            emsax, emsay = emsax.flatten(), emsay.flatten()
-            arrx, arry = [], []
-            for ig_i in ig:
-                arrx.append(emsax[ime[ig_i]])
-                arry.append(emsay[ime[ig_i]])
-            info_fig1 = [xlabel, ylabel, arrx, arry, delwave]
-            mk_plots(title, info_fig1=info_fig1, show_figs=show_figs, save_figs=save_figs,
-                     msacolormap=True, fig_name=msacolormap_name)
+            info_fig1 = [xlabel, ylabel, deltas.msax, deltas.msay, delwave]
+            auxfunc.make_plot(plot_queue, mk_plots, title=title, info_fig1=info_fig1, show_figs=show_figs,
+                              save_figs=save_figs, msacolormap=True, fig_name=msacolormap_name)
 
             print("Done.")
 
@@ -482,6 +368,8 @@ def compare_wcs(infile_name, esa_files_path=None, auxiliary_code_path=None,
             if len(delwave) == 0:
                 print ("NO plots were made because the delta_wavelength array is emtpy.  \n")
 
+    auxfunc.finish_plot_queue(plot_queue)
+
     return median_diff
 
 
@@ -1,11 +1,10 @@
 import numpy as np
-import os
 import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib.ticker import MaxNLocator
 from astropy.io import fits
-from jwst.assign_wcs.tools.nirspec import compute_world_coordinates
 from . import auxiliary_functions as wcsfunc
+from .. import core_utils
 
 
 """
@@ -65,29 +64,9 @@ def mk_plots(title, show_figs=True, save_figs=False, info_fig1=None, info_fig2=N
             mean_plus_half_std = x_median + 0.5*x_stddev
             mean_plus_1half_std = x_median + 1.5*x_stddev
 
-            for xd, xi, yi in zip(xdelta, xarr1, yarr1):
-                if xd > mean_plus_1half_std:
-                    plt.plot(xi, yi, linewidth=7, marker='D', color='red')#, label="")
-                if xd < mean_minus_1half_std:
-                    plt.plot(xi, yi, linewidth=7, marker='D', color='fuchsia')#, label="")
-                if (xd > mean_minus_1half_std) and (xd < mean_minus_half_std):
-                    plt.plot(xi, yi, linewidth=7, marker='D', color='blue')#, label="")
-                if (xd > mean_minus_half_std) and (xd < mean_plus_half_std):
-                    plt.plot(xi, yi, linewidth=7, marker='D', color='lime')#, label="")
-                if (xd > mean_plus_half_std) and (xd < mean_plus_1half_std):
-                    plt.plot(xi, yi, linewidth=7, marker='D', color='black')#, label="")
-            '''
-            idx_red = np.where(xdelta > mean_plus_1half_std)
-            idx_fuchsia = np.where(xdelta < mean_minus_1half_std)
-            idx_blue = np.where((xdelta > mean_minus_1half_std) & (xdelta < mean_minus_half_std))
-            idx_lime = np.where((xdelta > mean_minus_half_std) & (xdelta < mean_plus_half_std))
-            idx_black = np.where((xdelta > mean_plus_half_std) & (xdelta < mean_plus_1half_std))
-            plt.plot(xarr1[idx_red], yarr1[idx_red], linewidth=7, marker='D', color='red')#, label="")
-            plt.plot(xarr1[idx_fuchsia], yarr1[idx_fuchsia], linewidth=7, marker='D', color='fuchsia')#, label="")
-            plt.plot(xarr1[idx_blue], yarr1[idx_blue], linewidth=7, marker='D', color='blue')#, label="")
-            plt.plot(xarr1[idx_lime], yarr1[idx_lime], linewidth=7, marker='D', color='lime')#, label="")
-            plt.plot(xarr1[idx_black], yarr1[idx_black], linewidth=7, marker='D', color='black')#, label="")
-            '''
+            band_limits = [mean_minus_1half_std, mean_minus_half_std,
+                           mean_plus_half_std, mean_plus_1half_std]
+            wcsfunc.plot_sigma_bands(ax, xarr1, yarr1, xdelta, band_limits)
             # add legend
             #box = ax.get_position()
             #ax.set_position([box.x0, box.y0, box.width * 1.0, box.height])
@@ -127,17 +106,9 @@ def mk_plots(title, show_figs=True, save_figs=False, info_fig1=None, info_fig2=N
             mean_minus_half_std = y_median - 0.5*y_stddev
             mean_plus_half_std = y_median + 0.5*y_stddev
             mean_plus_1half_std = y_median + 1.5*y_stddev
-            for yd, xi, yi in zip(ydelta, xarr2, yarr2):
-                if yd > mean_plus_1half_std:
-                    plt.plot(xi, yi, linewidth=7, marker='D', color='red')#, label="")
-                if yd < mean_minus_1half_std:
-                    plt.plot(xi, yi, linewidth=7, marker='D', color='fuchsia')#, label="")
-                if (yd > mean_minus_1half_std) and (yd < mean_minus_half_std):
-                    plt.plot(xi, yi, linewidth=7, marker='D', color='blue')#, label="")
-                if (yd > mean_minus_half_std) and (yd < mean_plus_half_std):
-                    plt.plot(xi, yi, linewidth=7, marker='D', color='lime')#, label="")
-                if (yd > mean_plus_half_std) and (yd < mean_plus_1half_std):
-                    plt.plot(xi, yi, linewidth=7, marker='D', color='black')#, label=r"$\mu+0.5*\sigma$ > $\mu+1.5*\sigma$")
+            band_limits = [mean_minus_1half_std, mean_minus_half_std,
+                           mean_plus_half_std, mean_plus_1half_std]
+            wcsfunc.plot_sigma_bands(ax, xarr2, yarr2, ydelta, band_limits)
             # add legend
             #box = ax.get_position()
             #ax.set_position([box.x0, box.y0, box.width * 1.0, box.height])
@@ -159,17 +130,7 @@ def mk_plots(title, show_figs=True, save_figs=False, info_fig1=None, info_fig2=N
         plt.ylim(-0.0010, 0.0010)
         #plt.xticks(np.arange(min(xarr), max(xarr), xarr[0]*5))
         #plt.yticks(np.arange(min(yarr), max(yarr), 0.000005))
-        for xd, xi, yi in zip(xdelta, xarr, yarr):
-            if xd > lim_d:
-                plt.plot(xi, yi, linewidth=7, marker='D', color='red')#, label="")
-            if xd < lim_a:
-                plt.plot(xi, yi, linewidth=7, marker='D', color='fuchsia')#, label="")
-            if (xd > lim_a) and (xd < lim_b):
-                plt.plot(xi, yi, linewidth=7, marker='D', color='blue')#, label="")
-            if (xd > lim_b) and (xd < lim_c):
-                plt.plot(xi, yi, linewidth=7, marker='D', color='lime')#, label="")
-            if (xd > lim_c) and (xd < lim_d):
-                plt.plot(xi, yi, linewidth=7, marker='D', color='black')#, label="")
+        wcsfunc.plot_sigma_bands(ax, xarr, yarr, xdelta, [lim_a, lim_b, lim_c, lim_d])
         # Shrink current axis
         box = ax.get_position()
         #percent = 0.85
@@ -197,8 +158,137 @@ def mk_plots(title, show_figs=True, save_figs=False, info_fig1=None, info_fig2=N
     plt.close()
 
 
+def compare_slitlet(i, wc=None, det=None, msa_conf=None, esa_files_path=None, raw_data_root_file=None,
+                    debug=False):
+    """
+    This function compares the world coordinates of the slitlet in the given extension of the world coordinates
+    file with the corresponding ESA file. It only depends on its arguments, so the slitlets can be compared in
+    parallel (see wcsfunc.run_in_pool).
+    Args:
+        i: integer, extension of the world coordinates file
+        wc: WorldCoordinates, headers and data of the world coordinates file
+        det: string, detector (NRS1 or NRS2)
+        msa_conf: MSAShutterConf, index of the MSA shutter configuration
+        esa_files_path: str, full path of where to find all ESA intermediary products
+        raw_data_root_file: string, raw data file used to find the corresponding ESA file
+        debug: boolean, if true a series of print statements will show on-screen
+
+    Returns:
+        slitlet_id: string, row and column of the slitlet shutter
+        deltas: SubwindowDeltas, pipeline minus ESA values of the slitlet
+    """
+    pslit, quad, row, col = msa_conf.slitlet_id, msa_conf.quadrant, msa_conf.row, msa_conf.column
+    slitlet_idx = i-1
+    slitlet_id = repr(row[slitlet_idx])+"_"+repr(col[slitlet_idx])
+    print ('pslit=', pslit, "   quad=", quad, "   row=", row, "   col=", col, "   slitlet_id=", slitlet_id)
+
+    # check that the slitlet is in this exposure
+    wcslit = int(core_utils.get_snapshot_val(wc.headers, "SLIT", i))
+    ims = msa_conf.slitlet_shutters[wcslit]
+    # get slitlet in this exposure
+    row_str = str(row[ims[0]])
+    col_str = str(col[ims[0]])
+    if len(ims) != 0:
+        if len(row_str) == 1:
+            row_str = "00"+row_str
+        elif len(row_str) == 2:
+            row_str = "0"+row_str
+        if len(col_str) == 1:
+            col_str = "00"+col_str
+        elif len(col_str) == 2:
+            col_str = "0"+col_str
+    #print("row_str, col_str: ", row_str, col_str)
+    #slitlet_id = repr(quad[ims])+"_"+row_str+col_str
+    #print ("Slitlet name: ", slitlet_id)
+
+    # get wavelength (convert from microns to m)
+    fdata = wc.data[i]
+    pwave = fdata[0,:,:] * 1.0e-6
+    pdy = fdata[3,:,:]
+
+    # get the subwindow origin
+    px0 = core_utils.get_snapshot_val(wc.headers, "CRVAL1", 1)
+    py0 = core_utils.get_snapshot_val(wc.headers, "CRVAL2", 1)
+    #if debug:
+    print ("subwindow origin:    px0=",px0, "   py0=", py0)
+
+    n_p = np.shape(pwave)
+    #print(np.shape(pwave))
+    npx = n_p[1]
+    npy = n_p[0]
+    px = np.arange(npx)+px0
+    py = np.arange(npy)+py0
+    if debug:
+        print  ("px =", px)
+        print  ("px0+npx-1 =", px0+npx-1)
+        print  ("py =", py)
+        print  ("py0+npy-1 =", py0+npy-1)
+
+    # read in the ESA file using raw data root file name
+    #rawdatroot = fits.getval(extract_2d_file, "rawdatrt", 0)
+    q, r, c = quad[slitlet_idx], row[slitlet_idx], col[slitlet_idx]
+    specifics = [q, r, c]
+    esafile = wcsfunc.get_esafile(esa_files_path, raw_data_root_file, "MOS", specifics)
+
+    esahdulist = fits.open(esafile)
+    print ("* ESA file contents ")
+    esahdulist.info()
+    esahdr1 = esahdulist[1].header
+    enext = []
+    for ext in esahdulist:
+        enext.append(ext)
+    eflux = fits.getdata(esafile, 1)
+    ewave = fits.getdata(esafile, 4)
+    edy = fits.getdata(esafile, 5)
+    emsax = fits.getdata(esafile, 6)
+    emsay = fits.getdata(esafile, 7)
+    # second set of extensions for NRS2, if NRS1 data exists
+    if det == "NRS2":
+        if esahdr1["EXTNAME"] == "DATA1":
+            eflux = fits.getdata(esafile, 8)
+            ewave = fits.getdata(esafile, 11)
+            edy = fits.getdata(esafile, 12)
+            emsax = fits.getdata(esafile, 13)
+            emsay = fits.getdata(esafile, 14)
+    esahdulist.close()
+    n_p = np.shape(eflux)
+    nex = n_p[1]
+    ney = n_p[0]
+
+    # get the origin of the subwindow
+    if det == "NRS1":
+        ex0 = esahdr1["CRVAL1"] - esahdr1["CRPIX1"] + 1
+        ey0 = esahdr1["CRVAL2"] - esahdr1["CRPIX2"] + 1
+    else:
+        ex0 = 2049.0 - (esahdr1["CRPIX1"] - esahdr1["CRVAL1"] + 1)
+        ey0 = 2049.0 - (esahdr1["CRPIX2"] - esahdr1["CRVAL2"] + 1)
+    ex = np.arange(nex) + ex0
+    ey = np.arange(ney) + ey0
+    print("ESA subwindow corner pixel ID: ", ex0, ey0)
+    if debug:
+        print ("ex0 =", ex0)
+        print ("ex0+nex-1 =", ex0+nex-1)
+        print ("ey0 =", ey0)
+        print ("ey0+ney-1 =", ey0+ney-1)
+        print ("ex=", ex, "   ey=", ey)
+
+    # match up the correct elements in each data set and get the difference between the two in units of m
+    # (do not include pixels where one or the other solution is 0 or NaN)
+    deltas = wcsfunc.compare_subwindows([px0, py0, pwave, pdy], [ex0, ey0, ewave, edy, emsax, emsay])
+    delwave = deltas.delwave
+    if debug:
+        print("shapes of px, py: ", np.shape(px), np.shape(py))
+        print("shapes of pdy, edy: ", np.shape(pdy), np.shape(edy))
+        print("shapes of pwave, ewave, delwave: ", np.shape(pwave), np.shape(ewave), np.shape(delwave))
+
+    if not np.all(np.isfinite(delwave)):
+        print("Got a NaN!, median and standard deviation will fail.")
+
+    return slitlet_id, deltas
+
+
 def compare_wcs(infile_name, msa_conf_name=None, esa_files_path=None, auxiliary_code_path=None,
-                show_figs=True, save_figs=False, plot_names=None, threshold_diff=1.0e-14, debug=False):
+                show_figs=True, save_figs=False, plot_names=None, threshold_diff=1.0e-14, debug=False, n_workers=1):
     """
     This function does the WCS comparison from the world coordinates calculated using the
     compute_world_coordinates.py script with the ESA files. The function calls that script.
@@ -215,6 +305,7 @@ def compare_wcs(infile_name, msa_conf_name=None, esa_files_path=None, auxiliary_
                     default)
         threshold_diff: float, threshold difference between pipeline output and ESA file
         debug: boolean, if true a series of print statements will show on-screen
+        n_workers: integer, number of processes to compare the slitlets in parallel (1 runs them serially)
 
     Returns:
         - 3 plots, if told to save and/or show them.
@@ -224,225 +315,48 @@ def compare_wcs(infile_name, msa_conf_name=None, esa_files_path=None, auxiliary_
 
     # get info from the rate file header
     rate_file = infile_name.replace("_assign_wcs_extract_2d", "")
-    det = fits.getval(rate_file, "DETECTOR", 0)
+    rate_hdrs = core_utils.read_header_snapshot(rate_file, extensions=[0])
+    det = core_utils.get_snapshot_val(rate_hdrs, "DETECTOR")
     print('infile_name=', rate_file)
-    msametfl = fits.getval(rate_file, "MSAMETFL", 0)
-    lamp = fits.getval(rate_file, "LAMP", 0)
-    grat = fits.getval(rate_file, "GRATING", 0)
-    filt = fits.getval(rate_file, "FILTER", 0)
+    msametfl = core_utils.get_snapshot_val(rate_hdrs, "MSAMETFL")
+    lamp = core_utils.get_snapshot_val(rate_hdrs, "LAMP")
+    grat = core_utils.get_snapshot_val(rate_hdrs, "GRATING")
+    filt = core_utils.get_snapshot_val(rate_hdrs, "FILTER")
     print ("rate_file  -->     Grating:", grat, "   Filter:", filt, "   Lamp:", lamp)
 
     # get shutter info from metadata
-    shutter_info = fits.getdata(msa_conf_name, ext=2)
-    pslit = shutter_info.field("slitlet_id")
-    quad = shutter_info.field("shutter_quadrant")
-    row = shutter_info.field("shutter_row")
-    col = shutter_info.field("shutter_column")
+    msa_conf = wcsfunc.read_msa_shutter_conf(msa_conf_name)
     print ('Using this MSA shutter configuration file: ', msa_conf_name)
 
-    # Run compute_world_coordinates.py in order to produce the necessary file
+    # get the world coordinates of the extract_2d file (compute_world_coordinates.py is only run if they were not
+    # computed before for a product with the same WCS, see auxfunc.get_world_coordinates)
     # !!! note that the code expects to be in the build environment !!!
     if auxiliary_code_path is None:
         auxiliary_code_path = "./"
+    wc = wcsfunc.get_world_coordinates(infile_name)
 
-    compute_world_coordinates.compute_world_coordinates(infile_name)
-
-    # The world coordinate file was created but it needs to be renamed
-    basenameinfile_name = os.path.basename(infile_name)
-    fileID = basenameinfile_name.split("_")[0]   # obtain the id of the file
-    working_dir_path = os.getcwd()
-    wcoordfile = working_dir_path+"/"+fileID+"_world_coordinates.fits"
-    #print ("*** wcoordfile = ", wcoordfile)
-    # to move file to location of infile
-    #cwc_fname = infile_name.replace(".fits", "_world_coordinates.fits")
-    # to rename file within the working directory
-    #cwc_fname = basenameinfile_name.replace(".fits", "_world_coordinates_James.fits")   # FOR TESTING THE CODE
-    #cwc_fname = basenameinfile_name.replace(".fits", "_world_coordinates_b7.fits")
-    cwc_fname = basenameinfile_name.replace(".fits", "_world_coordinates.fits")
-    #print ("*** cwc_fname = ", cwc_fname)
-    cwc_fname = infile_name.replace(basenameinfile_name, cwc_fname)
-    os.system("mv "+wcoordfile+" "+cwc_fname)
-
-    # get info from the extract_2d file header
-    #extract_2d_file = cwc_fname.replace("_world_coordinates_James", "")
-    #extract_2d_file = cwc_fname.replace("_world_coordinates_b7", "")
-    extract_2d_file = cwc_fname.replace("_world_coordinates", "")
+    # get info from the extract_2d file header (the world coordinates file is in the cache, named by its key)
+    extract_2d_file = infile_name
     print('extract_2d_file=', extract_2d_file)
-    det_extract_2d_file = fits.getval(extract_2d_file, "DETECTOR", 0)
-    lamp_extract_2d_file = fits.getval(extract_2d_file, "LAMP", 0)
-    grat_extract_2d_file = fits.getval(extract_2d_file, "GRATING", 0)
-    filt_extract_2d_file = fits.getval(extract_2d_file, "FILTER", 0)
+    extract_2d_hdrs = core_utils.read_header_snapshot(extract_2d_file, extensions=[0])
+    det_extract_2d_file = core_utils.get_snapshot_val(extract_2d_hdrs, "DETECTOR")
+    lamp_extract_2d_file = core_utils.get_snapshot_val(extract_2d_hdrs, "LAMP")
+    grat_extract_2d_file = core_utils.get_snapshot_val(extract_2d_hdrs, "GRATING")
+    filt_extract_2d_file = core_utils.get_snapshot_val(extract_2d_hdrs, "FILTER")
     print ("extract_2d_file ->  Grating:", grat_extract_2d_file, "    Filter:", filt_extract_2d_file,
            "    Lamp:", lamp_extract_2d_file)
 
-    # loop over the slitlets
-    wchdu = fits.open(cwc_fname)
-    n_ext = len(wchdu)
-    for i in range(1, n_ext):
-        slitlet_idx = i-1
-        slitlet_id = repr(row[slitlet_idx])+"_"+repr(col[slitlet_idx])
-        print ('pslit=', pslit, "   quad=", quad, "   row=", row, "   col=", col, "   slitlet_id=", slitlet_id)
-
-        # check that the slitlet is in this exposure
-        hdr = wchdu[i].header
-        wcslit = int(hdr["SLIT"])
-        ims = np.where(np.array(pslit, dtype=int) == wcslit)
-        # get slitlet in this exposure
-        row_str = str(row[ims][0])
-        col_str = str(col[ims][0])
-        if ims[0].size != 0:
-            row, col = np.array(row), np.array(col)
-            if len(row_str) == 1:
-                row_str = "00"+row_str
-            elif len(row_str) == 2:
-                row_str = "0"+row_str
-            if len(col_str) == 1:
-                col_str = "00"+col_str
-            elif len(col_str) == 2:
-                col_str = "0"+col_str
-        #print("row_str, col_str: ", row_str, col_str)
-        #slitlet_id = repr(quad[ims])+"_"+row_str+col_str
-        #print ("Slitlet name: ", slitlet_id)
-
-        # get wavelength (convert from microns to m)
-        fdata = wchdu[i].data
-        pwave = fdata[0,:,:] * 1.0e-6
-        pdy = fdata[3,:,:]
-        pmsax = fdata[1,:,:]
-        pmsay = fdata[2,:,:]
-
-        # get the subwindow origin
-        px0 = fits.getval(cwc_fname, "CRVAL1", 1)
-        py0 = fits.getval(cwc_fname, "CRVAL2", 1)
-        #if debug:
-        print ("subwindow origin:    px0=",px0, "   py0=", py0)
-
-        # get the count rates for this spectrum
-        counts = fits.getdata(rate_file, 1)
-        n_p = np.shape(pwave)
-        #print(np.shape(pwave))
-        npx = n_p[1]
-        npy = n_p[0]
-        px = np.arange(npx)+px0
-        py = np.arange(npy)+py0
-        if debug:
-            print  ("px =", px)
-            print  ("px0+npx-1 =", px0+npx-1)
-            print  ("py =", py)
-            print  ("py0+npy-1 =", py0+npy-1)
-
-        # read in the ESA file using raw data root file name
-        #rawdatroot = fits.getval(extract_2d_file, "rawdatrt", 0)
-        _, raw_data_root_file = wcsfunc.get_modeused_and_rawdatrt_PTT_cfg_file()
-        print("Using this raw data file to find the corresponding ESA file: ", raw_data_root_file)
-        q, r, c = quad[slitlet_idx], row[slitlet_idx], col[slitlet_idx]
-        specifics = [q, r, c]
-        esafile = wcsfunc.get_esafile(esa_files_path, raw_data_root_file, "MOS", specifics)
-
-        esahdulist = fits.open(esafile)
-        print ("* ESA file contents ")
-        esahdulist.info()
-        esahdr1 = esahdulist[1].header
-        enext = []
-        for ext in esahdulist:
-            enext.append(ext)
-        eflux = fits.getdata(esafile, 1)
-        ewave = fits.getdata(esafile, 4)
-        edy = fits.getdata(esafile, 5)
-        emsax = fits.getdata(esafile, 6)
-        emsay = fits.getdata(esafile, 7)
-        # second set of extensions for NRS2, if NRS1 data exists
-        if det == "NRS2":
-            if esahdr1["EXTNAME"] == "DATA1":
-                eflux = fits.getdata(esafile, 8)
-                ewave = fits.getdata(esafile, 11)
-                edy = fits.getdata(esafile, 12)
-                emsax = fits.getdata(esafile, 13)
-                emsay = fits.getdata(esafile, 14)
-        esahdulist.close()
-        n_p = np.shape(eflux)
-        nex = n_p[1]
-        ney = n_p[0]
-
-        # get the origin of the subwindow
-        if det == "NRS1":
-            ex0 = esahdr1["CRVAL1"] - esahdr1["CRPIX1"] + 1
-            ey0 = esahdr1["CRVAL2"] - esahdr1["CRPIX2"] + 1
-        else:
-            ex0 = 2049.0 - (esahdr1["CRPIX1"] - esahdr1["CRVAL1"] + 1)
-            ey0 = 2049.0 - (esahdr1["CRPIX2"] - esahdr1["CRVAL2"] + 1)
-        ex = np.arange(nex) + ex0
-        ey = np.arange(ney) + ey0
-        print("ESA subwindow corner pixel ID: ", ex0, ey0)
-        if debug:
-            print ("ex0 =", ex0)
-            print ("ex0+nex-1 =", ex0+nex-1)
-            print ("ey0 =", ey0)
-            print ("ey0+ney-1 =", ey0+ney-1)
-            print ("ex=", ex, "   ey=", ey)
-
-        # match up the correct elements in each data set
-        subpx, subex = wcsfunc.do_idl_match(px, ex)
-        subpy, subey = wcsfunc.do_idl_match(py, ey)
-        imp, ime = [], []
-        for spy in subpy:
-            im0 = subpx + npx * spy
-            imp.append(im0)
-        for sey in subey:
-            im0 = subex + nex * sey
-            ime.append(im0)
-        imp, ime = np.array(imp), np.array(ime)
-        imp, ime  = imp.flatten(), ime.flatten()
-
-        if debug:
-            print ("SAHPES subpx, subex: ", np.shape(subpx), np.shape(subex))
-            print ("SHAPES subpy, subey: ", np.shape(subpy), np.shape(subey))
-
-        # get the difference between the two in units of m
-        # do not include pixels where one or the other solution is 0 or NaN
-        flat_pwave, flat_ewave = pwave.flatten(), ewave.flatten()
-        ig = []
-        for ip, ie, ig_i in zip(imp, ime, range(len(imp))):
-            if all( [flat_pwave[ip] != 0 and flat_ewave[ie].size != 0 and np.isfinite(flat_pwave[ip]) and np.isfinite(flat_ewave[ip])] ):
-                ig.append(ig_i)
-
-        delwave = []
-        for ig_i in ig:
-            delw = flat_pwave[imp[ig_i]] - flat_ewave[ime[ig_i]]
-            delwave.append(delw)
-        delwave = np.array(delwave)
-
-        pxr, pyr = np.array([]), np.array([])
-        for _ in range(npy):
-            pxr = np.concatenate((pxr, px))
-        pxr = pxr.astype(int)
-        reshaped_py = py.reshape(npy, 1)
-        for rpy_i in reshaped_py:
-            for _ in range(npx):
-                pyr = np.concatenate((pyr, rpy_i))
-        pyr = pyr.astype(int)
-
-        if debug:
-            print("shapes of px, py: ", np.shape(px), np.shape(py))
-            print("shapes of pxr, pyr: ", np.shape(pxr), np.shape(pyr))
-            print("shapes of pdy, edy: ", np.shape(pdy), np.shape(edy))
-            print("shapes of ig, delwave: ", np.shape(ig), np.shape(delwave))
-            print("shapes of pwave, ewave, imp, ime: ", np.shape(pwave), np.shape(ewave), np.shape(imp), np.shape(ime))
-
-        for dw in delwave:
-            if not np.isfinite(dw):
-                print("Got a NaN!, median and standard deviation will fail.")
-
-        pxrg, pyrg, deldy = [], [], []
-        flat_pdy, flat_edy = pdy.flatten(), edy.flatten()
-        for ig_i in ig:
-            pxrg_i = pxr[imp[ig_i]]
-            pxrg.append(pxrg_i)
-            pyrg_i = pyr[imp[ig_i]]
-            pyrg.append(pyrg_i)
-            deldy_i = flat_pdy[imp[ig_i]] - flat_edy[ime[ig_i]]
-            deldy.append(deldy_i)
-        pxrg, pyrg, deldy = np.array(pxrg), np.array(pyrg), np.array(deldy)
+    # compare each slitlet, in parallel if n_workers > 1; the results come back in the order of the extensions, so
+    # the statistics and plots are the same as in a serial run
+    _, raw_data_root_file = wcsfunc.get_modeused_and_rawdatrt_PTT_cfg_file()
+    print("Using this raw data file to find the corresponding ESA file: ", raw_data_root_file)
+    slitlet_data = dict(wc=wc, det=det, msa_conf=msa_conf, esa_files_path=esa_files_path,
+                        raw_data_root_file=raw_data_root_file, debug=debug)
+    wc_exts = list(range(1, len(wc.headers.headers)))
+    # the figures that are only saved are rendered in the background while the next slitlets are compared
+    plot_queue = wcsfunc.start_plot_queue(show_figs, save_figs, n_workers=n_workers)
+    for slitlet_id, deltas in wcsfunc.run_in_pool(compare_slitlet, wc_exts, slitlet_data, n_workers=n_workers):
+        delwave, deldy, pxrg, pyrg = deltas.delwave, deltas.deldy, deltas.pxrg, deltas.pyrg
 
         # get the median and standard deviations
         median_diff = False
@@ -487,8 +401,8 @@ def compare_wcs(infile_name, msa_conf_name=None, esa_files_path=None, auxiliary_
             xmax2 = max(deldy) + (max(deldy)-min(deldy))*0.1
             xlabel2, ylabel2 = r"$\Delta y_{pipe}$ - $\Delta y_{ESA}$ (relative slit position)", "N"
             info_fig2 = [xlabel2, ylabel2, deldy, yarr, xmin2, xmax2, bins, deldy_median, deldy_stddev]
-            mk_plots(title, info_fig1=info_fig1, info_fig2=info_fig2, show_figs=show_figs, save_figs=save_figs,
-                     histogram=True, fig_name=hist_name)
+            wcsfunc.make_plot(plot_queue, mk_plots, title=title, info_fig1=info_fig1, info_fig2=info_fig2,
+                              show_figs=show_figs, save_figs=save_figs, histogram=True, fig_name=hist_name)
 
             # DELTAS PLOT
             title = ""
@@ -496,20 +410,15 @@ def compare_wcs(infile_name, msa_conf_name=None, esa_files_path=None, auxiliary_
             info_fig1 = [title1, xlabel1, ylabel1, pxrg, pyrg, delwave, delwave_median, delwave_stddev]
             title2, xlabel2, ylabel2 = "Relative slit position", "x (pixels)", "y (pixels)"
             info_fig2 = [title2, xlabel2, ylabel2, pxrg, pyrg, deldy, deldy_median, deldy_stddev]
-            mk_plots(title, info_fig1=info_fig1, info_fig2=info_fig2, show_figs=show_figs, save_figs=save_figs,
-                     deltas_plt=True, fig_name=deltas_name)
+            wcsfunc.make_plot(plot_queue, mk_plots, title=title, info_fig1=info_fig1, info_fig2=info_fig2,
+                              show_figs=show_figs, save_figs=save_figs, deltas_plt=True, fig_name=deltas_name)
 
             # MSA COLOR MAP
             title = "MSA Color Map"
             xlabel, ylabel = "MSA_x (m)", "MSA_y (m)"
-            emsax, emsay = emsax.flatten(), emsay.flatten()
-            arrx, arry = [], []
-            for ig_i in ig:
-                arrx.append(emsax[ime[ig_i]])
-                arry.append(emsay[ime[ig_i]])
-            info_fig1 = [xlabel, ylabel, arrx, arry, delwave]
-            mk_plots(title, info_fig1=info_fig1, show_figs=show_figs, save_figs=save_figs,
-                     msacolormap=True, fig_name=msacolormap_name)
+            info_fig1 = [xlabel, ylabel, deltas.msax, deltas.msay, delwave]
+            wcsfunc.make_plot(plot_queue, mk_plots, title=title, info_fig1=info_fig1, show_figs=show_figs,
+                              save_figs=save_figs, msacolormap=True, fig_name=msacolormap_name)
 
             print("Done.")
 
@@ -519,6 +428,8 @@ def compare_wcs(infile_name, msa_conf_name=None, esa_files_path=None, auxiliary_
             if len(delwave) == 0:
                 print ("NO plots were made because the delta_wavelength array is emtpy.  \n")
 
+    wcsfunc.finish_plot_queue(plot_queue)
+
     return median_diff
 
 
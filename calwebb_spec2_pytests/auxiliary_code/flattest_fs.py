@@ -5,6 +5,7 @@ import matplotlib.pyplot as plt
 from astropy.io import fits
 
 from . import auxiliary_functions as auxfunc
+from .. import core_utils
 
 
 """
@@ -13,30 +14,161 @@ This script tests the pipeline flat field step output for MOS data. It is the py
 """
 
 
-def reverse_cols(arr):
+def calc_pixel_bandwidth(wave):
     """
-    This function permutates the last column of the array with the first, e.g. a = [4,5,6]
-    b = reverse_cols(a) = [6,5,4].
+    This function calculates the bandwidth of every pixel of the wavelength array of a slit, using the
+    neighbouring pixels in the same row (i.e. along the dispersion direction).
     Args:
-        arr: numpy array
+        wave: 2D numpy array, wavelengths of the slit subwindow
 
     Returns:
-        rev_arr: numpy array with first and last columns reversed
+        delw: 2D numpy array, bandwidth of each pixel (NaN if neither neighbour has a finite wavelength)
     """
-    last_idx = np.shape(arr)[-1]-1
-    permutation = [last_idx]
-    for i, a in enumerate(arr):
-        if (i != 0) and (i != last_idx):
-            permutation.append(i)
-        if i == last_idx:
-            permutation.append(0)
-    p = np.argsort(permutation)
-    rev_arr = arr[:, p]
-    return rev_arr
+    prev_wave, next_wave = np.roll(wave, 1, axis=1), np.roll(wave, -1, axis=1)
+    prev_ok, next_ok = np.isfinite(prev_wave), np.isfinite(next_wave)
+    delw = np.zeros(np.shape(wave)) + np.nan
+    delw = np.where(prev_ok & next_ok, 0.5 * (next_wave - prev_wave), delw)
+    delw = np.where(next_ok & ~prev_ok, next_wave - wave, delw)
+    delw = np.where(prev_ok & ~next_ok, wave - prev_wave, delw)
+    delw[:, 0] = next_wave[:, 0] - wave[:, 0]
+    return delw
+
+
+def calc_slit_flat(wave, px0, py0, pipeflat, dflat, sflat, ffv, debug=False):
+    """
+    This function calculates the flat field for all the pixels of a slit that have a finite wavelength at once,
+    and the difference with the pipeline flat. As in the IDL script, the last row and column of the subwindow are
+    not calculated.
+    Args:
+        wave: 2D numpy array, wavelengths of the slit subwindow
+        px0: integer, full-frame x-index of the subwindow origin
+        py0: integer, full-frame y-index of the subwindow origin
+        pipeflat: 2D numpy array, pipeline-calculated flat of the slit
+        dflat: list, D-flat wavelengths, cube, DQ image, and fast vector table
+        sflat: list, S-flat image, DQ image, and fast vector table
+        ffv: F-flat fast vector table
+        debug: boolean, if true a series of print statements will show on-screen
+
+    Returns:
+        flatcor: 2D numpy array, calculated flat of each pixel (999.0 where it was not calculated)
+        delf: 2D numpy array, pipeline minus calculated flat of each pixel (999.0 where it was not calculated)
+    """
+    dfwave, dfim, dfimdq, dfrqe = dflat
+    sfim, sfimdq, sfv = sflat
+    nw2, nw1 = np.shape(wave)
+    delf = np.zeros([nw2, nw1]) + 999.0
+    flatcor = np.zeros([nw2, nw1]) + 999.0
+
+    # get the pixel indeces, skipping pixels where the wavelength is NaN
+    # **** this does not account for subarrays!
+    finite = np.isfinite(wave)
+    finite[-1, :], finite[:, -1] = False, False
+    k, j = np.where(finite)
+    jwav = wave[k, j]
+    pind = [k+py0-1, j+px0-1]
+
+    # get the pixel bandwidth
+    delw = calc_pixel_bandwidth(wave)[k, j]
+    wav_min, wav_max = jwav - delw/2.0, jwav + delw/2.0
+    if debug:
+        print ("delw = ", delw)
+
+    # integrate over D-flat fast vector
+    dff, _ = auxfunc.band_average(dfrqe.field("WAVELENGTH"), dfrqe.field("RQE"), wav_min, wav_max)
+    if debug:
+        print ("dff = ", dff)
+
+    # interpolate over D-flat cube
+    dfs, in_range = auxfunc.interp_cube(jwav, dfwave, dfim, pind[0], pind[1])
+    dfs = np.where(in_range, dfs, 1.0)
+    # check DQ flags
+    dfs[dfimdq[pind[0], pind[1]] != 0] = 1.0
+    if debug:
+        print ("dfs = ", dfs)
+
+    # integrate over S-flat fast vector
+    sff, npts = auxfunc.band_average(sfv.field("WAVELENGTH"), sfv.field("DATA"), wav_min, wav_max)
+    sff[npts <= 2] = 1.0
+
+    # get s-flat pixel-dependent correction
+    sfs = np.where(sfimdq[pind[0], pind[1]] == 0, sfim[pind[0], pind[1]], 1.0)
+    if debug:
+        print ("sff = ", sff)
+        print ("sfs = ", sfs)
+
+    # integrate over F-flat fast vector
+    # reference file blue cutoff is 1 micron, so need to force solution for shorter wavs
+    fff, npts = auxfunc.band_average(ffv.field("WAVELENGTH"), ffv.field("DATA"), wav_min, wav_max)
+    fff[(npts <= 1) | ~(wav_min >= 1.0)] = 1.0
+    if debug:
+        print ("fff = ", fff)
+
+    flatcor[k, j] = dff * dfs * sff * sfs * fff
+
+    # Difference between pipeline and calculated values, only where the pipeline flat is defined
+    inside = (k < np.shape(pipeflat)[0]) & (j < np.shape(pipeflat)[1])
+    k, j = k[inside], j[inside]
+    delf[k, j] = pipeflat[k, j] - flatcor[k, j]
+
+    # Remove all pixels with values=1 (outside slit boundaries) for statistics
+    pipe_one = pipeflat[k, j] == 1
+    delf[k[pipe_one], j[pipe_one]] = 999.0
+    flatcor[k[~pipe_one], j[~pipe_one]] = 1.0   # no correction if no wavelength
+    if debug:
+        print ("flatcor = ", flatcor)
+        print ("delf = ", delf)
+    return flatcor, delf
+
+
+def mk_hist(title, delfg, delfg_median, delfg_std, save_figs, show_figs, plot_name):
+    """
+    This function makes the histogram of the flat differences of a slit.
+    Args:
+        title: str, title of the plot
+        delfg: array, pipeline minus calculated flat values, without the outliers
+        delfg_median: float, median of delfg
+        delfg_std: float, standard deviation of delfg
+        save_figs: boolean, save the plot or not
+        show_figs: boolean, show the plot on screen or not
+        plot_name: str, path and name of the saved plot
+
+    Returns:
+        nothing
+    """
+    font = {#'family' : 'normal',
+            'weight' : 'normal',
+            'size'   : 16}
+    matplotlib.rc('font', **font)
+    alpha = 0.2
+    fontsize = 15
+    fig = plt.figure(1, figsize=(8, 6))
+    plt.subplots_adjust(hspace=.4)
+    ax = plt.subplot(111)
+    plt.title(title)
+    plt.xlabel("flat$_{pipe}$ - flat$_{calc}$")
+    plt.ylabel("N")
+    xmin = delfg_median - delfg_std*5
+    xmax = delfg_median + delfg_std*5
+    plt.xlim(xmin, xmax)
+    x_median = "median = {:0.3}".format(delfg_median)
+    x_stddev = "stddev = {:0.3}".format(delfg_std)
+    ax.text(0.65, 0.9, x_median, transform=ax.transAxes, fontsize=fontsize)
+    ax.text(0.65, 0.83, x_stddev, transform=ax.transAxes, fontsize=fontsize)
+    plt.tick_params(axis='both', which='both', bottom='on', top='on', right='on', direction='in', labelbottom='on')
+    binwidth = (xmax-xmin)/40.
+    _, _, _ = ax.hist(delfg, bins=np.arange(xmin, xmax + binwidth, binwidth), histtype='bar', ec='k', facecolor="red", alpha=alpha)
+
+    if save_figs:
+        plt.savefig(plot_name)
+        print ('\n Plot saved: ', os.path.basename(plot_name))
+    if show_figs:
+        plt.show()
+    plt.close()
 
 
 def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_path=None, writefile=False,
-             show_figs=True, save_figs=False, plot_name=None, threshold_diff=1.0e-14, debug=False):
+             show_figs=True, save_figs=False, plot_name=None, threshold_diff=1.0e-14, debug=False,
+             cache_dir=None):
     """
     This function calculates the difference between the pipeline and the calculated flat field values.
     The functions uses the output of the compute_world_coordinates.py script.
@@ -53,6 +185,8 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
                     default)
         threshold_diff: float, threshold difference between pipeline output and ESA file
         debug: boolean, if true a series of print statements will show on-screen
+        cache_dir: string, path to the directory where the reference flats are cached in science orientation
+                    (None or empty string to not use the cache)
 
     Returns:
         - 1 plot, if told to save and/or show them.
@@ -61,11 +195,12 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
     """
 
     # get info from the rate file header
-    det = fits.getval(step_input_filename, "DETECTOR", 0)
+    step_input_hdrs = core_utils.read_header_snapshot(step_input_filename, extensions=[0])
+    det = core_utils.get_snapshot_val(step_input_hdrs, "DETECTOR")
     print('step_input_filename=', step_input_filename)
-    exptype = fits.getval(step_input_filename, "EXP_TYPE", 0)
-    grat = fits.getval(step_input_filename, "GRATING", 0)
-    filt = fits.getval(step_input_filename, "FILTER", 0)
+    exptype = core_utils.get_snapshot_val(step_input_hdrs, "EXP_TYPE")
+    grat = core_utils.get_snapshot_val(step_input_hdrs, "GRATING")
+    filt = core_utils.get_snapshot_val(step_input_hdrs, "FILTER")
     print ("flat_field_file  -->     Grating:", grat, "   Filter:", filt, "   EXP_TYPE:", exptype)
 
     # read in the on-the-fly flat image
@@ -78,28 +213,15 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
     dfile = "_".join(t)
     if det == "NRS2":
         dfile = dfile.replace("nrs1", "nrs2")
-    dfim = fits.getdata(dfile, 1)
-    dfimdq = fits.getdata(dfile, 4)
     # need to flip/rotate the image into science orientation
-    ns = np.shape(dfim)
-    dfim = np.transpose(dfim, (0, 2, 1))   # keep in mind that 0,1,2 = z,y,x in Python, whereas =x,y,z in IDL
-    dfimdq = np.transpose(dfimdq)
-    if det == "NRS2":
-        dfim = reverse_cols(dfim)
-        dfim = dfim[::-1]
-        dfimdq = reverse_cols(dfimdq)
-        dfimdq = dfimdq[::-1]
-    naxis3 = fits.getval(dfile, "NAXIS3", 1)
+    dfim = auxfunc.read_reference_flat(dfile, 1, det, axes=(0, 2, 1), cache_dir=cache_dir)
+    dfimdq = auxfunc.read_reference_flat(dfile, 4, det, cache_dir=cache_dir)
     if debug:
         print('np.shape(dfim) =', np.shape(dfim))
         print('np.shape(dfimdq) =', np.shape(dfimdq))
 
     # get the wavelength values
-    dfwave = np.array([])
-    for i in range(naxis3):
-        t = ("PFLAT", str(i+1))
-        keyword = "_".join(t)
-        dfwave = np.append(dfwave, fits.getval(dfile, keyword, 1))
+    dfwave = auxfunc.get_flat_wavelengths(dfile, "PFLAT_%d")
     dfrqe = fits.getdata(dfile, 2)
 
     # S-flat
@@ -138,17 +260,10 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
 
     if det == "NRS2":
         sfile = sfile.replace("nrs1", "nrs2")
-    sfim = fits.getdata(sfile, 1)
-    sfimdq = fits.getdata(sfile, 3)
 
     # need to flip/rotate image into science orientation
-    sfim = np.transpose(sfim)
-    sfimdq = np.transpose(sfimdq)
-    if det == "NRS2":
-        sfim = np.transpose(sfim)
-        sfim = sfim[::-1]
-        sfimdq = np.transpose(sfimdq)
-        sfimdq = sfimdq[::-1]
+    sfim = auxfunc.read_reference_flat(sfile, 1, det, nrs2_op="transpose", cache_dir=cache_dir)
+    sfimdq = auxfunc.read_reference_flat(sfile, 3, det, nrs2_op="transpose", cache_dir=cache_dir)
     if debug:
         print("np.shape(sfim) = ", np.shape(sfim))
         print("np.shape(sfimdq) = ", np.shape(sfimdq))
@@ -174,8 +289,8 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
     ffv = fits.getdata(ffile, 1)
 
     # now go through each pixel in the test data
-    wc_file_name = step_input_filename.replace("_flat_field.fits", "_world_coordinates.fits")
-    wc_hdulist = fits.open(wc_file_name)
+    # (the world coordinates are the ones cached by the WCS tests, or they are computed if they are not there)
+    wc = auxfunc.get_world_coordinates(step_input_filename)
 
     if writefile:
         # create the fits list to hold the calculated flat values for each slit
@@ -190,11 +305,13 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
 
     # loop over the slits
     print ("Now looping through the slits. This may take a while... ")
-    for i, _ in enumerate(wc_hdulist):
+    # the histograms that are only saved are rendered in the background while the next slits are calculated
+    plot_queue = auxfunc.start_plot_queue(show_figs, save_figs)
+    for i, _ in enumerate(wc.headers.headers):
         ext = i+1
-        if ext >= len(wc_hdulist):
+        if ext >= len(wc.headers.headers):
             break
-        slit_id = fits.getval(wc_file_name, "SLIT", ext)
+        slit_id = core_utils.get_snapshot_val(wc.headers, "SLIT", ext)
         print("\n Working with slit: ", slit_id)
 
         # select the appropriate S-flat fast vector
@@ -210,12 +327,12 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
             sfv = sfv_b200
 
         # get the wavelength
-        wc_data = fits.getdata(wc_file_name, ext)
+        wc_data = wc.data[ext]
         wave = wc_data[0, :, :]
 
         # get the subwindow origin
-        px0 = int(fits.getval(wc_file_name, "CRVAL1", ext))
-        py0 = int(fits.getval(wc_file_name, "CRVAL2", ext))
+        px0 = int(core_utils.get_snapshot_val(wc.headers, "CRVAL1", ext))
+        py0 = int(core_utils.get_snapshot_val(wc.headers, "CRVAL2", ext))
         n_p = np.shape(wave)
         nw = n_p[0]*n_p[1]
         nw1, nw2 = n_p[1], n_p[0]   # remember that x=nw1 and y=nw2 are reversed  in Python
@@ -223,144 +340,13 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
             print ("subwindow origin:   px0=",px0, "   py0=", py0)
             print ("nw1, nw2, nw = ", nw1, nw2, nw)
 
-        delf = np.zeros([nw2, nw1]) + 999.0
-        flatcor = np.zeros([nw2, nw1]) + 999.0
-
-        # loop through the wavelengths
-        for j in range(nw1-1):   # in x
-            for k in range(nw2-1):   # in y
-                if np.isfinite(wave[k, j]):   # skip if wavelength is NaN
-                    # get thr full-frame pixel indeces for D- and S-flat image components
-                    # **** this does not account for subarrays!
-                    pind = [k+py0-1, j+px0-1]
-                    #print ("pind = ", pind)
-                    #print ("j, k = ", j, k)
-
-                    # get the pixel bandwidth
-                    if (j != 0) and (j < nw1-1):
-                        if np.isfinite(wave[k, j+1]) and np.isfinite(wave[k, j-1]):
-                            delw = 0.5 * (wave[k, j+1] - wave[k, j-1])
-                        if np.isfinite(wave[k, j+1]) and not np.isfinite(wave[k, j-1]):
-                            delw = wave[k, j+1] - wave[k, j]
-                        if not np.isfinite(wave[k, j+1]) and np.isfinite(wave[k, j-1]):
-                            delw = wave[k, j] - wave[k, j-1]
-                    if j == 0:
-                        delw = wave[k, j+1] - wave[k, j]
-                    if j == nw-1:
-                        delw = wave[k, j] - wave[k, j-1]
-                    #print ("delw = ", delw)
-
-                    # integrate over D-flat fast vector
-                    dfrqe_wav = dfrqe.field("WAVELENGTH")
-                    dfrqe_rqe = dfrqe.field("RQE")
-                    iw = np.where((dfrqe_wav >= wave[k, j]-delw/2.) & (dfrqe_wav <= wave[k, j]+delw/2.))
-                    int_tab = auxfunc.idl_tabulate(dfrqe_wav[iw], dfrqe_rqe[iw])
-                    first_dfrqe_wav, last_dfrqe_wav = dfrqe_wav[iw[0]][0], dfrqe_wav[iw[0]][-1]
-                    dff = int_tab/(last_dfrqe_wav - first_dfrqe_wav)
-
-                    if debug:
-                        print ("np.shape(dfrqe_wav) : ", np.shape(dfrqe_wav))
-                        print ("np.shape(dfrqe_rqe) : ", np.shape(dfrqe_rqe))
-                        print ("dfimdq[pind[0],[pind[1]] : ", dfimdq[pind[0],pind[1]])
-                        print ("np.shape(iw) =", np.shape(iw))
-                        print ("np.shape(dfrqe_wav) = ", np.shape(dfrqe_wav[iw]))
-                        print ("np.shape(dfrqe_rqe) = ", np.shape(dfrqe_rqe[iw]))
-                        print ("int_tab=", int_tab)
-                        print ("np.shape(dfim) = ", np.shape(dfim))
-                        print ("dff = ", dff)
-
-                    # interpolate over D-flat cube
-                    iloc = auxfunc.idl_valuelocate(dfwave, wave[k, j])[0]
-                    if dfwave[iloc] > wave[k, j]:
-                        iloc -= 1
-                    ibr = [iloc]
-                    if iloc != len(dfwave)-1:
-                        ibr.append(iloc+1)
-                    # get the values in the z-array at indeces ibr, and x=pind[1] and y=pind[0]
-                    zz = dfim[:, pind[0], pind[1]][[ibr]]
-                    # now determine the length of the array with only the finite numbers
-                    zzwherenonan = np.where(np.isfinite(zz))
-                    kk = np.size(zzwherenonan)
-                    dfs = 1.0
-                    if (wave[k, j] <= max(dfwave)) and (wave[k, j] >= min(dfwave)) and (kk == 2):
-                        dfs = np.interp(wave[k, j], dfwave[ibr], zz[zzwherenonan])
-
-                    # check DQ flags
-                    if dfimdq[pind[0]][pind[1]] != 0:
-                        dfs = 1.0
-
-                    if debug:
-                        print("wave[k, j] = ", wave[k, j])
-                        print ("iloc = ", iloc)
-                        print ("ibr = ", ibr)
-                        print ("np.interp(wave[k, j], dfwave[ibr], zz[zzwherenonan]) = ", np.interp(wave[k, j], dfwave[ibr], zz[zzwherenonan]))
-                        print ("dfs = ", dfs)
-
-                    # integrate over S-flat fast vector
-                    sfv_wav = sfv.field("WAVELENGTH")
-                    sfv_dat = sfv.field("DATA")
-                    iw = np.where((sfv_wav >= wave[k, j]-delw/2.0) & (sfv_wav <= wave[k, j]+delw/2.0))
-                    sff = 1.0
-                    if np.size(iw) > 2:
-                        int_tab = auxfunc.idl_tabulate(sfv_wav[iw], sfv_dat[iw])
-                        first_sfv_wav, last_sfv_wav = sfv_wav[iw[0]][0], sfv_wav[iw[0]][-1]
-                        sff = int_tab/(last_sfv_wav - first_sfv_wav)
-                    # get s-flat pixel-dependent correction
-                    sfs = 1.0
-                    if sfimdq[pind[0], pind[1]] == 0:
-                        sfs = sfim[pind[0], pind[1]]
-
-                    if debug:
-                        print ("np.shape(iw) =", np.shape(iw))
-                        print ("np.shape(sfv_wav) = ", np.shape(sfv_wav))
-                        print ("np.shape(sfv_dat) = ", np.shape(sfv_dat))
-                        print ("int_tab = ", int_tab)
-                        print ("sff = ", sff)
-                        print ("sfs = ", sfs)
-
-                    # integrate over F-flat fast vector
-                    # reference file blue cutoff is 1 micron, so need to force solution for shorter wavs
-                    ffv_wav = ffv.field("WAVELENGTH")
-                    ffv_dat = ffv.field("DATA")
-                    fff = 1.0
-                    if wave[k, j]-delw/2.0 >= 1.0:
-                        iw = np.where((ffv_wav >= wave[k, j]-delw/2.0) & (ffv_wav <= wave[k, j]+delw/2.0))
-                        if np.size(iw) > 1:
-                            int_tab = auxfunc.idl_tabulate(ffv_wav[iw], ffv_dat[iw])
-                            first_ffv_wav, last_ffv_wav = ffv_wav[iw[0]][0], ffv_wav[iw[0]][-1]
-                            fff = int_tab/(last_ffv_wav - first_ffv_wav)
-
-                    flatcor[k, j] = dff * dfs * sff * sfs * fff
-
-                    if debug:
-                        print ("np.shape(iw) =", np.shape(iw))
-                        print ("np.shape(ffv_wav) = ", np.shape(ffv_wav))
-                        print ("np.shape(ffv_dat) = ", np.shape(ffv_dat))
-                        print ("fff = ", fff)
-                        print ("flatcor[k, j] = ", flatcor[k, j])
-
-                    # read the pipeline-calculated flat image
-                    pipeflat = fits.getdata(flatfile, ext+(ext-1)*2)
-                    #print ("np.shape(pipeflat) = ", np.shape(pipeflat))
-
-                    try:
-                        # Difference between pipeline and calculated values
-                        delf[k, j] = pipeflat[k, j] - flatcor[k, j]
-
-                        if debug:
-                            print ("delf[k, j] = ", delf[k, j])
-
-                        # Remove all pixels with values=1 (outside slit boundaries) for statistics
-                        if pipeflat[k, j] == 1:
-                            delf[k, j] = 999.0
-                        else:
-                            flatcor[k, j] = 1.0   # no correction if no wavelength
-
-                        if debug:
-                            print ("flatcor[k, j] = ", flatcor[k, j])
-                            print ("delf[k, j] = ", delf[k, j])
-                    except:
-                        IndexError
+        # read the pipeline-calculated flat image
+        pipeflat = fits.getdata(flatfile, ext+(ext-1)*2)
+
+        # calculate the flat for all the pixels of the slit at once
+        dflat = [dfwave, dfim, dfimdq, dfrqe]
+        sflat = [sfim, sfimdq, sfv]
+        flatcor, delf = calc_slit_flat(wave, px0, py0, pipeflat, dflat, sflat, ffv, debug=debug)
 
         delfg = delf[np.where((delf != 999.0) & (delf < 0.1) & (delf > -0.1))]   # ignore outliers
         delfg_median, delfg_std = np.median(delfg), np.std(delfg)
@@ -387,44 +373,18 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
             test_result = "FAILED"
         print (" *** Result of the test: ",test_result)
 
-        # make histogram
+        # make histogram, in the background if it is only saved
         if np.isfinite(delfg_median):
-            print ("Making the plots...")
-            font = {#'family' : 'normal',
-                    'weight' : 'normal',
-                    'size'   : 16}
-            matplotlib.rc('font', **font)
-            alpha = 0.2
-            fontsize = 15
-            fig = plt.figure(1, figsize=(8, 6))
-            plt.subplots_adjust(hspace=.4)
-            ax = plt.subplot(111)
-            t = (filt, grat, slit_id)
-            plt.title("_".join(t))
-            plt.xlabel("flat$_{pipe}$ - flat$_{calc}$")
-            plt.ylabel("N")
-            xmin = delfg_median - delfg_std*5
-            xmax = delfg_median + delfg_std*5
-            plt.xlim(xmin, xmax)
-            x_median = "median = {:0.3}".format(delfg_median)
-            x_stddev = "stddev = {:0.3}".format(delfg_std)
-            ax.text(0.65, 0.9, x_median, transform=ax.transAxes, fontsize=fontsize)
-            ax.text(0.65, 0.83, x_stddev, transform=ax.transAxes, fontsize=fontsize)
-            plt.tick_params(axis='both', which='both', bottom='on', top='on', right='on', direction='in', labelbottom='on')
-            binwidth = (xmax-xmin)/40.
-            _, _, _ = ax.hist(delfg, bins=np.arange(xmin, xmax + binwidth, binwidth), histtype='bar', ec='k', facecolor="red", alpha=alpha)
-
-            if save_figs:
-                #if plot_name is None:
+            if show_figs or save_figs:
+                print ("Making the plots...")
+                t = (filt, grat, slit_id)
+                title = "_".join(t)
                 file_path = step_input_filename.replace(os.path.basename(step_input_filename), "")
                 file_basename = os.path.basename(step_input_filename.replace(".fits", ""))
                 t = (file_basename, "FS_flattest_"+slit_id+"_histogram.pdf")
-                plot_name = "_".join(t)
-                plt.savefig("/".join((file_path, plot_name)))
-                print ('\n Plot saved: ', plot_name)
-            if show_figs:
-                plt.show()
-            plt.close()
+                plot_name = "/".join((file_path, "_".join(t)))
+                auxfunc.make_plot(plot_queue, mk_hist, title=title, delfg=delfg, delfg_median=delfg_median,
+                                  delfg_std=delfg_std, save_figs=save_figs, show_figs=show_figs, plot_name=plot_name)
         else:
             print ("Not making plots because delfg_median is NaN.")
 
@@ -442,7 +402,7 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
             complfile.append(complfile_ext)
 
 
-    wc_hdulist.close()
+    auxfunc.finish_plot_queue(plot_queue)
 
     if writefile:
         outfile_name = step_input_filename.replace("2d_flat_field.fits", det+"_flat_calc.fits")
@@ -5,6 +5,7 @@ import matplotlib.pyplot as plt
 from astropy.io import fits
 
 from . import auxiliary_functions as auxfunc
+from .. import core_utils
 
 
 """
@@ -13,26 +14,111 @@ This script tests the pipeline flat field step output for IFU data. It is the py
 """
 
 
-def reverse_cols(arr):
+def fast_vector_value(vec_wav, vec_dat, wav_min, wav_max):
     """
-    This function permutates the last column of the array with the first, e.g. a = [4,5,6]
-    b = reverse_cols(a) = [6,5,4].
+    This function averages the fast vector of a flat reference file over the band of each pixel. If there is only
+    one point of the vector within the band that value is used, and if there is none the last value of the vector.
     Args:
-        arr: numpy array
+        vec_wav: numpy array, wavelengths of the fast vector ** This array MUST be in increasing order **
+        vec_dat: numpy array, fast vector values
+        wav_min: numpy array, lower edge of the band of each pixel
+        wav_max: numpy array, upper edge of the band of each pixel
 
     Returns:
-        rev_arr: numpy array with first and last columns reversed
+        val: numpy array, fast vector value for each pixel
     """
-    last_idx = np.shape(arr)[-1]-1
-    permutation = [last_idx]
-    for i, a in enumerate(arr):
-        if (i != 0) and (i != last_idx):
-            permutation.append(i)
-        if i == last_idx:
-            permutation.append(0)
-    p = np.argsort(permutation)
-    rev_arr = arr[:, p]
-    return rev_arr
+    val, npts = auxfunc.band_average(vec_wav, vec_dat, wav_min, wav_max)
+    lo = np.searchsorted(vec_wav, wav_min, side="left")
+    val = np.where(npts == 1, vec_dat[np.clip(lo, 0, len(vec_dat)-1)], val)
+    val = np.where(npts == 0, vec_dat[-1], val)
+    return val
+
+
+def calc_ifu_flat(slices, pipeflat, dflat, sflat, ffv, debug=False):
+    """
+    This function calculates the flat field for all the pixels of all the slices that have a finite wavelength in
+    one pass, and the difference with the pipeline flat.
+    Args:
+        slices: list, wavelength array and subwindow origin (wave, px0, py0) of each slice
+        pipeflat: 2D numpy array, pipeline on-the-fly flat
+        dflat: list, D-flat wavelengths, cube, DQ image, and fast vector table
+        sflat: list, S-flat image, DQ image, and fast vector table
+        ffv: F-flat fast vector table
+        debug: boolean, if true a series of print statements will show on-screen
+
+    Returns:
+        flatcor_list: list, 1D numpy array with the calculated flat of each slice (999.0 where not calculated)
+        delf_list: list, 1D numpy array with pipeline minus calculated flat of each slice (999.0 where not calculated)
+    """
+    dfwave, dfim, dfimdq, dfrqe = dflat
+    sfim, sfimdq, sfv = sflat
+    if len(slices) == 0:
+        return [], []
+
+    # get the pixel indeces and bandwidths of all the slices, skipping pixels where the wavelength is NaN
+    all_jj, all_jwav, all_delw, all_yind, all_xind = [], [], [], [], []
+    for wave, px0, py0 in slices:
+        nx = np.shape(wave)[1]
+        flat_wave = wave.flatten()
+        jj = np.where(np.isfinite(flat_wave))[0]
+        jj = jj[jj != 0]
+        all_jj.append(jj)
+        all_jwav.append(flat_wave[jj])
+        all_delw.append(auxfunc.calc_pixel_bandwidth(flat_wave, nx, edge_factor=0.5)[jj])
+        all_yind.append(jj // nx + py0 - 1)
+        all_xind.append(jj % nx + px0 - 1)
+    jwav, delw = np.concatenate(all_jwav), np.concatenate(all_delw)
+    pind = [np.concatenate(all_yind).astype(int), np.concatenate(all_xind).astype(int)]
+    wav_min, wav_max = jwav - delw/2.0, jwav + delw/2.0
+    if debug:
+        print ("delw = ", delw)
+
+    # integrate over D-flat fast vector
+    dff, _ = auxfunc.band_average(dfrqe.field("WAVELENGTH"), dfrqe.field("RQE"), wav_min, wav_max)
+    if debug:
+        print ("dff = ", dff)
+
+    # interpolate over D-flat cube
+    dfs, _ = auxfunc.interp_cube(jwav, dfwave, dfim, pind[0], pind[1])
+    dfs[dfimdq[pind[0], pind[1]] != 0] = 1.0
+
+    # integrate over S-flat fast vector
+    sff = fast_vector_value(sfv.field("WAVELENGTH"), sfv.field("DATA"), wav_min, wav_max)
+    sff[(jwav >= 5.3) | (jwav <= 0.6)] = 999.0
+
+    # get s-flat pixel-dependent correction
+    sfs = np.where(sfimdq[pind[0], pind[1]] == 0, sfim[pind[0], pind[1]], 1.0)
+    if debug:
+        print ("sfs = ", sfs)
+        print ("sff = ", sff)
+
+    # integrate over f-flat fast vector
+    # reference file blue cutoff is 1 micron, so need to force solution for shorter wavs
+    fff = fast_vector_value(ffv.field("WAVELENGTH"), ffv.field("DATA"), wav_min, wav_max)
+    fff[~(wav_min >= 1.0)] = 1.0
+    if debug:
+        print ("fff = ", fff)
+
+    # Difference between pipeline and calculated values
+    pix_flatcor = dff * dfs * sff * sfs * fff
+    pipe = pipeflat[pind[0], pind[1]]
+    pix_delf = pipe - pix_flatcor
+    # Remove all pixels with values=1 (mainly inter-slit pixels) for statistics
+    pix_delf[pipe == 1] = 999.0
+    pix_flatcor[pipe != 1] = 1.0   # no correction if no wavelength
+
+    # split the results into the slices
+    flatcor_list, delf_list = [], []
+    bounds = np.cumsum([0] + [len(jj) for jj in all_jj])
+    for k, (wave, _, _) in enumerate(slices):
+        nw = np.size(wave)
+        delf = np.zeros([nw]) + 999.0
+        flatcor = np.zeros([nw]) + 999.0
+        flatcor[all_jj[k]] = pix_flatcor[bounds[k]:bounds[k+1]]
+        delf[all_jj[k]] = pix_delf[bounds[k]:bounds[k+1]]
+        flatcor_list.append(flatcor)
+        delf_list.append(delf)
+    return flatcor_list, delf_list
 
 
 def mk_hist(title, delfg, delfg_median, delfg_std, save_figs, show_figs, plot_name):
@@ -81,7 +167,8 @@ def mk_hist(title, delfg, delfg_median, delfg_std, save_figs, show_figs, plot_na
 
 def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_path=None, writefile=False,
              mk_all_slices_plt=False, show_figs=True, save_figs=False, plot_name=None,
-             threshold_diff=1.0e-14, debug=False):
+             threshold_diff=1.0e-14, debug=False,
+             cache_dir=None, n_workers=1):
     """
     This function calculates the difference between the pipeline and the calculated flat field values.
     The functions uses the output of the compute_world_coordinates.py script.
@@ -99,6 +186,9 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
                     default)
         threshold_diff: float, threshold difference between pipeline output and ESA file
         debug: boolean, if true a series of print statements will show on-screen
+        cache_dir: string, path to the directory where the reference flats are cached in science orientation
+                    (None or empty string to not use the cache)
+        n_workers: integer, number of processes to calculate the slices in parallel (1 runs them serially)
 
     Returns:
         - 1 plot, if told to save and/or show.
@@ -108,10 +198,11 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
 
     # get info from the flat field file
     file_path = step_input_filename.replace(os.path.basename(step_input_filename), "")
-    det = fits.getval(step_input_filename, "DETECTOR", 0)
-    exptype = fits.getval(step_input_filename, "EXP_TYPE", 0)
-    grat = fits.getval(step_input_filename, "GRATING", 0)
-    filt = fits.getval(step_input_filename, "FILTER", 0)
+    step_input_hdrs = core_utils.read_header_snapshot(step_input_filename, extensions=[0])
+    det = core_utils.get_snapshot_val(step_input_hdrs, "DETECTOR")
+    exptype = core_utils.get_snapshot_val(step_input_hdrs, "EXP_TYPE")
+    grat = core_utils.get_snapshot_val(step_input_hdrs, "GRATING")
+    filt = core_utils.get_snapshot_val(step_input_hdrs, "FILTER")
     file_basename = os.path.basename(step_input_filename.replace(".fits", ""))
     print('step_input_filename=', step_input_filename)
     print ("flat_field_file  -->     Grating:", grat, "   Filter:", filt, "   EXP_TYPE:", exptype)
@@ -126,24 +217,12 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
     dfile = dflatref_path+"_nrs1_"+dflat_ending
     if det == "NRS2":
         dfile = dfile.replace("nrs1", "nrs2")
-    dfim = fits.getdata(dfile, 1)
-    dfimdq = fits.getdata(dfile, 4)
     # need to flip/rotate the image into science orientation
-    ns = np.shape(dfim)
-    dfim = np.transpose(dfim, (0, 2, 1))   # keep in mind that 0,1,2 = z,y,x in Python, whereas =x,y,z in IDL
-    dfimdq = np.transpose(dfimdq)
-    if det == "NRS2":
-        dfim = reverse_cols(dfim)
-        dfim = dfim[::-1]
-        dfimdq = reverse_cols(dfimdq)
-        dfimdq = dfimdq[::-1]
-    naxis3 = fits.getval(dfile, "NAXIS3", 1)
+    dfim = auxfunc.read_reference_flat(dfile, 1, det, axes=(0, 2, 1), cache_dir=cache_dir)
+    dfimdq = auxfunc.read_reference_flat(dfile, 4, det, cache_dir=cache_dir)
 
     # get the wavelength values
-    dfwave = np.array([])
-    for i in range(naxis3):
-        keyword = "PFLAT_"+str(i+1)
-        dfwave = np.append(dfwave, fits.getval(dfile, keyword, 1))
+    dfwave = auxfunc.get_flat_wavelengths(dfile, "PFLAT_%d")
     dfrqe = fits.getdata(dfile, 2)
 
     # S-flat
@@ -176,17 +255,10 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
 
     if det == "NRS2":
         sfile = sfile.replace("nrs1", "nrs2")
-    sfim = fits.getdata(sfile, 1)
-    sfimdq = fits.getdata(sfile, 3)
 
     # need to flip/rotate image into science orientation
-    sfim = np.transpose(sfim)
-    sfimdq = np.transpose(sfimdq)
-    if det == "NRS2":
-        sfim = reverse_cols(sfim)
-        sfim = sfim[::-1]
-        sfimdq = reverse_cols(sfimdq)
-        sfimdq = sfimdq[::-1]
+    sfim = auxfunc.read_reference_flat(sfile, 1, det, cache_dir=cache_dir)
+    sfimdq = auxfunc.read_reference_flat(sfile, 3, det, cache_dir=cache_dir)
     sfv = fits.getdata(sfile, 5)
 
     # F-Flat
@@ -203,8 +275,8 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
     ffv = fits.getdata(ffile, 1)
 
     # go through each pixel in the test data
-    wc_file_name = step_input_filename.replace("_flat_field.fits", "_world_coordinates.fits")
-    wc_hdulist = fits.open(wc_file_name)
+    # (the world coordinates are the ones cached by the WCS tests, or they are computed if they are not there)
+    wc = auxfunc.get_world_coordinates(step_input_filename, ifu=True)
 
     if writefile:
         # create the fits list to hold the calculated flat values for each slit
@@ -218,17 +290,17 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
         complfile.append(hdu0)
 
     # loop over the slices and read in the WCS values
-    all_delfg_median, all_test_result = [], []
+    slice_ids, slices = [], []
     print ("Looping through the slices... ")
-    n_ext = len(wc_hdulist)
+    n_ext = len(wc.headers.headers)
     for ext in range(n_ext):
         ext += 1
         try:
-            slice_id = fits.getval(wc_file_name, "SLIT", ext)
+            slice_id = core_utils.get_snapshot_val(wc.headers, "SLIT", ext)
         except:
             IndexError
             break
-        wc_data = fits.getdata(wc_file_name, ext)
+        wc_data = wc.data[ext]
         print("Working with slice: ", slice_id)
 
         # get the wavelength
@@ -236,142 +308,32 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
 
         # get the subwindow origin (technically no subwindows for IFU, but need this for comparing to the
         # full frame on-the-fly flat image).
-        px0 = int(fits.getval(wc_file_name, "CRVAL1", ext))
-        py0 = int(fits.getval(wc_file_name, "CRVAL2", ext))
-        n_p = np.shape(wave)
-        nx, ny = n_p[1], n_p[0]
-        nw = nx * ny
+        px0 = int(core_utils.get_snapshot_val(wc.headers, "CRVAL1", ext))
+        py0 = int(core_utils.get_snapshot_val(wc.headers, "CRVAL2", ext))
         print (" subwindow origin:   px0=",px0, "   py0=", py0)
         if debug:
-            print ("nw = ", nw)
-        delf = np.zeros([nw]) + 999.0
-        flatcor = np.zeros([nw]) + 999.0
-        sffarr = np.zeros([nw])
-
-        # loop through the wavelengths
-        print (" looping through the wavelngth, this may take a little time ... ")
-        flat_wave = wave.flatten()
-        wave_shape = np.shape(wave)
-        for j in range(1, nw):
-            if np.isfinite(flat_wave[j]):   # skip if wavelength is NaN
-                # get the pixel indeces
-                jwav = flat_wave[j]
-                t=np.where(wave == jwav)
-                pind = [t[0][0]+py0-1, t[1][0]+px0-1]   # pind =[pixel_y, pixe_x] in python, [x, y] in IDL
-                if debug:
-                    print ('j, jwav, px0, py0 : ', j, jwav, px0, py0)
-                    print ('pind[0], pind[1] = ', pind[0], pind[1])
-
-                # get the pixel bandwidth **this needs to be modified for prism, since the dispersion is not linear!**
-                delw = 0.0
-                if (j!=0) and (int((j-1)/nx)==int(j/nx)) and (int((j+1)/nx)==int(j/nx)) and np.isfinite(flat_wave[j+1]) and np.isfinite(flat_wave[j-1]):
-                    delw = 0.5 * (flat_wave[j+1] - flat_wave[j-1])
-                if (j==0) or not np.isfinite(flat_wave[j-1]) or (int((j-1)/nx) != int(j/nx)):
-                    delw = 0.5 * (flat_wave[j+1] - flat_wave[j])
-                if (j==nw-1) or not np.isfinite(flat_wave[j+1]) or (int((j+1)/nx) != int(j/nx)):
-                    delw = 0.5 * (flat_wave[j] - flat_wave[j-1])
-
-                if debug:
-                    #print ("(j, (j-1), nx, (j-1)/nx, (j+1), (j+1)/nx)", j, (j-1), nx, int((j-1)/nx), (j+1), int((j+1)/nx))
-                    #print ("np.isfinite(flat_wave[j+1]), np.isfinite(flat_wave[j-1])", np.isfinite(flat_wave[j+1]), np.isfinite(flat_wave[j-1]))
-                    #print ("flat_wave[j+1], flat_wave[j-1] : ", np.isfinite(flat_wave[j+1]), flat_wave[j+1], flat_wave[j-1])
-                    print ("delw = ", delw)
-
-                # integrate over D-flat fast vector
-                dfrqe_wav = dfrqe.field("WAVELENGTH")
-                dfrqe_rqe = dfrqe.field("RQE")
-                iw = np.where((dfrqe_wav >= jwav-delw/2.0) & (dfrqe_wav <= jwav+delw/2.0))
-                if np.size(iw) == 0:
-                    iw = -1
-                int_tab = auxfunc.idl_tabulate(dfrqe_wav[iw], dfrqe_rqe[iw])
-                first_dfrqe_wav, last_dfrqe_wav = dfrqe_wav[iw][0], dfrqe_wav[iw][-1]
-                dff = int_tab/(last_dfrqe_wav - first_dfrqe_wav)
-
-                if debug:
-                    #print ("np.shape(dfrqe_wav) : ", np.shape(dfrqe_wav))
-                    #print ("np.shape(dfrqe_rqe) : ", np.shape(dfrqe_rqe))
-                    #print ("dfimdq[pind[0]][pind[1]] : ", dfimdq[pind[0]][pind[1]])
-                    #print ("np.shape(iw) =", np.shape(iw))
-                    #print ("np.shape(dfrqe_wav[iw[0]]) = ", np.shape(dfrqe_wav[iw[0]]))
-                    #print ("np.shape(dfrqe_rqe[iw[0]]) = ", np.shape(dfrqe_rqe[iw[0]]))
-                    #print ("int_tab=", int_tab)
-                    print ("np.shape(iw) = ", np.shape(iw))
-                    print ("iw = ", iw)
-                    print ("dff = ", dff)
-
-                # interpolate over D-flat cube
-                dfs = 1.0
-                if dfimdq[pind[0], pind[1]] == 0:
-                    dfs = np.interp(jwav, dfwave, dfim[:, pind[0], pind[1]])
-
-                # integrate over S-flat fast vector
-                sfv_wav = sfv.field("WAVELENGTH")
-                sfv_dat = sfv.field("DATA")
-                if (jwav < 5.3) and (jwav > 0.6):
-                    iw = np.where((sfv_wav >= jwav-delw/2.0) & (sfv_wav <= jwav+delw/2.0))
-                    if np.size(iw) == 0:
-                        iw = -1
-                    if np.size(iw) > 1:
-                        int_tab = auxfunc.idl_tabulate(sfv_wav[iw], sfv_dat[iw])
-                        first_sfv_wav, last_sfv_wav = sfv_wav[iw][0], sfv_wav[iw][-1]
-                        sff = int_tab/(last_sfv_wav - first_sfv_wav)
-                    elif np.size(iw) == 1:
-                        sff = float(sfv_dat[iw])
-                else:
-                    sff = 999.0
-
-                # get s-flat pixel-dependent correction
-                sfs = 1.0
-                if sfimdq[pind[0], pind[1]] == 0:
-                    sfs = sfim[pind[0], pind[1]]
-
-                if debug:
-                    print("jwav-delw/2.0 = ", jwav-delw/2.0)
-                    print("jwav+delw/2.0 = ", jwav+delw/2.0)
-                    print("np.shape(sfv_wav), sfv_wav[-1] = ", np.shape(sfv_wav), sfv_wav[-1])
-                    print ("iw = ", iw)
-                    print ("sfv_wav[iw] = ", sfv_wav[iw])
-                    print ("int_tab = ", int_tab)
-                    print ("first_sfv_wav, last_sfv_wav = ", first_sfv_wav, last_sfv_wav)
-                    print ("sfs = ", sfs)
-                    print ("sff = ", sff)
-
-                # integrate over f-flat fast vector
-                # reference file blue cutoff is 1 micron, so need to force solution for shorter wavs
-                ffv_wav = ffv.field("WAVELENGTH")
-                ffv_dat = ffv.field("DATA")
-                fff = 1.0
-                if jwav-delw/2.0 >= 1.0:
-                    iw = np.where((ffv_wav >= jwav-delw/2.0) & (ffv_wav <= jwav+delw/2.0))
-                    if np.size(iw) == 0:
-                        iw = -1
-                    if np.size(iw) > 1:
-                        int_tab = auxfunc.idl_tabulate(ffv_wav[iw], ffv_dat[iw])
-                        first_ffv_wav, last_ffv_wav = ffv_wav[iw][0], ffv_wav[iw][-1]
-                        fff = int_tab/(last_ffv_wav - first_ffv_wav)
-                    elif np.size(iw) == 1:
-                        fff = float(ffv_dat[iw])
-
-                flatcor[j] = dff * dfs * sff * sfs * fff
-                sffarr[j] = sff
-
-                # Difference between pipeline and calculated values
-                delf[j] = pipeflat[pind[0], pind[1]] - flatcor[j]
-
-                # Remove all pixels with values=1 (mainly inter-slit pixels) for statistics
-                if pipeflat[pind[0], pind[1]] == 1:
-                    delf[j] = 999.0
-                else:
-                    flatcor[j] = 1.0   # no correction if no wavelength
-
-                if debug:
-                    print ("np.shape(iw) = ", np.shape(iw))
-                    print ("fff = ", fff)
-                    print ("flatcor[j] = ", flatcor[j])
-                    print ("delf[j] = ", delf[j])
-
-
-        wc_hdulist.close()
+            print ("nw = ", np.size(wave))
+        slice_ids.append(slice_id)
+        slices.append((wave, px0, py0))
+
+    # calculate the flat for all the pixels of all the slices at once, or for one group of slices per process if
+    # n_workers > 1 (the groups keep the order of the slices, so the results are the same as in a serial run)
+    print ("calculating the flat for all the slices, this may take a little time ... ")
+    flat_data = dict(pipeflat=pipeflat, dflat=[dfwave, dfim, dfimdq, dfrqe], sflat=[sfim, sfimdq, sfv], ffv=ffv,
+                     debug=debug)
+    flatcor_list, delf_list = [], []
+    slice_groups = auxfunc.split_in_groups(slices, n_workers or 1)
+    for group_flatcor, group_delf in auxfunc.run_in_pool(calc_ifu_flat, slice_groups, flat_data, n_workers=n_workers):
+        flatcor_list.extend(group_flatcor)
+        delf_list.extend(group_delf)
+
+    # the histograms that are only saved are rendered in the background while the next slices are checked
+    plot_queue = auxfunc.start_plot_queue(show_figs, save_figs, n_workers=n_workers)
+    all_delfg_median, all_test_result = [], []
+    for ext, slice_id in enumerate(slice_ids):
+        ext += 1
+        wave_shape = np.shape(slices[ext-1][0])
+        flatcor, delf = flatcor_list[ext-1], delf_list[ext-1]
 
         # ignore outliers for calculating median
         delfg = delf[np.where(delf != 999.0)]
@@ -392,7 +354,8 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
                 t = (file_basename, det, slice_id, "IFUflatcomp_histogram")
                 title = ("_".join(t))
                 plot_name = "".join((file_path, title+".pdf"))
-                mk_hist(title, delfg, delfg_median, delfg_std, save_figs, show_figs, plot_name=plot_name)
+                auxfunc.make_plot(plot_queue, mk_hist, title=title, delfg=delfg, delfg_median=delfg_median,
+                                  delfg_std=delfg_std, save_figs=save_figs, show_figs=show_figs, plot_name=plot_name)
 
         if writefile:
             # this is the file to hold the image of pipeline-calculated difference values
@@ -417,7 +380,7 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
 
         # if the test is failed exit the script
         if (delfg_median == 999.0) or not np.isfinite(delfg_median):
-            if ext < len(wc_hdulist)-2:
+            if ext < len(wc.headers.headers)-2:
                 print ("Unable to determine mean and std_dev. Continuing to next slice...")
             else:
                 print ("Unable to determine mean and std_dev for the last slice.")
@@ -432,8 +395,10 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
         median_of_delfg_median = np.median(all_delfg_median_arr)
         medians_std = np.std(median_of_delfg_median)
         plot_name = "".join((file_path, title))
-        mk_hist(title, all_delfg_median_arr, median_of_delfg_median, medians_std, save_figs, show_figs,
-                plot_name=plot_name)
+        auxfunc.make_plot(plot_queue, mk_hist, title=title, delfg=all_delfg_median_arr,
+                          delfg_median=median_of_delfg_median, delfg_std=medians_std, save_figs=save_figs,
+                          show_figs=show_figs, plot_name=plot_name)
+    auxfunc.finish_plot_queue(plot_queue)
 
     # create fits file to hold the calculated flat for each slice
     if writefile:
@@ -5,6 +5,7 @@ import matplotlib.pyplot as plt
 from astropy.io import fits
 
 from . import auxiliary_functions as auxfunc
+from .. import core_utils
 
 
 """
@@ -13,30 +14,253 @@ This script tests the pipeline flat field step output for MOS data. It is the py
 """
 
 
-def reverse_cols(arr):
+def calc_slitlet_flat(wave, px0, py0, pipeflat, dflat, sflat, fflat, debug=False):
     """
-    This function permutates the last column of the array with the first, e.g. a = [4,5,6]
-    b = reverse_cols(a) = [6,5,4].
+    This function calculates the flat field for all the pixels of a slitlet that have a finite wavelength at once,
+    and the difference with the pipeline flat.
     Args:
-        arr: numpy array
+        wave: 2D numpy array, wavelengths of the slitlet subwindow
+        px0: integer, full-frame x-index of the subwindow origin
+        py0: integer, full-frame y-index of the subwindow origin
+        pipeflat: 2D numpy array, pipeline on-the-fly flat
+        dflat: list, D-flat wavelengths, cube, DQ image, and fast vector table
+        sflat: list, S-flat wavelengths, cube, DQ cube, and fast vector table
+        fflat: list, F-flat wavelengths, F-flat values for the shutter, and fast vector table
+        debug: boolean, if true a series of print statements will show on-screen
+
+    Returns:
+        flatcor: 1D numpy array, calculated flat of each pixel (999.0 where it was not calculated)
+        delf: 1D numpy array, pipeline minus calculated flat of each pixel (999.0 where it was not calculated)
+    """
+    dfwave, dfim, dfimdq, dfrqe = dflat
+    sfimwave, sfim, sfimdq, sfv = sflat
+    ffsallwave, ffs_shutter, ffv = fflat
+
+    n_p = np.shape(wave)
+    nw = n_p[0]*n_p[1]
+    flat_wave = wave.flatten()
+    delf = np.zeros([nw]) + 999.0
+    flatcor = np.zeros([nw]) + 999.0
+
+    # get the pixel indeces, skipping pixels where the wavelength is NaN
+    jj = np.where(np.isfinite(flat_wave))[0]
+    # stop at the first pixel that falls outside of the pipeline flat
+    outside = np.where((jj // n_p[1] >= np.shape(pipeflat)[0]) | (jj % n_p[1] >= np.shape(pipeflat)[1]))[0]
+    if outside.size != 0:
+        jj = jj[:outside[0]+1]
+    jwav = flat_wave[jj]
+    pind = [jj // n_p[1] + py0, jj % n_p[1] + px0]
+
+    # get the pixel bandwidth
+    delw = auxfunc.calc_pixel_bandwidth(flat_wave, n_p[1])[jj]
+    wav_min, wav_max = jwav - delw/2.0, jwav + delw/2.0
+    if debug:
+        print ("delw = ", delw)
+
+    # integrate over dflat fast vector
+    dff, _ = auxfunc.band_average(dfrqe.field("WAVELENGTH"), dfrqe.field("RQE"), wav_min, wav_max)
+    if debug:
+        print ("dff = ", dff)
+
+    # interpolate over dflat cube
+    dfs, in_range = auxfunc.interp_cube(jwav, dfwave, dfim, pind[0], pind[1])
+    dfs = np.where(in_range, dfs, 1.0)
+    # check DQ flags
+    dfs[dfimdq[pind[0], pind[1]] != 0] = 1.0
+
+    # integrate over S-flat fast vector
+    sff, npts = auxfunc.band_average(sfv.field("WAVELENGTH"), sfv.field("DATA"), wav_min, wav_max)
+    sff[npts == 0] = 1.0
+
+    # interpolate s-flat cube
+    # check DQ flags
+    sfs, in_range = auxfunc.interp_cube(jwav, sfimwave, sfim, pind[0], pind[1], dq=sfimdq)
+    sfs = np.where(in_range, sfs, 1.0)
+
+    # integrate over f-flat fast vector
+    # reference file wavelength range is from 0.6 to 5.206 microns, so need to force
+    # solution to 1 for wavelengths outside that range
+    fff, npts = auxfunc.band_average(ffv.field("WAVELENGTH"), ffv.field("DATA"), wav_min, wav_max)
+    fff[(npts <= 1) | (wav_min < 0.6) | (wav_max > 5.206)] = 1.0
+
+    # interpolate over f-flat cube
+    ffs = np.interp(jwav, ffsallwave, ffs_shutter)
+    flatcor[jj] = dff*dfs*sff*sfs*fff*ffs
+
+    if debug:
+        print ("dfs = ", dfs)
+        print ("sff = ", sff)
+        print ("sfs = ", sfs)
+        print ("ffs = ", ffs)
+
+    # Difference between pipeline and calculated values
+    if outside.size != 0:
+        jj = jj[:-1]
+    pipe = pipeflat[jj // n_p[1], jj % n_p[1]]
+    delf[jj] = pipe - flatcor[jj]
+
+    # Remove all pixels with values=1 (mainly inter-slit pixels) for statistics
+    delf[jj[pipe == 1]] = 999.0
+    flatcor[jj[pipe != 1]] = 1.0   # no correction if no wavelength
+
+    return flatcor, delf
+
+
+def get_fflat_quadrant(ffile, quad, fflat_hdrs, fflat_quads):
+    """
+    This function returns the F-flat reference data for the given MSA quadrant. The data of a quadrant is read
+    only the first time it is requested and then kept in fflat_quads, so quadrants without any open shutters are
+    never read. Files with the 4 quadrants (at least 16 extensions) have 4 extensions per quadrant, otherwise all
+    the quadrants share extensions 1 to 4, which are then read only once.
+    Args:
+        ffile: string, F-flat reference file name (with full path)
+        quad: integer, MSA quadrant of the slitlet (1 to 4)
+        fflat_hdrs: HeaderSnapshot, headers of all the extensions of the F-flat reference file
+        fflat_quads: dictionary, F-flat data already read, keyed by the first extension of the quadrant
+
+    Returns:
+        ffsallwave: numpy array, wavelengths of the F-flat cube planes
+        ffsall: numpy array, F-flat cube
+        ffsalldq: numpy array, F-flat DQ cube
+        ffv: FITS record, F-flat fast variation table
+    """
+    sci_ext = 1
+    if len(fflat_hdrs.headers) > 16:
+        sci_ext = (int(quad)-1)*4 + 1
+    if sci_ext not in fflat_quads:
+        print ("Reading F-flat data for quadrant ", quad, " from extension ", sci_ext)
+        ffsallwave = auxfunc.get_flat_wavelengths(ffile, "FLAT_%02d", first=0, ext=sci_ext)
+        ffsall = fits.getdata(ffile, sci_ext)
+        ffsalldq = fits.getdata(ffile, sci_ext+2)
+        ffv = fits.getdata(ffile, sci_ext+3)
+        fflat_quads[sci_ext] = (ffsallwave, ffsall, ffsalldq, ffv)
+    return fflat_quads[sci_ext]
+
+
+def load_fflat_quadrants(ffile, fflat_hdrs, fflat_quads, wc, msa_conf):
+    """
+    This function reads the F-flat data of all the quadrants that have a slitlet in the world coordinates file
+    (see get_fflat_quadrant). It is used before calculating the slitlets in a pool of processes, since the workers
+    get a copy of fflat_quads and would otherwise each read again every quadrant they need.
+    Args:
+        ffile: string, F-flat reference file name (with full path)
+        fflat_hdrs: HeaderSnapshot, headers of all the extensions of the F-flat reference file
+        fflat_quads: dictionary, F-flat data already read, keyed by the first extension of the quadrant
+        wc: WorldCoordinates, headers and data of the world coordinates file
+        msa_conf: MSAShutterConf, index of the MSA shutter configuration
+
+    Returns:
+        nothing
+    """
+    for ext in range(1, len(wc.headers.headers)):
+        slit_id = core_utils.get_snapshot_val(wc.headers, "SLIT", ext)
+        im = msa_conf.slitlet_shutters[int(slit_id)][-1]
+        get_fflat_quadrant(ffile, msa_conf.quadrant[im], fflat_hdrs, fflat_quads)
+
+
+def calc_slitlet(ext, wc=None, pipeflat=None, dflat=None, sflat=None, ffile=None,
+                 fflat_hdrs=None, fflat_quads=None, msa_conf=None, debug=False):
+    """
+    This function calculates the flat of the slitlet in the given extension of the world coordinates file. It
+    only depends on its arguments, so the slitlets can be calculated in parallel (see auxfunc.run_in_pool).
+    Args:
+        ext: integer, extension of the world coordinates file
+        wc: WorldCoordinates, headers and data of the world coordinates file (see auxfunc.read_world_coordinates)
+        pipeflat: numpy array, on-the-fly flat image from the pipeline
+        dflat: list, D-flat wavelengths, cube, DQ, and RQE table
+        sflat: list, S-flat wavelengths, cube, DQ, and fast variation table
+        ffile: string, F-flat reference file name (with full path)
+        fflat_hdrs: HeaderSnapshot, headers of the F-flat reference file
+        fflat_quads: dictionary, F-flat data already read (see get_fflat_quadrant)
+        msa_conf: MSAShutterConf, index of the MSA shutter configuration
+        debug: boolean, if true a series of print statements will show on-screen
 
     Returns:
-        rev_arr: numpy array with first and last columns reversed
+        slit_id: string, slit name in the world coordinates file
+        slitlet_id: string, row and column of the slitlet shutter
+        flatcor: numpy array, calculated flat of the slitlet
+        delf: numpy array, pipeline minus calculated flat
+        wave_shape: tuple, shape of the slitlet subwindow
     """
-    last_idx = np.shape(arr)[-1]-1
-    permutation = [last_idx]
-    for i, a in enumerate(arr):
-        if (i != 0) and (i != last_idx):
-            permutation.append(i)
-        if i == last_idx:
-            permutation.append(0)
-    p = np.argsort(permutation)
-    rev_arr = arr[:, p]
-    return rev_arr
+    slit_id = core_utils.get_snapshot_val(wc.headers, "SLIT", ext)
+    wc_data = wc.data[ext]
+    # get the wavelength
+    wave = wc_data[0, :, :]
+
+    # get the subwindow origin
+    px0 = int(core_utils.get_snapshot_val(wc.headers, "CRVAL1", ext))-1
+    py0 = int(core_utils.get_snapshot_val(wc.headers, "CRVAL2", ext))-1
+    if debug:
+        print ("subwindow origin:   px0=",px0, "   py0=", py0)
+
+    # get the slitlet info, needed for the F-Flat (the last shutter of the slitlet in the table)
+    im = msa_conf.slitlet_shutters[int(slit_id)][-1]
+    quad = msa_conf.quadrant[im]
+    row = msa_conf.row[im]
+    col = msa_conf.column[im]
+    slitlet_id = repr(row)+"_"+repr(col)
+    print ('sltid=', msa_conf.slitlet_id, "   quad=", quad, "   row=", row, "   col=", col, "   slitlet_id=", slitlet_id)
+
+    # get the relevant F-flat reference data
+    ffsallwave, ffsall, ffsalldq, ffv = get_fflat_quadrant(ffile, quad, fflat_hdrs, fflat_quads)
+
+    # calculate the flat for all the pixels of the slitlet at once
+    print ("calculating the flat for all the pixels of the slitlet... ")
+    wave_shape = np.shape(wave)
+    fflat = [ffsallwave, ffsall[:, col-1, row-1], ffv]
+    flatcor, delf = calc_slitlet_flat(wave, px0, py0, pipeflat, dflat, sflat, fflat, debug=debug)
+    return slit_id, slitlet_id, flatcor, delf, wave_shape
+
+
+def mk_hist(title, delfg, delfg_median, delfg_std, save_figs, show_figs, plot_name):
+    """
+    This function makes the histogram of the flat differences of a slitlet.
+    Args:
+        title: str, title of the plot
+        delfg: array, pipeline minus calculated flat values, without the outliers
+        delfg_median: float, median of delfg
+        delfg_std: float, standard deviation of delfg
+        save_figs: boolean, save the plot or not
+        show_figs: boolean, show the plot on screen or not
+        plot_name: str, name of the saved plot
+
+    Returns:
+        nothing
+    """
+    font = {#'family' : 'normal',
+            'weight' : 'normal',
+            'size'   : 16}
+    matplotlib.rc('font', **font)
+    alpha = 0.2
+    fontsize = 15
+    fig = plt.figure(1, figsize=(8, 6))
+    plt.subplots_adjust(hspace=.4)
+    ax = plt.subplot(111)
+    plt.title(title)
+    plt.xlabel("flat$_{pipe}$ - flat$_{calc}$")
+    plt.ylabel("N")
+    xmin = delfg_median - delfg_std*5
+    xmax = delfg_median + delfg_std*5
+    plt.xlim(xmin, xmax)
+    x_median = "median = {:0.3}".format(delfg_median)
+    x_stddev = "stddev = {:0.3}".format(delfg_std)
+    ax.text(0.7, 0.9, x_median, transform=ax.transAxes, fontsize=fontsize)
+    ax.text(0.7, 0.83, x_stddev, transform=ax.transAxes, fontsize=fontsize)
+    plt.tick_params(axis='both', which='both', bottom='on', top='on', right='on', direction='in', labelbottom='on')
+    binwidth = (xmax-xmin)/40.
+    _, _, _ = ax.hist(delfg, bins=np.arange(xmin, xmax + binwidth, binwidth), histtype='bar', ec='k', facecolor="red", alpha=alpha)
+
+    if save_figs:
+        plt.savefig(plot_name)
+        print ('\n Plot saved: ', plot_name)
+    if show_figs:
+        plt.show()
+    plt.close()
 
 
 def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_path=None, msa_shutter_conf=None,
-             writefile=False, show_figs=True, save_figs=False, plot_name=None, threshold_diff=1.0e-14, debug=False):
+             writefile=False, show_figs=True, save_figs=False, plot_name=None, threshold_diff=1.0e-14, debug=False,
+             cache_dir=None, n_workers=1):
     """
     This function does the WCS comparison from the world coordinates calculated using the
     compute_world_coordinates.py script with the ESA files. The function calls that script.
@@ -54,6 +278,9 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
                     default)
         threshold_diff: float, threshold difference between pipeline output and ESA file
         debug: boolean, if true a series of print statements will show on-screen
+        cache_dir: string, path to the directory where the reference flats are cached in science orientation
+                    (None or empty string to not use the cache)
+        n_workers: integer, number of processes to calculate the slitlets in parallel (1 runs them serially)
 
     Returns:
         - 1 plot, if told to save and/or show.
@@ -62,12 +289,13 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
     """
 
     # get info from the rate file header
-    det = fits.getval(step_input_filename, "DETECTOR", 0)
+    step_input_hdrs = core_utils.read_header_snapshot(step_input_filename, extensions=[0])
+    det = core_utils.get_snapshot_val(step_input_hdrs, "DETECTOR")
     print('step_input_filename=', step_input_filename)
-    lamp = fits.getval(step_input_filename, "LAMP", 0)
-    exptype = fits.getval(step_input_filename, "EXP_TYPE", 0)
-    grat = fits.getval(step_input_filename, "GRATING", 0)
-    filt = fits.getval(step_input_filename, "FILTER", 0)
+    lamp = core_utils.get_snapshot_val(step_input_hdrs, "LAMP")
+    exptype = core_utils.get_snapshot_val(step_input_hdrs, "EXP_TYPE")
+    grat = core_utils.get_snapshot_val(step_input_hdrs, "GRATING")
+    filt = core_utils.get_snapshot_val(step_input_hdrs, "FILTER")
     print ("rate_file  -->     Grating:", grat, "   Filter:", filt, "   Lamp:", lamp)
 
     # read in the on-the-fly flat image
@@ -81,24 +309,12 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
     if det == "NRS2":
         dfile = dfile.replace("nrs1", "nrs2")
     #print(" ***** path for d-flat: ", os.path.isfile(dfile))
-    dfim = fits.getdata(dfile, 1)
-    dfimdq = fits.getdata(dfile, 4)
     # need to flip/rotate the image into science orientation
-    ns = np.shape(dfim)
-    dfim = np.transpose(dfim, (0, 2, 1))   # keep in mind that 0,1,2 = z,y,x in Python, whereas =x,y,z in IDL
-    dfimdq = np.transpose(dfimdq)
-    if det == "NRS2":
-        dfim = reverse_cols(dfim)
-        dfim = dfim[::-1]
-        dfimdq = reverse_cols(dfimdq)
-        dfimdq = dfimdq[::-1]
-    naxis3 = fits.getval(dfile, "NAXIS3", 1)
+    dfim = auxfunc.read_reference_flat(dfile, 1, det, axes=(0, 2, 1), cache_dir=cache_dir)
+    dfimdq = auxfunc.read_reference_flat(dfile, 4, det, cache_dir=cache_dir)
 
     # get the wavelength values
-    dfwave = np.array([])
-    for i in range(naxis3):
-        keyword = "_".join(("PFLAT", str(i+1)))
-        dfwave = np.append(dfwave, fits.getval(dfile, keyword, 1))
+    dfwave = auxfunc.get_flat_wavelengths(dfile, "PFLAT_%d")
     dfrqe = fits.getdata(dfile, 2)
 
     # S-flat
@@ -132,98 +348,27 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
 
     if det == "NRS2":
         sfile = sfile.replace("nrs1", "nrs2")
-    sfim = fits.getdata(sfile, 1)
-    sfimdq = fits.getdata(sfile, 3)
 
     # need to flip/rotate image into science orientation
-    sfim = np.transpose(sfim, (0, 2, 1))
-    sfimdq = np.transpose(sfimdq, (0, 2, 1))
-    if det == "NRS2":
-        sfim = reverse_cols(sfim)
-        sfim = sfim[::-1]
-        sfimdq = reverse_cols(sfimdq)
-        sfimdq = sfimdq[::-1]
+    sfim = auxfunc.read_reference_flat(sfile, 1, det, axes=(0, 2, 1), cache_dir=cache_dir)
+    sfimdq = auxfunc.read_reference_flat(sfile, 3, det, axes=(0, 2, 1), cache_dir=cache_dir)
 
     # get the wavelength values for sflat cube
-    sfimwave = np.array([])
-    naxis3 = fits.getval(sfile, "NAXIS3", 1)
-    for i in range(0, naxis3):
-        if i+1 < 10:
-            keyword = "".join(("FLAT_0", str(i+1)))
-        else:
-            keyword = "".join(("FLAT_", str(i+1)))
-        #print ("S-flat -> using ", keyword)
-        try:
-            sfimwave = np.append(sfimwave, fits.getval(sfile, keyword, 1))
-        except:
-            KeyError
+    sfimwave = auxfunc.get_flat_wavelengths(sfile, "FLAT_%02d", skip_missing=True)
     sfv = fits.getdata(sfile, 5)
 
     # F-Flat
     #print ("F-flat -> using the following flats: ")
     fflat_ending = "_01.01.fits"
     ffile = fflat_path+"_"+filt+fflat_ending
-    naxis3 = fits.getval(ffile, "NAXIS3", 1)
+    fflat_hdrs = core_utils.read_header_snapshot(ffile)
     #print(" ***** path for f-flat: ", os.path.isfile(ffile))
-    ffsq1 = fits.getdata(ffile, 1)
-    ffswaveq1 = np.array([])
-    for i in range(0, naxis3):
-        if i <= 9 :
-            suff = "".join(("0", str(i)))
-        else:
-            suff = str(i)
-        t = ("FLAT", suff)
-        keyword = "_".join(t)
-        #print ("1. F-flat -> ", keyword)
-        ffswaveq1 = np.append(ffswaveq1, fits.getval(ffile, keyword, 1))
-    ffserrq1 = fits.getdata(ffile, 2)
-    ffsdqq1 = fits.getdata(ffile, 3)
-    ffvq1 = fits.getdata(ffile, 4)
-    ffsq2 = fits.getdata(ffile, 1)
-    ffswaveq2 = np.array([])
-    for i in range(0, naxis3):
-        if i <= 9:
-            suff = "".join(("0", str(i)))
-        else:
-            suff = str(i)
-        t = ("FLAT", suff)
-        keyword = "_".join(t)
-        #print ("2. F-flat -> using ", keyword)
-        ffswaveq2 = np.append(ffswaveq2, fits.getval(ffile, keyword, 1))
-    ffserrq2 = fits.getdata(ffile, 2)
-    ffsdqq2 = fits.getdata(ffile, 3)
-    ffvq2 = fits.getdata(ffile, 4)
-    ffsq3 = fits.getdata(ffile, 1)
-    ffswaveq3 = np.array([])
-    for i in range(0, naxis3):
-        if i <= 9 :
-            suff = "".join(("0", str(i)))
-        else:
-            suff = str(i)
-        t = ("FLAT", suff)
-        keyword = "_".join(t)
-        #print ("3. F-flat -> using ", keyword)
-        ffswaveq3 = np.append(ffswaveq3, fits.getval(ffile, keyword, 1))
-    ffserrq3 = fits.getdata(ffile, 2)
-    ffsdqq3 = fits.getdata(ffile, 3)
-    ffvq3 = fits.getdata(ffile, 4)
-    ffsq4 = fits.getdata(ffile, 1)
-    ffswaveq4 = np.array([])
-    for i in range(0, naxis3):
-        if i <= 9:
-            suff = "0"+str(i)
-        else:
-            suff = str(i)
-        keyword = "FLAT_"+suff
-        #print ("4. F-flat -> using ", keyword)
-        ffswaveq4 = np.append(ffswaveq4, fits.getval(ffile, keyword, 1))
-    ffserrq4 = fits.getdata(ffile, 2)
-    ffsdqq4 = fits.getdata(ffile, 3)
-    ffvq4 = fits.getdata(ffile, 4)
+    # the F-flat data of each quadrant is read when the first slitlet in that quadrant is found
+    fflat_quads = {}
 
     # go through each pixel in the test data
-    wc_file_name = step_input_filename.replace("_flat_field.fits", "_world_coordinates.fits")
-    wc_hdulist = fits.open(wc_file_name)
+    # (the world coordinates are the ones cached by the WCS tests, or they are computed if they are not there)
+    wc = auxfunc.get_world_coordinates(step_input_filename)
 
     if writefile:
         # create the fits list to hold the image of pipeline-calculated difference values
@@ -236,239 +381,23 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
         complfile = fits.HDUList()
         complfile.append(hdu0)
 
-    # loop over the 2D subwindows and read in the WCS values
-    for i, _ in enumerate(wc_hdulist):
-        ext = i+1
-        if ext >= len(wc_hdulist):
-            break
-        slit_id = fits.getval(wc_file_name, "SLIT", ext)
-        wc_data = fits.getdata(wc_file_name, ext)
-        # get the wavelength
-        wave = wc_data[0, :, :]
-
-        # get the subwindow origin
-        px0 = int(fits.getval(wc_file_name, "CRVAL1", ext))-1
-        py0 = int(fits.getval(wc_file_name, "CRVAL2", ext))-1
-        n_p = np.shape(wave)
-        nw = n_p[0]*n_p[1]
-        if debug:
-            print ("subwindow origin:   px0=",px0, "   py0=", py0)
-            #print ("nw = ", nw)
-        delf = np.zeros([nw]) + 999.0
-        flatcor = np.zeros([nw]) + 999.0
-
-        # get the slitlet info, needed for the F-Flat
-        ext_shutter_info = "SHUTTER_INFO"   # this is extension 2 of the msa file, that has the shutter info
-        slitlet_info = fits.getdata(msa_shutter_conf, ext_shutter_info)
-        sltid = slitlet_info.field("SLITLET_ID")
-        for j, s in enumerate(sltid):
-            if s == int(slit_id):
-                im = j
-                # get the shutter with the source in it
-                if slitlet_info.field("BACKGROUND")[im] == "N":
-                    isrc = j
-        quad = slitlet_info.field("SHUTTER_QUADRANT")[im]
-        row = slitlet_info.field("SHUTTER_ROW")[im]
-        col = slitlet_info.field("SHUTTER_COLUMN")[im]
-        slitlet_id = repr(row)+"_"+repr(col)
-        print ('sltid=', sltid, "   quad=", quad, "   row=", row, "   col=", col, "   slitlet_id=", slitlet_id)
-
-        # get the relevant F-flat reference data
-        if quad == 1:
-            ffsall = ffsq1
-            ffsallwave = ffswaveq1
-            ffsalldq = ffsdqq1
-            ffv = ffvq1
-        if quad == 2:
-            ffsall = ffsq2
-            ffsallwave = ffswaveq2
-            ffsalldq = ffsdqq2
-            ffv = ffvq2
-        if quad == 3:
-            ffsall = ffsq3
-            ffsallwave = ffswaveq3
-            ffsalldq = ffsdqq3
-            ffv = ffvq3
-        if quad == 4:
-            ffsall = ffsq4
-            ffsallwave = ffswaveq4
-            ffsalldq = ffsdqq4
-            ffv = ffvq4
-
-        # loop through the pixels
-        print ("looping through the pixels, this may take a little time ... ")
-        flat_wave = wave.flatten()
-        wave_shape = np.shape(wave)
-        for j in range(0, nw):
-            if np.isfinite(flat_wave[j]):   # skip if wavelength is NaN
-                # get the pixel indeces
-                jwav = flat_wave[j]
-                t=np.where(wave == jwav)
-                pind = [t[0][0]+py0, t[1][0]+px0]
-                if debug:
-                    print ('j, jwav, px0, py0 : ', j, jwav, px0, py0)
-                    print ('pind = ', pind)
-
-                # get the pixel bandwidth **this needs to be modified for prism, since the dispersion is not linear!**
-                delw = 0.0
-                if (j!=0) and (int((j-1)/n_p[1])==int(j/n_p[1])) and (int((j+1)/n_p[1])==int(j/n_p[1])) and np.isfinite(flat_wave[j+1]) and np.isfinite(flat_wave[j-1]):
-                    delw = 0.5 * (flat_wave[j+1] - flat_wave[j-1])
-                if (j==0) or not np.isfinite(flat_wave[j-1]) or (int((j-1)/n_p[1]) != int(j/n_p[1])):
-                    delw = flat_wave[j+1] - flat_wave[j]
-                if (j==nw-1) or not np.isfinite(flat_wave[j+1]) or (int((j+1)/n_p[1]) != int(j/n_p[1])):
-                    delw = flat_wave[j] - flat_wave[j-1]
-
-                if debug:
-                    #print ("(j, (j-1), n_p[1], (j-1)/n_p[1], (j+1), (j+1)/n_p[1])", j, (j-1), n_p[1], int((j-1)/n_p[1]), (j+1), int((j+1)/n_p[1]))
-                    #print ("np.isfinite(flat_wave[j+1]), np.isfinite(flat_wave[j-1])", np.isfinite(flat_wave[j+1]), np.isfinite(flat_wave[j-1]))
-                    #print ("flat_wave[j+1], flat_wave[j-1] : ", np.isfinite(flat_wave[j+1]), flat_wave[j+1], flat_wave[j-1])
-                    print ("delw = ", delw)
-
-                # integrate over dflat fast vector
-                dfrqe_wav = dfrqe.field("WAVELENGTH")
-                dfrqe_rqe = dfrqe.field("RQE")
-                iw = np.where((dfrqe_wav >= flat_wave[j]-delw/2.0) & (dfrqe_wav <= flat_wave[j]+delw/2.0))
-                int_tab = auxfunc.idl_tabulate(dfrqe_wav[iw[0]], dfrqe_rqe[iw[0]])
-                first_dfrqe_wav, last_dfrqe_wav = dfrqe_wav[iw[0]][0], dfrqe_wav[iw[0]][-1]
-                dff = int_tab/(last_dfrqe_wav - first_dfrqe_wav)
-
-                if debug:
-                    #print ("np.shape(dfrqe_wav) : ", np.shape(dfrqe_wav))
-                    #print ("np.shape(dfrqe_rqe) : ", np.shape(dfrqe_rqe))
-                    #print ("dfimdq[pind[0]][pind[1]] : ", dfimdq[pind[0]][pind[1]])
-                    #print ("np.shape(iw) =", np.shape(iw))
-                    #print ("np.shape(dfrqe_wav[iw[0]]) = ", np.shape(dfrqe_wav[iw[0]]))
-                    #print ("np.shape(dfrqe_rqe[iw[0]]) = ", np.shape(dfrqe_rqe[iw[0]]))
-                    #print ("int_tab=", int_tab)
-                    print ("dff = ", dff)
-
-                # interpolate over dflat cube
-                iloc = auxfunc.idl_valuelocate(dfwave, flat_wave[j])[0]
-                if dfwave[iloc] > flat_wave[j]:
-                    iloc -= 1
-                ibr = [iloc]
-                if iloc != len(dfwave)-1:
-                    ibr.append(iloc+1)
-                # get the values in the z-array at indeces ibr, and x=pind[1] and y=pind[0]
-                zz = dfim[:, pind[0], pind[1]][[ibr]]
-                # now determine the length of the array with only the finite numbers
-                zzwherenonan = np.where(np.isfinite(zz))
-                kk = np.size(zzwherenonan)
-                dfs = 1.0
-                if (flat_wave[j] <= max(dfwave)) and (flat_wave[j] >= min(dfwave)) and (kk == 2):
-                    dfs = np.interp(flat_wave[j], dfwave[ibr], zz[zzwherenonan])
-                # check DQ flags
-                if dfimdq[pind[0]][pind[1]] != 0:
-                    dfs = 1.0
-
-                # integrate over S-flat fast vector
-                sfv_wav = sfv.field("WAVELENGTH")
-                sfv_dat = sfv.field("DATA")
-                iw = np.where((sfv_wav >= flat_wave[j]-delw/2.0) & (sfv_wav <= flat_wave[j]+delw/2.0))
-                sff = 1.0
-                if np.size(iw) != 0:
-                    int_tab = auxfunc.idl_tabulate(sfv_wav[iw], sfv_dat[iw])
-                    first_sfv_wav, last_sfv_wav = sfv_wav[iw[0]][0], sfv_wav[iw[0]][-1]
-                    sff = int_tab/(last_sfv_wav - first_sfv_wav)
-
-                # interpolate s-flat cube
-                iloc = auxfunc.idl_valuelocate(sfimwave, flat_wave[j])[0]
-                ibr = [iloc]
-                if iloc != len(sfimwave)-1:
-                    ibr.append(iloc+1)
-                # get the values in the z-array at indeces ibr, and x=pind[1] and y=pind[0]
-                zz = sfim[:, pind[0], pind[1]][[ibr]]
-                # now determine the length of the array with only the finite numbers
-                zzwherenonan = np.where(np.isfinite(zz))
-                kk = np.size(zzwherenonan)
-                sfs = 1.0
-                if (flat_wave[j] <= max(sfimwave)) and (flat_wave[j] >= min(sfimwave)) and (kk == 2):
-                    sfs = np.interp(flat_wave[j], sfimwave[ibr], zz[zzwherenonan])
-                # check DQ flags
-                kk = np.where(sfimdq[:, pind[0], pind[1]][[ibr]] == 0)
-                if np.size(kk) != 2:
-                    sfs = 1.0
-
-                # integrate over f-flat fast vector
-                # reference file wavelength range is from 0.6 to 5.206 microns, so need to force
-                # solution to 1 for wavelengths outside that range
-                ffv_wav = ffv.field("WAVELENGTH")
-                ffv_dat = ffv.field("DATA")
-                fff = 1.0
-                if (flat_wave[j]-delw/2.0 >= 0.6) and (flat_wave[j]+delw/2.0 <= 5.206):
-                    iw = np.where((ffv_wav >= flat_wave[j]-delw/2.0) & (ffv_wav <= flat_wave[j]+delw/2.0))
-                    if np.size(iw) > 1:
-                        int_tab = auxfunc.idl_tabulate(ffv_wav[iw], ffv_dat[iw])
-                        first_ffv_wav, last_ffv_wav = ffv_wav[iw[0]][0], ffv_wav[iw[0]][-1]
-                        fff = int_tab/(last_ffv_wav - first_ffv_wav)
-
-                # interpolate over f-flat cube
-                ffs = np.interp(flat_wave[j], ffsallwave, ffsall[:, col-1, row-1])
-                flatcor[j] = dff*dfs*sff*sfs*fff*ffs
-
-                if (pind[1]-px0+1 == 9999) and (pind[0]-py0+1 == 9999):
-                    print ("pind = ", pind)
-                    print ("flat_wave[j] = ", flat_wave[j])
-                    print ("dfs, dff = ", dfs, dff)
-                    print ("sfs, sff = ", sfs, sff)
-                    # make plot
-                    font = {#'family' : 'normal',
-                            'weight' : 'normal',
-                            'size'   : 16}
-                    matplotlib.rc('font', **font)
-                    fig = plt.figure(1, figsize=(12, 10))
-                    plt.subplots_adjust(hspace=.4)
-                    ax = plt.subplot(111)
-                    xmin = flat_wave[j]-0.01
-                    xmax = flat_wave[j]+0.01
-                    plt.xlim(xmin, xmax)
-                    #plt.ylim(min(dfim[:, pind[0], pind[1]])*0.9, max(dfim[:, pind[0], pind[1]])*1.1)
-                    plt.plot(dfwave, dfim[:, pind[0], pind[1]], linewidth=7, marker='D', color='k', label="dflat_im")
-                    plt.plot(flat_wave[j], dfs, linewidth=7, marker='D', color='r')
-                    plt.plot(dfrqe_wav, dfrqe_rqe, linewidth=7, marker='D', c='k', label="dflat_vec")
-                    plt.plot(flat_wave[j], dff, linewidth=7, marker='D', color='r')
-                    plt.plot(sfimwave, sfim[:, pind[0], pind[1]], linewidth=7, marker='D', color='k', label="sflat_im")
-                    plt.plot(flat_wave[j], sfs, linewidth=7, marker='D', color='r')
-                    plt.plot(sfv_wav, sfv_dat, linewidth=7, marker='D', color='k', label="sflat_vec")
-                    plt.plot(flat_wave[j], sff, linewidth=7, marker='D', color='r')
-                    # add legend
-                    box = ax.get_position()
-                    ax.set_position([box.x0, box.y0, box.width * 1.0, box.height])
-                    ax.legend(loc='upper right', bbox_to_anchor=(1, 1))
-                    plt.minorticks_on()
-                    plt.tick_params(axis='both', which='both', bottom='on', top='on', right='on', direction='in', labelbottom='on')
-                    plt.show()
-                    print ("Exiting the program. Unable to determine mean and std_dev. Test set to be skiped.")
-                    plt.close()
-                    msg = "Unable to determine mean and std_dev. Test set to be skiped."
-                    median_diff = "skip"
-                    return median_diff, msg
-
-                if debug:
-                    print ("dfs = ", dfs)
-                    print ("sff = ", sff)
-                    print ("sfs = ", sfs)
-                    print ("ffs = ", ffs)
-
-                # Difference between pipeline and calculated values
-                if ((pind[0]-py0) < np.shape(pipeflat)[0]) and ((pind[1]-px0) < np.shape(pipeflat)[1]):
-                    delf[j] = pipeflat[pind[0]-py0, pind[1]-px0] - flatcor[j]
-                else:
-                    break
-                #print("pind[0], py0, pind[1], px0, flatcor[j] : ", pind[0], py0, pind[1], px0, flatcor[j])
-                #print("(pind[0]-py0, pind[1]-px0) : ", pind[0]-py0, pind[1]-px0 )
-                #print("(pind[0]-py0, pind[1]-px0) - flatcor[j] : ", (pind[0]-py0, pind[1]-px0) - flatcor[j])
-                #print("np.shape(pipeflat) = ", np.shape(pipeflat))
-                #print("delf[j] : ", delf[j])
-
-                # Remove all pixels with values=1 (mainly inter-slit pixels) for statistics
-                if pipeflat[pind[0]-py0, pind[1]-px0] == 1:
-                    delf[j] = 999.0
-                else:
-                    flatcor[j] = 1.0   # no correction if no wavelength
-
-        wc_hdulist.close()
-
+    # index the MSA shutter configuration (extension SHUTTER_INFO of the msa file) by slitlet
+    msa_conf = auxfunc.read_msa_shutter_conf(msa_shutter_conf)
+
+    # in parallel runs the F-flat quadrants are read here once, and shared with the worker processes
+    if n_workers is not None and int(n_workers) > 1:
+        load_fflat_quadrants(ffile, fflat_hdrs, fflat_quads, wc, msa_conf)
+
+    # calculate the flat of each 2D subwindow, in parallel if n_workers > 1; the results come back in the order of
+    # the extensions, so the statistics, plots, and output files are the same as in a serial run
+    slitlet_data = dict(wc=wc, pipeflat=pipeflat,
+                        dflat=[dfwave, dfim, dfimdq, dfrqe], sflat=[sfimwave, sfim, sfimdq, sfv], ffile=ffile,
+                        fflat_hdrs=fflat_hdrs, fflat_quads=fflat_quads, msa_conf=msa_conf, debug=debug)
+    wc_exts = list(range(1, len(wc.headers.headers)))
+    # the histograms that are only saved are rendered in the background while the next slitlets are calculated
+    plot_queue = auxfunc.start_plot_queue(show_figs, save_figs, n_workers=n_workers)
+    for slit_id, slitlet_id, flatcor, delf, wave_shape in auxfunc.run_in_pool(calc_slitlet, wc_exts, slitlet_data,
+                                                                             n_workers=n_workers):
         delfg = delf[np.where((delf != 999.0) & (delf >= -0.1))]   # ignore outliers
         delfg_median, delfg_std = np.median(delfg), np.std(delfg)
         print ("median, stdev in flat value differences: ", delfg_median, delfg_std)
@@ -483,40 +412,14 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
             test_result = "FAILED"
         print (" *** Result of the test: ",test_result)
 
-        # make histogram
-        font = {#'family' : 'normal',
-                'weight' : 'normal',
-                'size'   : 16}
-        matplotlib.rc('font', **font)
-        alpha = 0.2
-        fontsize = 15
-        fig = plt.figure(1, figsize=(8, 6))
-        plt.subplots_adjust(hspace=.4)
-        ax = plt.subplot(111)
-        t= (filt, grat, "   SLIT", slit_id)
-        plt.title(" ".join(t))
-        plt.xlabel("flat$_{pipe}$ - flat$_{calc}$")
-        plt.ylabel("N")
-        xmin = delfg_median - delfg_std*5
-        xmax = delfg_median + delfg_std*5
-        plt.xlim(xmin, xmax)
-        x_median = "median = {:0.3}".format(delfg_median)
-        x_stddev = "stddev = {:0.3}".format(delfg_std)
-        ax.text(0.7, 0.9, x_median, transform=ax.transAxes, fontsize=fontsize)
-        ax.text(0.7, 0.83, x_stddev, transform=ax.transAxes, fontsize=fontsize)
-        plt.tick_params(axis='both', which='both', bottom='on', top='on', right='on', direction='in', labelbottom='on')
-        binwidth = (xmax-xmin)/40.
-        _, _, _ = ax.hist(delfg, bins=np.arange(xmin, xmax + binwidth, binwidth), histtype='bar', ec='k', facecolor="red", alpha=alpha)
-
-        if save_figs:
-            #if plot_name is None:
+        # make histogram, in the background if it is only saved
+        if show_figs or save_figs:
+            t = (filt, grat, "   SLIT", slit_id)
+            title = " ".join(t)
             file_basename = step_input_filename.replace(".fits", "")
             plot_name = file_basename+"_"+slitlet_id+"_MOS_flattest_histogram.pdf"
-            plt.savefig(plot_name)
-            print ('\n Plot saved: ', plot_name)
-        if show_figs:
-            plt.show()
-        plt.close()
+            auxfunc.make_plot(plot_queue, mk_hist, title=title, delfg=delfg, delfg_median=delfg_median,
+                              delfg_std=delfg_std, save_figs=save_figs, show_figs=show_figs, plot_name=plot_name)
 
 
         # create fits file to hold the calculated flat for each slit
@@ -530,6 +433,8 @@ def flattest(step_input_filename, dflatref_path=None, sfile_path=None, fflat_pat
             complfile.append(complfile_ext)
 
 
+    auxfunc.finish_plot_queue(plot_queue)
+
     if writefile:
         outfile_name = step_input_filename.replace("2d_flat_field.fits", det+"_flat_calc.fits")
         complfile_name = step_input_filename.replace("2d_flat_field.fits", det+"_flat_comp.fits")
@@ -0,0 +1,31 @@
+import os
+import numpy as np
+from astropy.io import fits
+
+from .. import auxiliary_functions as auxfunc
+
+
+"""
+This script tests the in-memory cache of the world coordinates files.
+"""
+
+
+def test_world_coordinates_cache_is_bounded(tmpdir):
+    """
+    Only the last few world coordinates files are kept in memory, and a file that changes is read again.
+    """
+    auxfunc.cached_world_coordinates.cache_clear()
+    wc_file_names = []
+    for i in range(6):
+        wc_file_name = str(tmpdir.join("world_coordinates_"+str(i)+".fits"))
+        fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(np.zeros((2, 3)) + i)]).writeto(wc_file_name)
+        wc_file_names.append(wc_file_name)
+        assert auxfunc.read_world_coordinates(wc_file_name).data[1][0, 0] == i
+    cache_info = auxfunc.cached_world_coordinates.cache_info()
+    assert cache_info.currsize == cache_info.maxsize < len(wc_file_names)
+
+    wc_file_name = wc_file_names[-1]
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(np.zeros((2, 3)) - 1)]).writeto(wc_file_name, overwrite=True)
+    mtime = os.path.getmtime(wc_file_name) + 1
+    os.utime(wc_file_name, (mtime, mtime))
+    assert auxfunc.read_world_coordinates(wc_file_name).data[1][0, 0] == -1
@@ -0,0 +1,83 @@
+import os
+import numpy as np
+from astropy.io import fits
+
+from .. import auxiliary_functions as auxfunc
+from .. import compare_wcs_mos
+
+
+"""
+This script tests that compare_wcs_mos works with the world coordinates saved in the cache by
+auxfunc.get_world_coordinates (no pipeline run is needed, the world coordinates are already there).
+"""
+
+
+# origin and size of the slitlet subwindow
+px0, py0, nx, ny = 101, 201, 6, 4
+
+
+def mk_products(data_dir):
+    """
+    This function writes a rate file, its extract_2d product, the MSA configuration file, the world coordinates
+    of the product in the cache, and the matching ESA file.
+    Args:
+        data_dir: string, directory where the files are written
+
+    Returns:
+        infile_name: string, extract_2d product
+        msa_conf_name: string, MSA configuration file
+        esafile: string, ESA file of the slitlet
+    """
+    keywds = dict(DETECTOR="NRS1", LAMP="LINE1", GRATING="G140M", FILTER="F100LP", MSAMETFL="test_msa.fits")
+    rate_file = os.path.join(data_dir, "test_rate.fits")
+    infile_name = os.path.join(data_dir, "test_rate_assign_wcs_extract_2d.fits")
+    for file_name in (rate_file, infile_name):
+        prihdu = fits.PrimaryHDU()
+        prihdu.header.update(keywds)
+        fits.HDUList([prihdu, fits.ImageHDU(np.zeros((ny, nx)), name="SCI")]).writeto(file_name)
+
+    msa_conf_name = os.path.join(data_dir, "test_msa.fits")
+    cols = [fits.Column(name="SLITLET_ID", format="J", array=[1]),
+            fits.Column(name="SHUTTER_QUADRANT", format="J", array=[3]),
+            fits.Column(name="SHUTTER_ROW", format="J", array=[12]),
+            fits.Column(name="SHUTTER_COLUMN", format="J", array=[34]),
+            fits.Column(name="BACKGROUND", format="1A", array=["N"])]
+    shutter_info = fits.BinTableHDU.from_columns(cols, name="SHUTTER_INFO")
+    fits.HDUList([fits.PrimaryHDU(), shutter_info]).writeto(msa_conf_name)
+
+    # world coordinates of the slitlet: wavelength (microns) and relative slit position in planes 0 and 3
+    wave = 1.0 + np.arange(nx*ny).reshape(ny, nx) * 1.0e-3
+    dy = np.zeros((ny, nx)) + 0.25
+    wc_data = np.array([wave, wave, wave, dy])
+    wc_hdu = fits.ImageHDU(wc_data)
+    wc_hdu.header.update(dict(SLIT="1", CRVAL1=px0, CRVAL2=py0))
+    key = auxfunc.get_world_coordinates_key(infile_name)
+    cache_dir = os.path.join(data_dir, auxfunc.world_coordinates_cache_dir_name)
+    os.makedirs(cache_dir)
+    wc_file_name = os.path.join(cache_dir, "world_coordinates_"+key+".fits")
+    fits.HDUList([fits.PrimaryHDU(), wc_hdu]).writeto(wc_file_name)
+
+    # ESA file with the same wavelengths (in m) and slit positions
+    esafile = os.path.join(data_dir, "Trace_MOS_3_012_034_test.fits")
+    esa_hdus = [fits.PrimaryHDU()]
+    for name, arr in [("DATA1", np.ones((ny, nx))), ("VAR1", None), ("QUALITY1", None),
+                      ("LAMBDA1", wave*1.0e-6), ("SLITY1", dy), ("MSAX1", np.zeros((ny, nx))),
+                      ("MSAY1", np.zeros((ny, nx)))]:
+        if arr is None:
+            arr = np.zeros((ny, nx))
+        esa_hdus.append(fits.ImageHDU(arr, name=name))
+    esa_hdus[1].header.update(dict(CRVAL1=px0, CRPIX1=1, CRVAL2=py0, CRPIX2=1))
+    fits.HDUList(esa_hdus).writeto(esafile)
+    return infile_name, msa_conf_name, esafile
+
+
+def test_compare_wcs_cached_world_coordinates(tmpdir, monkeypatch):
+    """
+    The extract_2d product keywords are read from the product itself, not from the world coordinates file in the
+    cache, and the comparison with the ESA file passes.
+    """
+    infile_name, msa_conf_name, esafile = mk_products(str(tmpdir))
+    monkeypatch.setattr(auxfunc, "get_esafile", lambda *args: esafile)
+    median_diff = compare_wcs_mos.compare_wcs(infile_name, msa_conf_name=msa_conf_name,
+                                              esa_files_path=str(tmpdir), show_figs=False, save_figs=False)
+    assert median_diff
@@ -21,7 +21,9 @@ def pytest_addoption(parser):
 @pytest.fixture(scope="session", autouse=True)
 def config(request):
     config = configparser.ConfigParser()
-    config.read(request.config.getoption("--config_file"))
+    config_file = request.config.getoption("--config_file")
+    if config_file is not None:
+        config.read(config_file)
     return config
 
 """
@@ -1,5 +1,6 @@
 import collections
 import os
+import types
 import numpy as np
 from astropy.io import fits
 
@@ -76,6 +77,69 @@ def get_keywd_val(fits_file_name, keywd, ext=0):
     return keywd_val
 
 
+# header snapshot of a fits file: file name and a read-only dictionary of read-only keyword dictionaries per extension
+HeaderSnapshot = collections.namedtuple("HeaderSnapshot", ["file_name", "headers"])
+
+
+def read_header_snapshot(fits_file_name, extensions=None):
+    """
+    This function opens the fits file only once and reads the keywords of the given extensions into an immutable
+    snapshot, so that many keyword values can be obtained without reopening and parsing the file each time (as it
+    happens with fits.getval).
+    Args:
+        fits_file_name: name of the fits file (with full path)
+        extensions: list of integers, extensions to be read, if None all the extensions in the file are read
+
+    Returns:
+        snapshot: HeaderSnapshot, the headers attribute is a read-only dictionary of extension number to a read-only
+                  dictionary of keyword to value
+    """
+    with fits.open(fits_file_name) as hdulist:
+        snapshot = snapshot_hdulist(fits_file_name, hdulist, extensions=extensions)
+    return snapshot
+
+
+def snapshot_hdulist(fits_file_name, hdulist, extensions=None):
+    """
+    This function reads the keywords of the given extensions of an open (or in memory) HDUList into an immutable
+    snapshot (see read_header_snapshot).
+    Args:
+        fits_file_name: name of the fits file the HDUList belongs to
+        hdulist: astropy HDUList
+        extensions: list of integers, extensions to be read, if None all the extensions in the HDUList are read
+
+    Returns:
+        snapshot: HeaderSnapshot
+    """
+    headers = {}
+    if extensions is None:
+        extensions = range(len(hdulist))
+    for ext in extensions:
+        keywds = {}
+        for card in hdulist[ext].header.cards:
+            # keep the first occurrence, as fits.getval does
+            if card.keyword not in keywds:
+                keywds[card.keyword] = card.value
+        headers[ext] = types.MappingProxyType(keywds)
+    snapshot = HeaderSnapshot(fits_file_name, types.MappingProxyType(headers))
+    return snapshot
+
+
+def get_snapshot_val(snapshot, keywd, ext=0):
+    """
+    This function obtains the value corresponding to the given keyword from a header snapshot.
+    Args:
+        snapshot: HeaderSnapshot, output of function read_header_snapshot
+        keywd: keyword for which to obtain the value
+        ext: extension in which the keyword lives, by default it is set to the primary extension
+
+    Returns:
+        keywd_val: the value corresponding to the inputed keyword
+    """
+    keywd_val = snapshot.headers[ext][keywd.upper()]
+    return keywd_val
+
+
 def get_sci_extensions(fits_file_name):
     """
     This function obtains all the science extensions in the given file
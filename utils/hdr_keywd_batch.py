@@ -0,0 +1,152 @@
+import contextlib
+import io
+import multiprocessing
+import os
+import traceback
+from glob import glob, has_magic
+
+
+'''
+This script contains the functions to run the header keyword check of hdr_keywd_check.py or
+level2b_hdr_keywd_check.py over many fits files (given directly, as directories, or as glob patterns) in a single
+command, using a pool of processes. Instead of a _addedkeywds.txt file per fits file, the warnings of all the files
+are written, as soon as each file is checked, into a single report with one row per file and keyword.
+
+Example usage:
+    > python /path_to_this_script/hdr_keywd_check.py /path_to_data/ -m=FS -j=8 -r=report.txt
+    > python /path_to_this_script/level2b_hdr_keywd_check.py "/path_to_data/*_rate.fits" IFU
+
+'''
+
+# exit status of a batch run: all files have the expected keywords, at least one file has warnings (their headers
+# were updated), and at least one file was not found or could not be checked
+exit_status_ok = 0
+exit_status_warnings = 1
+exit_status_failed = 2
+
+
+def find_fits_files(paths):
+    """
+    This function makes the list of fits files to be checked. Directories are replaced by the fits files in them,
+    and glob patterns by the files that match them; in both cases the files created by a previous run of the check
+    (with suffix _updatedHDR) are skipped.
+    Args:
+        paths: list of strings, fits files, directories, or glob patterns
+
+    Returns:
+        fits_files: list of strings, fits files in the given order and without repetitions
+    """
+    fits_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = sorted(glob(os.path.join(path, "*.fits")))
+        elif has_magic(path):
+            matches = sorted(glob(path))
+        else:
+            fits_files.append(path)
+            continue
+        fits_files.extend(f for f in matches if not f.endswith("_updatedHDR.fits"))
+    fits_files = list(dict.fromkeys(fits_files))
+    return fits_files
+
+
+def is_batch(paths, fits_files, report_file_name):
+    """
+    This function tells if the check has to run in batch mode, i.e. if more than one file, a directory, or a glob
+    pattern was given, or a report was requested.
+    Args:
+        paths: list of strings, command line arguments (fits files, directories, or glob patterns)
+        fits_files: list of strings, output of find_fits_files
+        report_file_name: string or None, name of the report file given in the command line
+
+    Returns:
+        batch: boolean
+    """
+    batch = (report_file_name is not None) or (len(paths) != 1) or (fits_files != list(paths))
+    return batch
+
+
+def check_file(task):
+    """
+    This function runs the keyword check of a single file in a process of the pool. What the check prints on
+    screen is discarded, since the processes would mix it up; the warnings are returned to go into the report.
+    Args:
+        task: tuple, perform_check function of the script, fits file name, only_update, and mode_used
+
+    Returns:
+        fits_file: string, name of the fits file
+        warnings_list: list of strings, warnings of the file (without repetitions)
+        error: string or None, the error message if the file could not be checked
+    """
+    perform_check, fits_file, only_update, mode_used = task
+    warnings_list, error = [], None
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            warnings_list = perform_check(fits_file, only_update, mode_used, write_addedkeywds=False)
+    except Exception:
+        error = traceback.format_exc().strip().split("\n")[-1]
+    return fits_file, warnings_list, error
+
+
+def run_batch(perform_check, fits_files, only_update, mode_used, report_file_name, n_workers=None):
+    """
+    This function checks the keywords of all the fits files in a pool of processes, and writes the rows of the
+    report in the order of the files, as soon as they are available.
+    Args:
+        perform_check: function, the perform_check function of hdr_keywd_check.py or level2b_hdr_keywd_check.py
+        fits_files: list of strings, fits files to be checked (see find_fits_files)
+        only_update: boolean, if False a new file will be created for each input file; True will only update
+        mode_used: str or None, observation mode used FS, MOS, or IFU
+        report_file_name: string, name of the report file
+        n_workers: integer, number of processes (if None, the number of CPUs)
+
+    Returns:
+        exit_status: integer, exit_status_ok, exit_status_warnings, or exit_status_failed (also if there are no
+                     files to check, e.g. a glob pattern that matches nothing)
+    """
+    if len(fits_files) == 0:
+        print (' * ERROR: no fits files found to check')
+        return exit_status_failed
+    # the files that do not exist are reported as errors without sending them to the pool
+    missing_files = set(fits_file for fits_file in fits_files if not os.path.isfile(fits_file))
+    tasks = [(perform_check, fits_file, only_update, mode_used) for fits_file in fits_files
+             if fits_file not in missing_files]
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = max(1, min(n_workers, len(tasks)))
+    print ('Checking ', len(tasks), ' files with ', n_workers, ' processes...')
+    print ('Name of the report file:  ', report_file_name)
+    files_with_warnings, failed_files = [], []
+    with open(report_file_name, 'w') as rf:
+        rf.write('### Keywords added or with the wrong format, and files that could not be checked: \n')
+        rf.write('# {:<60} {:<15} {:<9} {:<25} \n'.format('File', 'Keyword', 'Extension', 'Comments'))
+        with multiprocessing.Pool(n_workers) as pool:
+            results = pool.imap(check_file, tasks)
+            for fits_file in fits_files:
+                if fits_file in missing_files:
+                    rf.write('{:<62} {:<15} {:<9} {:<25}\n'.format(fits_file, '-', '-', 'ERROR: file not found'))
+                    print (' * ', fits_file, '  not found')
+                    rf.flush()
+                    continue
+                fits_file, warnings_list, error = next(results)
+                if error is not None:
+                    failed_files.append(fits_file)
+                    rf.write('{:<62} {:<15} {:<9} {:<25}\n'.format(fits_file, '-', '-', 'ERROR: '+error))
+                    print (' * ', fits_file, '  could not be checked: ', error)
+                elif len(warnings_list) > 0:
+                    files_with_warnings.append(fits_file)
+                    for warning in warnings_list:
+                        rf.write('{:<62} {}\n'.format(fits_file, warning))
+                    print (' * ', fits_file, '  ', len(warnings_list), ' keywords added or changed')
+                else:
+                    print (' * ', fits_file, '  has the expected keywords')
+                rf.flush()
+
+    print ('\n Files checked: ', len(tasks), '   with warnings: ', len(files_with_warnings),
+           '   could not be checked: ', len(failed_files), '   not found: ', len(missing_files))
+    exit_status = exit_status_ok
+    if len(failed_files) > 0 or len(missing_files) > 0:
+        exit_status = exit_status_failed
+    elif len(files_with_warnings) > 0:
+        exit_status = exit_status_warnings
+    return exit_status
@@ -38,8 +38,8 @@ keywd_dict['SDP_VER']= 'B7.0' # Data processing software version number, e.g. 0.
 keywd_dict['DATE-OBS']= '2017-05-01' # UTC date at start of exposure, e.g. 2013-01-19
 keywd_dict['TIME-OBS']= '17:29:39.026' # UTC time at start of exposure, e.g. 18:23:34.230
 keywd_dict['OBS_ID']  = 'V84600010001P0000000002101' # full programmatic observation identifier
-keywd_dict['VISIT_ID']= '' # visit identifier
-keywd_dict['PROGRAM'] = '12345' # program number, e.g. '12345'
+keywd_dict['VISIT_ID']= 'V84600010001' # visit identifier, e.g. V84600010001
+keywd_dict['PROGRAM'] = 'test1' # program number, e.g. test1
 keywd_dict['OBSERVTN']= '001' # observation number, e.g. 001
 keywd_dict['VISIT']   = '001' # visit number, e.g. 001
 keywd_dict['VISITGRP']= '01' # visit group identifier, e.g. 01
@@ -93,7 +93,7 @@ keywd_dict['TARG_DEC']= 0.0 # target DEC computed at time of exposure, e.g. 0.0
 keywd_dict['TARRUDEC']= 0.0 # target Dec uncertainty, e.g. 0.0
 keywd_dict['PROP_RA'] = 0.0 # proposer specified RA for the target, e.g. 0.0
 keywd_dict['PROP_DEC']= 0.0 # proposer specified Dec for the target, e.g. 0.0
-keywd_dict['MU_EPOCH']= '2000-01-01T00:00:00.000' # epoch of proper motion values for RA and Dec, proposer specified, e.g. 2000.0
+keywd_dict['MU_EPOCH']= 2000.0 # epoch of proper motion values for RA and Dec, proposer specified, e.g. 2000.0
 
 # Exposure times
 keywd_dict['EXPSTART']= 57404.72892391204 # UTC exposure start time (MJD), e.g. 56311.76636840278
@@ -0,0 +1,464 @@
+import collections
+import os
+from astropy.io import fits
+from collections import OrderedDict
+
+import hdr_keywd_rules as hkrules
+
+
+'''
+This script contains the engine that checks and fixes the header keywords of the fits files, for any keyword schema:
+the level 2a schema of hdr_keywd_check.py (hdr_keywd_dict.py with the values of hdr_keywd_dict_sample.py), the level
+2b schema of level2b_hdr_keywd_check.py (level2b_hdr_keywd_dict_sample.py), or any future one (see make_schema).
+The headers of a file are read only once, also to check it against several schemas (see check_schemas).
+
+Example usage:
+    import hdr_keywd_dict as hkwd
+    import hdr_keywd_dict_sample as shkvd
+    import level2b_hdr_keywd_dict_sample as lev2bdict
+    import hdr_keywd_engine as hkengine
+    level2a_schema = hkengine.make_schema('level2a', hkwd.keywd_dict, sample_dict=shkvd.keywd_dict)
+    level2b_schema = hkengine.make_schema('level2b', lev2bdict.keywd_dict, sample_values=True, sci_values=True,
+                                          ifu_datamodl='IFUImageModel')
+    schema_results = hkengine.check_schemas('blah.fits', [level2a_schema, level2b_schema], 'FS')
+
+'''
+
+# keyword schema: name, dictionary of the keywords to check (allowed values and/or types, or sample values), sample
+# values of the keywords that are added, compiled rules, True if the values in the science header take precedence
+# over those in the main header, and data model set when the mode is IFU (or None)
+KeywdSchema = collections.namedtuple("KeywdSchema", ["name", "keywd_dict", "sample_dict", "rules", "sci_values",
+                                                     "ifu_datamodl"])
+
+# headers of a fits file: dictionary of keyword to value (as a string) of the main header, and science header
+FileHeaders = collections.namedtuple("FileHeaders", ["keywd_dict", "sci_header"])
+
+# results of the check of a file against a schema: warnings and keywords to be modified (without repetitions), and
+# the specific keys and values that need to be changed
+SchemaResult = collections.namedtuple("SchemaResult", ["warnings_list", "missing_keywds", "specific_keys_dict"])
+
+
+### General functions
+
+def get_modeused_PTT_cfg_file():
+    # get script directory and config name
+    utils_dir = os.path.abspath(os.path.dirname(os.path.realpath(__file__)))
+    PPT_cfg_file = utils_dir.replace("utils", "calwebb_spec2_pytests/cwspec2_config.cfg")
+    with open(PPT_cfg_file, "r") as cfg:
+        for i, line in enumerate(cfg.readlines()):
+            if "mode_used" in line:
+                mode_used = line.split()[2]
+    return mode_used
+
+
+def make_schema(name, keywd_dict, sample_dict=None, sample_values=False, sci_values=False, ifu_datamodl=None):
+    """
+    This function compiles a keyword dictionary into a schema for the engine.
+    Args:
+        name: string, name of the schema, e.g. level2a
+        keywd_dict: dictionary, keyword to list of allowed values and/or types, or keyword to sample value
+        sample_dict: dictionary, keyword to the value given to the keyword when it is added (if None, keywd_dict)
+        sample_values: boolean, True if keywd_dict has sample values (the values have to be of the same type)
+        sci_values: boolean, if True the values in the science header take precedence over those in the main header
+        ifu_datamodl: string or None, value of DATAMODL to be set when the mode used is IFU
+
+    Returns:
+        keywd_schema: KeywdSchema
+    """
+    if sample_dict is None:
+        sample_dict = keywd_dict
+    rules = hkrules.compile_rules(keywd_dict, sample_values=sample_values)
+    keywd_schema = KeywdSchema(name, keywd_dict, sample_dict, rules, sci_values, ifu_datamodl)
+    return keywd_schema
+
+
+def read_file_headers(fits_file_name):
+    """
+    This function opens the fits file once and reads its main and science headers (not the data).
+    Args:
+        fits_file_name: full path with name of the fits file
+
+    Returns:
+        file_headers: FileHeaders, the science header is None if the file has no extensions
+    """
+    with fits.open(fits_file_name) as hdulist:
+        keywd_dict = read_hdrcards(hdulist[0].header)
+        sci_header = None
+        if len(hdulist) > 1:
+            sci_header = hdulist[1].header
+    file_headers = FileHeaders(keywd_dict, sci_header)
+    return file_headers
+
+
+def read_hdrfits(fits_file_name):
+    '''
+    This function reads the primary header of the fits file and returns a dictionary of the keywords with
+    corresponding values. Keywords will be stored in the order they are read. Only the header is read from the
+    file (no data, and no other files are written).
+    Args:
+        fits_file_name: full path with name of the fits file
+
+    Returns:
+        A dictionary of keywords with corresponding values
+    '''
+    hdr = fits.getheader(fits_file_name, 0)
+    keywd_dict = read_hdrcards(hdr)
+    return keywd_dict
+
+
+def read_hdrcards(hdr):
+    '''
+    This function returns a dictionary of the keywords with corresponding values from the cards of a header, with
+    the values as strings exactly as read_hdrtxt obtains them from the printed header. Keywords will be stored in
+    the order they are read.
+    Args:
+        hdr: astropy header
+
+    Returns:
+        A dictionary of keywords with corresponding values
+    '''
+    keywd_dict = collections.OrderedDict()
+    for card in hdr.cards:
+        # long string values take more than one card image of 80 characters, the printed header has a line for each
+        card_image = card.image
+        for i in range(0, len(card_image), 80):
+            read_hdrline(card_image[i:i+80], keywd_dict)
+    return keywd_dict
+
+
+def read_hdrtxt(hdr_txt_file):
+    '''
+    This function reads the header text file and returns a dictionary of the keywords with
+    corresponding values. Keywords will be stored in the order they are read.
+    Args:
+        hdr_txt_file: full path with name of the header text file
+
+    Returns:
+        A dictionary of keywords with corresponding values
+    '''
+    keywd_dict = collections.OrderedDict()
+    with open(hdr_txt_file, 'r') as htf:
+        for line in htf.readlines():
+            read_hdrline(line, keywd_dict)
+    return keywd_dict
+
+
+def read_hdrline(line, keywd_dict):
+    '''
+    This function adds the keyword and value of a line of a printed header to the dictionary.
+    Args:
+        line: string, line of the printed header (or card image)
+        keywd_dict: dictionary of keywords with corresponding values
+    '''
+    if '=' in line:   # identify keywords by lines containing a =
+        line_list = line.split('=')
+        keywd = line_list[0].split()[0]   # remove the white spaces from the keyword
+        keywd_val = line_list[1].split()[0]  # remove the white spaces from the keyword value
+        if "'" in keywd_val:
+            keywd_val = keywd_val.replace("'", "")   # remove the extra '
+        keywd_dict[keywd] = keywd_val   # add dictionary entry
+
+
+def create_addedkeywds_file(fits_file):
+    """
+    This function create text file to log added keywords.
+    Args:
+        fits_file: string, name of the fits file to be keyword checked
+
+    Returns:
+        addedkeywds_file_name: string, the file name where all added keywords were saved
+    """
+    addedkeywds_file_name = fits_file.replace(".fits", "_addedkeywds.txt")
+    print ('Name of text file containing all keywords added:  ', addedkeywds_file_name)
+    tf = open(addedkeywds_file_name, 'w')
+    tf.write('### The following keywords were added or have the wrong format: \n')
+    tf.write('# {:<12} {:<10} {:<25} \n'.format('Keyword', 'Extension', 'Comments'))
+    tf.close()
+    return addedkeywds_file_name
+
+
+def check_addedkeywds_file(addedkeywds_file_name):
+    """
+    If no new keywords were added, the text file is set to empty, and this function will erase it.
+    Args:
+        addedkeywds_file_name: string, name of text file to check
+
+    Returns:
+        nothing
+
+    """
+    with open(addedkeywds_file_name, 'r') as wf:
+        lines = wf.readlines()
+        if len(lines) == 1:
+            os.remove(addedkeywds_file_name)
+
+
+### keyword and format check
+
+def get_keywd_values(keywd_schema, file_headers):
+    """
+    This function gets the values of the keywords of the main header to be checked with the schema.
+    Args:
+        keywd_schema: KeywdSchema
+        file_headers: FileHeaders
+
+    Returns:
+        file_vals: dictionary of keyword to value, taken from the science header if the schema says so and they
+                   are there, otherwise from the main header
+    """
+    if not keywd_schema.sci_values or file_headers.sci_header is None:
+        return file_headers.keywd_dict
+    file_vals = OrderedDict()
+    for key, val in file_headers.keywd_dict.items():
+        orig_val = file_headers.sci_header.get(key)
+        if orig_val is not None:
+            val = orig_val
+        file_vals[key] = val
+    return file_vals
+
+
+def check_keywds(keywd_schema, file_headers, warnings_file_name, warnings_list, missing_keywds, mode_used,
+                 write_warnings=True):
+    """
+    This function will check keywords against those in the keyword dictionary of the schema
+    Args:
+        keywd_schema: KeywdSchema
+        file_headers: FileHeaders, the original headers
+        warnings_file_name: string, name of the file to reccord added keywords
+        warnings_list: list of the warnings to be written into the file
+        missing_keywds: list of the keywords not in the original the header
+        mode_used: str or None, observation mode used FS, MOS, or IFU (if None then a configuration file
+                    is expected to exist and contain a variable named mode_used)
+        write_warnings: boolean, if False the warnings are only appended to warnings_list
+
+    Returns:
+        specific_keys_dict: dictionary with specific keys and values that need to be changed
+    """
+    if mode_used is None:
+        mode_used = get_modeused_PTT_cfg_file()
+    specific_keys_dict = {}
+    file_keywd_dict = file_headers.keywd_dict
+    file_vals = get_keywd_values(keywd_schema, file_headers)
+    # check the values of all the keywords in the file at once, the warnings are saved in the file at the end
+    keywd_warnings = hkrules.check_header(keywd_schema.rules, file_vals)
+    new_warnings = []
+    for key, schema_val in keywd_schema.keywd_dict.items():
+        # Check if keyword is in the file, expect for wcs info (these go in the science extension)
+        if key != 'wcsinfo':
+            ext = 'primary'
+            if key not in file_keywd_dict:
+                missing_keywds.append(key)
+                warning = '{:<15} {:<9} {:<25}'.format(key, ext, 'New keyword added to header')
+                warnings_list.append(warning)
+            else:
+                val = file_vals[key]
+                warning = keywd_warnings[key]
+
+                # specific check for VISITYPE and SUBARRAY, set to GENERIC
+                if (key == 'VISITYPE') or (key == 'SUBARRAY'):
+                    if val not in keywd_schema.rules[key].expected:
+                        # for now always set this keyword to generic
+                        print ("Replacing ", key, val, "for GENERIC")
+                        specific_keys_dict[key] = 'GENERIC'
+                        missing_keywds.append(key)
+
+                # check for right value for EXP_TYPE, default will be to add the sample value: NRS_MSASPEC
+                # (the keywords set from the mode are only changed if they have another value)
+                if key == 'EXP_TYPE':
+                    print('   * MODE_USED  = ', mode_used)
+                    if 'FS' in mode_used:
+                        val = 'NRS_FIXEDSLIT'
+                    if 'IFU' in mode_used:
+                        val = 'NRS_IFU'
+                        ifu_datamodl = keywd_schema.ifu_datamodl
+                        if ifu_datamodl is not None and file_keywd_dict.get('DATAMODL') != ifu_datamodl:
+                            missing_keywds.append('DATAMODL')
+                    if 'MOS' in mode_used:
+                        val = 'NRS_MSASPEC'
+                    if val != file_vals[key]:
+                        specific_keys_dict[key] = val
+                        missing_keywds.append(key)
+                        print('     Setting value of ', key, ' to ', val)
+
+                # make sure the MSASTATE keyword is set correctly
+                if key == 'MSASTATE':
+                    if (mode_used == 'FS') or (mode_used == 'IFU'):
+                        val = 'PRIMARYPARK_ALLCLOSED'
+                        if val != file_vals[key]:
+                            specific_keys_dict[key] = val
+                            missing_keywds.append(key)
+
+            if warning is not None:
+                missing_keywds.append(key)
+                warnings_list.append(warning)
+                new_warnings.append(warning)
+        else:
+            # add the WCS keywords that are not in the science extension, and remove them from the main header
+            sci_header = file_headers.sci_header
+            if sci_header is None:
+                sci_header = {}
+            missing_subkeys = [subkey for subkey in schema_val if subkey not in sci_header]
+            if len(missing_subkeys) > 0 or any(subkey in file_keywd_dict for subkey in schema_val):
+                missing_keywds.append(key)
+            for subkey in missing_subkeys:
+                # now add the keyword to in the list to be added into the science extension
+                warning = '{:<15} {:<9} {:<25}'.format(subkey, 'sci', 'New keyword added to header')
+                warnings_list.append(warning)
+                new_warnings.append(warning)
+
+    if write_warnings and len(new_warnings) > 0:
+        with open(warnings_file_name, "a") as tf:
+            tf.write(''.join(warning+'\n' for warning in new_warnings))
+
+    print("keywords to be modified: ", list(OrderedDict.fromkeys(missing_keywds)))
+    return specific_keys_dict
+
+
+def edit_headers(keywd_schema, hdulist, missing_keywds, specific_keys_dict):
+    '''
+    This function makes all the header changes in memory: it adds the missing keywords with the sample values of
+    the schema, changes or removes the specific keywords, and moves the WCS keywords to the science extension. Only
+    the headers are touched, so the data of the file is not read.
+    Args:
+        keywd_schema: KeywdSchema
+        hdulist: astropy HDUList, the opened fits file
+        missing_keywds: list, keywords to be added or changed (without repetitions)
+        specific_keys_dict: dictionary with specific keys and values that need to be changed
+    '''
+    sample_dict = keywd_schema.sample_dict
+    sample_keys = list(sample_dict.keys())
+    main_hdr = hdulist[0].header
+    ext = 0
+    for i, key in enumerate(missing_keywds):
+        if key in specific_keys_dict:
+            #print ("found it in the dict: ", key, specific_keys_dict[key])
+            if specific_keys_dict[key] == 'remove':
+                # keyword to be deleted
+                try:
+                    del hdulist[ext].header[key]
+                except:
+                    KeyError
+            else:
+                # change the keyword to specified value
+                main_hdr.set(key, specific_keys_dict[key])
+            continue
+        # get the index of the keyword previous to the one you want to add
+        prev_key_idx = sample_keys.index(key) - 1
+        # add the keyword in the right place from the right dictionary
+        new_value = sample_dict[key]
+        after_key = sample_keys[prev_key_idx]
+        if after_key == 'wcsinfo':
+            after_key = sample_keys[prev_key_idx-1]
+        if key != 'wcsinfo':
+            print("adding keyword: ", key, " in extension: primary    after: ", after_key)
+            # the DATAMODL keyword will only be modified if mode is IFU
+            if key == 'DATAMODL' and keywd_schema.ifu_datamodl is not None and sample_dict['EXP_TYPE'] == 'NRS_IFU':
+                new_value = keywd_schema.ifu_datamodl
+            main_hdr.set(key, new_value, after=after_key)
+        else:
+            # go into the subdictionary for WCS keywords
+            extname = 'sci'
+            sci_hdr = hdulist[extname].header.copy()
+            for subkey, new_value in sample_dict["wcsinfo"].items():
+                # first remove these keywords from the main header
+                if subkey in main_hdr:
+                    del main_hdr[subkey]
+                if subkey not in sci_hdr:
+                    print("adding keyword: ", subkey, " in extension: ", extname, " with value: ", new_value)
+                    hdulist[1].header.set(subkey, new_value, after='EXTNAME')
+            print ("Science header has been updated.")
+
+
+def add_keywds(keywd_schema, fits_file, only_update, missing_keywds, specific_keys_dict):
+    '''
+    This function adds the missing keywords of the schema and gives them the sample values. All the changes are done
+    in memory (see edit_headers) and the file is written only once: the updated file is a copy of the input where
+    the data blocks are copied as they are, without decoding them, and when only updating, the headers are rewritten
+    in place if they still fit in their padding (otherwise the file is rewritten once).
+    Args:
+        keywd_schema: KeywdSchema
+        fits_file: string, name of the input file
+        only_update: If false a copy of the original fits file will be created with the
+                     updated header.
+        missing_keywds: list, missing keywords will be appended here
+        specific_keys_dict: dictionary with specific keys and values that need to be changed
+    '''
+    missing_keywds = list(OrderedDict.fromkeys(missing_keywds))
+    #print ("specific_keys_dict = ", specific_keys_dict)
+    # create name for updated fits file
+    updated_fitsfile = fits_file
+    open_mode = 'update'
+    if not only_update:
+        updated_fitsfile = fits_file.replace('.fits', '_updatedHDR.fits')
+        open_mode = 'readonly'
+    # add missimg keywords
+    print ('Saving keyword values in file: ', updated_fitsfile)
+    with fits.open(fits_file, mode=open_mode) as hdulist:
+        edit_headers(keywd_schema, hdulist, missing_keywds, specific_keys_dict)
+        if not only_update:
+            hdulist.writeto(updated_fitsfile, overwrite=True)
+
+
+def perform_check(keywd_schema, fits_file, only_update, mode_used, write_addedkeywds=True):
+    """
+    This is the function that does all the work (i.e. uses all other functions) to update the header
+    Args:
+        keywd_schema: KeywdSchema
+        fits_file: string, name of the input file to be checked
+        only_update: boolean, if False a new file will be created; True will only update
+        mode_used: str or None, observation mode used FS, MOS, or IFU
+        write_addedkeywds: boolean, if False the warnings are not saved in a text file (batch mode, where they go
+                           into the report instead)
+
+    Returns:
+        warnings_list: list of the warnings, without repetitions. The other outputs are a text file with all the
+                       added keywords and the new/updated fits file.
+    """
+
+    # read the keywords and corresponding values from fits file directly
+    file_headers = read_file_headers(fits_file)
+
+    # create text file to log warnings
+    print('')
+    addedkeywds_file_name = fits_file.replace(".fits", "_addedkeywds.txt")
+    if write_addedkeywds:
+        addedkeywds_file_name = create_addedkeywds_file(fits_file)
+
+    # check the keywords
+    print('\n   Starting keyword check...')
+    warnings_list, missing_keywds = [], []
+    specific_keys_dict = check_keywds(keywd_schema, file_headers, addedkeywds_file_name, warnings_list,
+                                      missing_keywds, mode_used, write_warnings=write_addedkeywds)
+
+    # if warnings text file is empty erase it
+    if write_addedkeywds:
+        check_addedkeywds_file(addedkeywds_file_name)
+
+    # create new file with updated header or simply update the input fits file
+    print('\n   Adding keywords...')
+    add_keywds(keywd_schema, fits_file, only_update, missing_keywds, specific_keys_dict)
+    return list(OrderedDict.fromkeys(warnings_list))
+
+
+def check_schemas(fits_file, keywd_schemas, mode_used):
+    """
+    This function checks the headers of a file against several schemas, reading them only once, without writing
+    any file.
+    Args:
+        fits_file: string, name of the input file to be checked
+        keywd_schemas: list of KeywdSchema
+        mode_used: str or None, observation mode used FS, MOS, or IFU
+
+    Returns:
+        schema_results: ordered dictionary of schema name to SchemaResult
+    """
+    file_headers = read_file_headers(fits_file)
+    schema_results = OrderedDict()
+    for keywd_schema in keywd_schemas:
+        warnings_list, missing_keywds = [], []
+        specific_keys_dict = check_keywds(keywd_schema, file_headers, None, warnings_list, missing_keywds,
+                                          mode_used, write_warnings=False)
+        schema_results[keywd_schema.name] = SchemaResult(list(OrderedDict.fromkeys(warnings_list)),
+                                                         list(OrderedDict.fromkeys(missing_keywds)),
+                                                         specific_keys_dict)
+    return schema_results
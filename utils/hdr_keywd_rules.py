@@ -0,0 +1,275 @@
+import collections
+import functools
+import re
+from datetime import datetime
+import numpy as np
+
+
+'''
+This script contains the rules used by hdr_keywd_engine.py (for hdr_keywd_check.py and level2b_hdr_keywd_check.py)
+to check the header keyword values. The keyword dictionaries (e.g. hdr_keywd_dict.py or
+level2b_hdr_keywd_dict_sample.py) are compiled only once into a table with a rule per keyword (see compile_rules),
+which checks all the keywords of a header in a single pass (see check_header) and can be used from any other script.
+
+Example usage:
+    import hdr_keywd_dict as hkwd
+    import hdr_keywd_rules as hkrules
+    keywd_rules = hkrules.compile_rules(hkwd.keywd_dict)
+    keywd_warnings = hkrules.check_header(keywd_rules, file_keywd_dict)
+
+'''
+
+# rule to check a keyword value: allowed values and/or types, expected values (for the keywords that are replaced
+# when they have other values, e.g. VISITYPE), function that tells if the value is right without further checks, and
+# the function that checks the format of the value of specific keywords (or None)
+KeywdRule = collections.namedtuple("KeywdRule", ["keywd", "allowed", "expected", "quick_check", "format_check"])
+
+# a letter anywhere in the value, a structure like 0.1.1 at its start, and the format of the dates and times
+letter_re = re.compile(r'[^\W\d_]')
+three_numbers_re = re.compile(r'\d.\d.\d')
+time_format = '%H:%M:%S'
+date_format = '%Y-%m-%d'
+datetime_format = '%Y-%m-%dT%H:%M:%S'
+
+
+### Functions to check specific keyword values
+
+def coerce_value(val):
+    """
+    This function converts the string value of a keyword as read from the header into an integer or a float, if it
+    looks like one (no letters, and no dot or one dot, respectively).
+    Args:
+        val: string, or the value as it is if it is not a string
+
+    Returns:
+        val: string, integer, or float
+    """
+    if isinstance(val, str) and letter_re.search(val) is None:
+        count = val.count('.')
+        if (count == 0) and (':' not in val) and ('-' not in val):
+            val = int(val)
+        elif (count == 1) and (':' not in val):
+            val = float(val)
+    return val
+
+
+def check_value_type(key, val, hkwd_val, ext='primary'):
+    """
+    Check if the keyword has the right type of value.
+    Args:
+        key: string, keyword
+        val: string, integer, or float, value of the keyword given
+        hkwd_val: list of the allowed keyword values
+        ext: string, extension number (default value is 'primary')
+
+    Returns:
+        warning: string or None, if string this is a sentence saying that either the keyword was empty or that its
+                 value does not correspond to one of the expected values.
+    """
+    if val == '':
+        warning = '{:<15} {:<9} {:<25}'.format(key, ext, 'This keyword has an empty value')
+        print (warning)
+        return warning
+    # Check if type of value correspond to what is given, else change it
+    val = coerce_value(val)
+    valtype = type(val)
+    if (valtype in hkwd_val) or (val in hkwd_val):
+        print ('{:<15} {:<9} {:<25}'.format(key, ext, 'Allowed value type'))
+        warning = None
+    else:
+        warning = '{:<15} {:<9} {:<25}'.format(key, ext, 'Incorrect value type. Expected: '+str(val)+', got: '+str(valtype))
+        print (warning)
+    return warning
+
+
+def check3numbers(key, val, ext='primary'):
+    """
+    Check if this keyword value has a format like: 0.1.1
+    Args:
+        key: keyword
+        val: value of that keyword
+        ext: string, extension number (default value is 'primary')
+
+    Returns:
+        A warning (if the format is not what is expected) or nothing if it is.
+
+    """
+    warning = '{:<15} {:<9} {:<25}'.format(key, ext, 'Incorrect value format. Expected: 0.0.0, got: '+str(val))
+    if three_numbers_re.match(str(val)) is None:
+        print (warning)
+        return warning
+    else:
+        print ('{:<15} {:<9} {:<25}'.format(key, ext, 'Matches expected format'))
+
+
+def check_len(key, val, val_len=2, ext='primary'):
+    """
+    Check if the length of the keyword value has a a given length, default value for the length check is 2.
+    Args:
+        key: keyword
+        val: keyword value
+        val_len: length to be checked against
+        ext: string, extension number (default value is 'primary')
+
+    Returns:
+        A warning (if the length was not what was expected) or nothing.
+
+    """
+    string_length = len(str(val))
+    warning = '{:<15} {:<9} {:<25}'.format(key, ext, 'Incorrect length of value. Expected: '+repr(val_len)+', got '+repr(string_length))
+    if string_length == val_len:
+        print ('{:<15} {:<9} {:<25}'.format(key, ext, 'Correct format'))
+    else:
+        print (warning)
+        return warning
+
+
+def check_datetimeformat(key, val, check_time, check_date, check_datetime, ext='primary'):
+    """
+    Check if the date and/or time has the expected format.
+    Args:
+        key: keyword
+        val: keyword value
+        check_time: boolean, if true check against this format hr:min:sec
+        check_date: boolean, if true check against this format year:month:day
+        check_datetime: boolean, if true check against this format year-month-dayThr:min:sec
+        ext: string, extension number (default value is 'primary')
+
+    Returns:
+        A warning that the format is not correct, or nothing.
+    """
+    warning = '{:<15} {:<9} {:<25}'.format(key, ext, 'Incorrect value format')
+    val = str(val)
+    try:
+        if '.' in val:
+            vlist = val.split(':')
+            v = float(vlist[-1])
+            v = str(int(np.round(v, decimals=0)))
+            val = vlist[0]+':'+vlist[1]+':'+v
+        if check_time:
+            val = datetime.strptime(val, time_format)
+        if check_date:
+            val = datetime.strptime(val, date_format)
+        if check_datetime:
+            val = datetime.strptime(val, datetime_format)
+    except (ValueError, IndexError):
+        pass
+    if isinstance(val, datetime):
+        print ('{:<15} {:<9} {:<25}'.format(key, ext, 'Correct value format'))
+    else:
+        print (warning)
+        return warning
+
+
+# checks of the format of specific keywords, they replace the result of the check of the value type
+format_checks = {
+    'DPSW_VER': check3numbers,
+    'VISITGRP': functools.partial(check_len, val_len=2),
+    'ACT_ID': functools.partial(check_len, val_len=2),
+    'OBSERVTN': functools.partial(check_len, val_len=3),
+    'VISIT': functools.partial(check_len, val_len=3),
+    'EXPOSURE': functools.partial(check_len, val_len=5),
+    'DATE': functools.partial(check_datetimeformat, check_date=False, check_datetime=True, check_time=False),
+    'VSTSTART': functools.partial(check_datetimeformat, check_date=False, check_datetime=True, check_time=False),
+    'DATE-OBS': functools.partial(check_datetimeformat, check_date=True, check_datetime=False, check_time=False),
+    'TIME-OBS': functools.partial(check_datetimeformat, check_date=False, check_datetime=False, check_time=True),
+}
+
+
+### Rule table
+
+def type_is(valtype, val):
+    """
+    This function tells if the value is of the given type (the quick check of the rules compiled from samples).
+    Args:
+        valtype: type
+        val: keyword value
+
+    Returns:
+        boolean
+    """
+    return type(val) == valtype
+
+
+def is_logical(val):
+    """
+    This function tells if the value is a FITS logical value, i.e. a boolean, or T or F as read from the printed
+    header (the quick check of the rules compiled from boolean samples).
+    Args:
+        val: keyword value
+
+    Returns:
+        boolean
+    """
+    return isinstance(val, (bool, np.bool_)) or val in ('T', 'F')
+
+
+def compile_rules(keywd_dict, sample_values=False):
+    """
+    This function compiles a keyword dictionary into a table of rules, one per keyword (the WCS keywords of the
+    wcsinfo entry are not checked, since they are always added to the science extension).
+    Args:
+        keywd_dict: dictionary, keyword to list of allowed values and/or types (e.g. hdr_keywd_dict.py), or
+                    keyword to sample value (e.g. level2b_hdr_keywd_dict_sample.py)
+        sample_values: boolean, if True the dictionary has sample values, and the value of a keyword has to be of
+                       the same type as the sample
+
+    Returns:
+        keywd_rules: ordered dictionary of keyword to KeywdRule
+    """
+    keywd_rules = collections.OrderedDict()
+    for keywd, allowed in keywd_dict.items():
+        if keywd == 'wcsinfo':
+            continue
+        if sample_values:
+            expected = [allowed]
+            allowed = [type(allowed)]
+            quick_check = functools.partial(type_is, allowed[0])
+            if allowed[0] == bool:
+                quick_check = is_logical
+        else:
+            allowed = list(allowed)
+            expected = allowed
+            quick_check = allowed.__contains__
+        keywd_rules[keywd] = KeywdRule(keywd, allowed, expected, quick_check, format_checks.get(keywd))
+    return keywd_rules
+
+
+def check_keywd_value(rule, val, ext='primary'):
+    """
+    This function checks the value of a keyword with its rule.
+    Args:
+        rule: KeywdRule
+        val: keyword value
+        ext: string, extension number (default value is 'primary')
+
+    Returns:
+        warning: string or None
+    """
+    if rule.quick_check(val):
+        print ('{:<15} {:<9} {:<25}'.format(rule.keywd, ext, 'Has correct format'))
+        warning = None
+    else:
+        warning = check_value_type(rule.keywd, val, rule.allowed, ext=ext)
+    if rule.format_check is not None:
+        warning = rule.format_check(rule.keywd, val, ext=ext)
+    return warning
+
+
+def check_header(keywd_rules, file_keywd_dict, ext='primary'):
+    """
+    This function checks all the keywords of a header in a single pass. The keywords that are not in the header
+    are not checked (they are missing, not wrong).
+    Args:
+        keywd_rules: ordered dictionary of keyword to KeywdRule (output of compile_rules)
+        file_keywd_dict: dictionary of keyword to value of the header
+        ext: string, extension number (default value is 'primary')
+
+    Returns:
+        keywd_warnings: ordered dictionary of keyword to warning (None if the value is right)
+    """
+    keywd_warnings = collections.OrderedDict()
+    for keywd, rule in keywd_rules.items():
+        if keywd in file_keywd_dict:
+            keywd_warnings[keywd] = check_keywd_value(rule, file_keywd_dict[keywd], ext=ext)
+    return keywd_warnings
@@ -0,0 +1,12 @@
+"""
+py.test configuration for the tests of the utils scripts
+"""
+
+import os
+import sys
+
+
+# the scripts import each other by their names, as when they are run from the terminal
+utils_dir = os.path.abspath(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+if utils_dir not in sys.path:
+    sys.path.insert(0, utils_dir)
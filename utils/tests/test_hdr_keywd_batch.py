@@ -0,0 +1,62 @@
+import os
+
+import hdr_keywd_batch as hkbatch
+import hdr_keywd_check as hkcheck
+import level2b_hdr_keywd_check as lev2bcheck
+from .test_hdr_keywd_engine import mk_sample_file
+
+
+"""
+This script tests the exit status and the report of the batch mode of the header keyword checks.
+"""
+
+
+def read_report_rows(report_file_name):
+    """
+    This function reads the rows of a report, without the comment lines.
+    Args:
+        report_file_name: string, name of the report file
+
+    Returns:
+        rows: list of strings
+    """
+    with open(report_file_name) as rf:
+        rows = [line for line in rf.readlines() if not line.startswith('#')]
+    return rows
+
+
+def test_clean_files(tmpdir):
+    """
+    Files with the keywords of each schema give no rows in the report and exit status ok.
+    """
+    level2a_file = str(tmpdir.join('test_level2a.fits'))
+    mk_sample_file(level2a_file, hkcheck.keywd_schema.sample_dict)
+    level2b_file = str(tmpdir.join('test_level2b.fits'))
+    mk_sample_file(level2b_file, lev2bcheck.keywd_schema.sample_dict, DATAMODL='IFUImageModel',
+                   MSASTATE='PRIMARYPARK_ALLCLOSED')
+    for perform_check, fits_file, mode_used in [(hkcheck.perform_check, level2a_file, 'MOS'),
+                                                (lev2bcheck.perform_check, level2b_file, 'IFU')]:
+        report_file_name = fits_file.replace('.fits', '_report.txt')
+        exit_status = hkbatch.run_batch(perform_check, [fits_file], False, mode_used, report_file_name,
+                                        n_workers=1)
+        assert exit_status == hkbatch.exit_status_ok
+        assert read_report_rows(report_file_name) == []
+
+
+def test_file_not_found(tmpdir, capsys):
+    """
+    A file that does not exist is reported as not found, and it is not counted among the files checked.
+    """
+    fits_file = str(tmpdir.join('test_level2a.fits'))
+    mk_sample_file(fits_file, hkcheck.keywd_schema.sample_dict)
+    missing_file = str(tmpdir.join('test_missing.fits'))
+    report_file_name = str(tmpdir.join('report.txt'))
+    exit_status = hkbatch.run_batch(hkcheck.perform_check, [missing_file, fits_file], False, 'MOS',
+                                    report_file_name, n_workers=1)
+    assert exit_status == hkbatch.exit_status_failed
+    rows = read_report_rows(report_file_name)
+    assert len(rows) == 1
+    assert rows[0].startswith(missing_file) and 'ERROR: file not found' in rows[0]
+    summary = capsys.readouterr().out.split('Files checked:')[-1].split()
+    assert summary == ['1', 'with', 'warnings:', '0', 'could', 'not', 'be', 'checked:', '0', 'not', 'found:', '1']
+    assert not os.path.exists(missing_file.replace('.fits', '_updatedHDR.fits'))
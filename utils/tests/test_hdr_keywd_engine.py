@@ -0,0 +1,63 @@
+import numpy as np
+from astropy.io import fits
+
+import hdr_keywd_check as hkcheck
+import hdr_keywd_engine as hkengine
+import level2b_hdr_keywd_check as lev2bcheck
+
+
+"""
+This script tests that the header keyword engine leaves alone the headers that already have the expected keywords.
+"""
+
+
+# keywords written by astropy
+structural_keywds = ['SIMPLE', 'BITPIX', 'NAXIS', 'EXTEND']
+
+
+def mk_sample_file(file_name, sample_dict, **keywds):
+    """
+    This function writes a fits file with the sample values of the keywords, the WCS keywords in the science
+    extension, and the given keyword values.
+    Args:
+        file_name: string, name of the fits file
+        sample_dict: dictionary, keyword to sample value
+        keywds: keyword values that replace the sample values
+    """
+    prihdu = fits.PrimaryHDU()
+    for key, val in sample_dict.items():
+        if key != 'wcsinfo' and key not in structural_keywds:
+            prihdu.header[key] = keywds.get(key, val)
+    sci = fits.ImageHDU(np.zeros((4, 6), dtype='f4'), name='SCI')
+    for subkey, val in sample_dict['wcsinfo'].items():
+        sci.header[subkey] = val
+    fits.HDUList([prihdu, sci]).writeto(file_name)
+
+
+def test_level2b_sample_values(tmpdir):
+    """
+    A header with the sample values (with the keywords that depend on the mode set for IFU data) gives no warnings
+    and no edits, and the logical keywords keep their values.
+    """
+    fits_file = str(tmpdir.join('test_rate.fits'))
+    keywds = dict(DATAMODL='IFUImageModel', MSASTATE='PRIMARYPARK_ALLCLOSED', TARGOOPP=True)
+    mk_sample_file(fits_file, lev2bcheck.keywd_schema.sample_dict, **keywds)
+    schema_result = hkengine.check_schemas(fits_file, [lev2bcheck.keywd_schema], 'IFU')['level2b']
+    assert schema_result == hkengine.SchemaResult([], [], {})
+    warnings_list = lev2bcheck.perform_check(fits_file, False, 'IFU', write_addedkeywds=False)
+    assert warnings_list == []
+    updated_hdr = fits.getheader(fits_file.replace('.fits', '_updatedHDR.fits'))
+    assert updated_hdr == fits.getheader(fits_file)
+    assert updated_hdr['TARGOOPP'] is True
+    assert updated_hdr['INTARGET'] is True
+    assert updated_hdr['ZEROFRAM'] is False
+
+
+def test_level2a_sample_values(tmpdir):
+    """
+    A header with the level 2a sample values (MOS data) has the keywords of the level 2a schema.
+    """
+    fits_file = str(tmpdir.join('test_rate.fits'))
+    mk_sample_file(fits_file, hkcheck.keywd_schema.sample_dict)
+    schema_result = hkengine.check_schemas(fits_file, [hkcheck.keywd_schema], 'MOS')['level2a']
+    assert schema_result == hkengine.SchemaResult([], [], {})